@@ -3,26 +3,40 @@ Qwen API Backend Server
 Full REST API wrapper around qwen_client.py
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
-from qwen_client import QwenClient
+from qwen_client import QwenClient, UploadFailed, HostConnectionLimit, UpstreamBusy, POOL_TIMEOUT
+from qwen_cache import ClientPool, shared_single_flight, shared_model_cache, shared_tip_cache
+from token_refresher import TokenRefresher
+from image_prep import shared_image_preprocessor
+from oss_upload import bucket_pool
+from response_cache import shared_response_cache
+from upload_cache import shared_upload_cache
+from server_common import (
+    ALLOWED_ORIGINS,
+    ALLOWED_REFERERS,
+    ENVIRONMENT,
+    POOL_MAX_CLIENTS,
+    POOL_MAX_CONNECTIONS,
+    POOL_TTL,
+    TOKEN_REFRESH_INTERVAL,
+    TOKEN_REFRESH_MARGIN,
+    catalog_headers,
+    etag_matches,
+    format_sse,
+    load_stored_token,
+    progress_reporter,
+    save_token,
+    token_from_headers,
+    token_refreshed,
+    upload_failed_response,
+)
 import time
-import json
 import os
 from functools import wraps
 
 app = Flask(__name__)
 
-# Security: Configure CORS to only allow specific origins
-ALLOWED_ORIGINS = [
-    'https://jlpt4you.com',
-    'https://www.jlpt4you.com',
-    'http://localhost:3000',  # For local development
-    'http://localhost:5000',
-    'http://127.0.0.1:3000',
-    'http://127.0.0.1:5000'
-]
-
 CORS(app, resources={
     r"/api/*": {
         "origins": ALLOWED_ORIGINS,
@@ -31,20 +45,15 @@ CORS(app, resources={
     }
 })
 
-# Cache for clients
-_client_cache = {}
-
-# Token storage file (for persistence)
-TOKEN_FILE = os.path.join(os.path.dirname(__file__), '.token_storage.json')
+# All clients share one connection cap to the Qwen API host, so evicted
+# clients need no closing (a handler may still be streaming through one)
+upstream_adapter = HostConnectionLimit(POOL_MAX_CONNECTIONS)
 
-# Security configuration
-ENVIRONMENT = os.getenv('ENVIRONMENT', 'development')  # production, development
-ALLOWED_REFERERS = [
-    'https://jlpt4you.com',
-    'https://www.jlpt4you.com',
-    'http://localhost',
-    'http://127.0.0.1'
-]
+client_pool = ClientPool(
+    factory=lambda token: QwenClient(auth_token=token, http_adapter=upstream_adapter),
+    max_size=POOL_MAX_CLIENTS,
+    ttl=POOL_TTL
+)
 
 def check_security():
     """Security middleware to check origin and referer"""
@@ -79,21 +88,12 @@ def check_security():
         return decorated_function
     return decorator
 
-def load_stored_token():
-    """Load token from file"""
-    if os.path.exists(TOKEN_FILE):
-        try:
-            with open(TOKEN_FILE, 'r') as f:
-                data = json.load(f)
-                return data.get('token')
-        except:
-            pass
-    return None
-
-def save_token(token):
-    """Save token to file"""
-    with open(TOKEN_FILE, 'w') as f:
-        json.dump({'token': token, 'updated_at': int(time.time())}, f)
+token_refresher = TokenRefresher(
+    client_pool,
+    margin=TOKEN_REFRESH_MARGIN,
+    interval=TOKEN_REFRESH_INTERVAL,
+    on_refresh=token_refreshed
+)
 
 # Global client instance (will be initialized per request with token)
 def get_token_from_request():
@@ -104,22 +104,7 @@ def get_token_from_request():
     2. QWEN_TOKEN from environment variable
     3. Stored token from file
     """
-    # Try to get from Authorization header
-    token = request.headers.get('Authorization', '').replace('Bearer ', '')
-    if token:
-        return token
-    
-    # Try to get from environment variable
-    env_token = os.getenv('QWEN_TOKEN')
-    if env_token:
-        return env_token
-    
-    # Try to get from stored file
-    stored_token = load_stored_token()
-    if stored_token:
-        return stored_token
-    
-    return None
+    return token_from_headers(request.headers)
 
 def get_client(token=None):
     """Get QwenClient instance with token"""
@@ -129,11 +114,108 @@ def get_client(token=None):
     if not token:
         raise ValueError("No token available")
     
-    if token in _client_cache:
-        return _client_cache[token]
-    client = QwenClient(auth_token=token)
-    _client_cache[token] = client
-    return client
+    token_refresher.start()
+    return client_pool.get(token)
+
+def wants_event_stream():
+    """Check whether the caller asked for a Server-Sent Events response"""
+    return 'text/event-stream' in request.headers.get('Accept', '')
+
+def error_status(e):
+    """503 when every upstream connection stayed busy for the pool timeout, else 500"""
+    return 503 if isinstance(e, UpstreamBusy) else 500
+
+def stream_upload_response(upload, filename):
+    """
+    Run an upload in a worker thread and report it as Server-Sent Events
+    
+    upload(progress_callback) performs the upload and returns file metadata.
+        event: progress  {"filename": ..., "uploaded": ..., "total": ..., "percent": ...}
+        event: done      {"success": true, "data": <file metadata>}
+        event: error     {"error": ...}
+    """
+    import queue
+    import threading
+    
+    events = queue.Queue()
+    
+    def run():
+        try:
+            file_metadata = upload(progress_reporter(filename, lambda data: events.put(('progress', data))))
+            events.put(('done', {"success": True, "data": file_metadata}))
+        except Exception as e:
+            events.put(('error', {"error": str(e)}))
+    
+    threading.Thread(target=run, daemon=True).start()
+    
+    def generate():
+        while True:
+            event, data = events.get()
+            yield format_sse(event, data)
+            if event != 'progress':
+                return
+    
+    # Keep the request (and its uploaded file streams) open until the upload ends
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+def stream_chat_response(client, chat_id, data):
+    """
+    Stream a chat completion to the browser as Server-Sent Events
+    
+    Every delta from the upstream completion stream is re-emitted as its
+    own frame as soon as it is parsed:
+        event: meta      {"chat_id": ...}
+        event: phase     {"phase": ...}     ("think" / "answer")
+        event: thinking  {"content": ...}   (reasoning output)
+        event: answer    {"content": ...}   (answer output)
+        event: done      {"chat_id": ..., "response_id": ..., "usage": ...}
+        event: error     {"error": ...}
+    """
+    deltas = client.stream_message(
+        chat_id=chat_id,
+        message=data.get('message'),
+        model=data.get('model', 'qwen3-max'),
+        system_prompt=data.get('system_prompt'),
+        thinking_enabled=data.get('thinking_enabled', False),
+        search_enabled=data.get('search_enabled', False)
+    )
+    
+    def generate():
+        yield format_sse('meta', {"chat_id": chat_id})
+        try:
+            for delta in deltas:
+                if delta.type == "content":
+                    yield format_sse('answer', {"content": delta.content})
+                elif delta.type == "reasoning":
+                    yield format_sse('thinking', {"content": delta.content})
+                elif delta.type == "phase":
+                    yield format_sse('phase', {"phase": delta.phase})
+                elif delta.type == "done":
+                    yield format_sse('done', {
+                        "chat_id": chat_id,
+                        "response_id": delta.response_id,
+                        "usage": delta.usage
+                    })
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            yield format_sse('error', {"error": str(e)})
+    
+    return Response(
+        generate(),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
 
 # Health & Status Endpoints
 # ============================================================
@@ -153,12 +235,15 @@ def list_models():
     """List available Qwen models"""
     try:
         client = get_client()
-        models = client.list_models()
-        return jsonify(models)
+        catalog = client.get_model_catalog()
+        headers = catalog_headers(catalog)
+        if etag_matches(request.headers.get('If-None-Match'), catalog.etag):
+            return Response(status=304, headers=headers)
+        return Response(catalog.body, mimetype='application/json', headers=headers)
     except ValueError as e:
         return jsonify({"error": "No authorization token"}), 401
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return jsonify({"error": str(e)}), error_status(e)
 
 @app.route('/api/admin/token', methods=['POST'])
 def update_token():
@@ -187,8 +272,8 @@ def update_token():
     # Save token
     save_token(new_token)
     
-    # Clear cache so new token is used
-    _client_cache.clear()
+    # Clear pool so new token is used
+    client_pool.clear()
     
     return jsonify({
         "success": True,
@@ -217,6 +302,32 @@ def get_token_info():
             "has_token": False
         })
 
+@app.route('/api/admin/pool', methods=['GET'])
+def pool_stats():
+    """Client pool and cache statistics (for admin use)"""
+    admin_key = request.args.get('admin_key')
+    expected_key = os.getenv('ADMIN_KEY', 'change-me-in-production')
+    
+    if admin_key != expected_key:
+        return jsonify({"error": "Invalid admin key"}), 403
+    
+    return jsonify({
+        "success": True,
+        "client_pool": dict(
+            client_pool.stats(),
+            max_connections=POOL_MAX_CONNECTIONS,
+            pool_timeout=POOL_TIMEOUT
+        ),
+        "tip_cache": shared_tip_cache.stats(),
+        "model_cache": shared_model_cache.stats(),
+        "single_flight": shared_single_flight.stats(),
+        "token_refresher": token_refresher.stats(),
+        "upload_cache": shared_upload_cache.stats() if shared_upload_cache else None,
+        "response_cache": shared_response_cache.stats() if shared_response_cache else None,
+        "image_preprocessor": shared_image_preprocessor.stats() if shared_image_preprocessor else None,
+        "oss_pool": bucket_pool.stats()
+    })
+
 @app.route('/api/user/status', methods=['GET'])
 @check_security()
 def user_status():
@@ -228,7 +339,7 @@ def user_status():
     except ValueError as e:
         return jsonify({"error": "No authorization token"}), 401
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return jsonify({"error": str(e)}), error_status(e)
 
 # ============================================================
 # ============================================================
@@ -239,20 +350,21 @@ def refresh_token():
     """Refresh authentication token"""
     try:
         client = get_client()
-        new_token = client.refresh_token()
+        data = token_refresher.refresh(client)
         
         # Save the new token
-        save_token(new_token)
+        save_token(client.auth_token)
         
         return jsonify({
             "success": True,
-            "token": new_token,
+            "token": client.auth_token,
+            "expires_at": data.get('expires_at'),
             "message": "Token refreshed successfully"
         })
     except ValueError as e:
         return jsonify({"error": "No authorization token"}), 401
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return jsonify({"error": str(e)}), error_status(e)
 
 @app.route('/api/token/info', methods=['GET'])
 @check_security()
@@ -270,7 +382,7 @@ def token_info():
             "source": "header" if request.headers.get('Authorization') else "environment"
         })
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return jsonify({"error": str(e)}), error_status(e)
 
 # ============================================================
 # Chat Management
@@ -293,7 +405,7 @@ def list_chats():
     except ValueError as e:
         return jsonify({"error": "No authorization token"}), 401
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return jsonify({"error": str(e)}), error_status(e)
 
 @app.route('/api/chats/<chat_id>', methods=['GET'])
 @check_security()
@@ -309,7 +421,7 @@ def get_chat(chat_id):
     except ValueError as e:
         return jsonify({"error": "No authorization token"}), 401
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return jsonify({"error": str(e)}), error_status(e)
 
 @app.route('/api/chats/<chat_id>', methods=['DELETE'])
 @check_security()
@@ -325,7 +437,7 @@ def delete_chat(chat_id):
     except ValueError as e:
         return jsonify({"error": "No authorization token"}), 401
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return jsonify({"error": str(e)}), error_status(e)
 
 # ============================================================
 # Messaging
@@ -344,6 +456,9 @@ def send_message():
         "model": "qwen3-max",  // optional
         "stream": false  // always false for now
     }
+    
+    Send "Accept: text/event-stream" to receive Server-Sent Events instead
+    (see /api/chat/stream).
     """
     data = request.get_json()
     chat_id = data.get('chat_id')
@@ -359,34 +474,22 @@ def send_message():
     try:
         client = get_client()
         
-        # Capture stdout to get the streamed response
-        import sys
-        from io import StringIO
-        
-        old_stdout = sys.stdout
-        sys.stdout = StringIO()
+        if wants_event_stream():
+            return stream_chat_response(client, chat_id, data)
         
-        try:
-            # Call with stream=True to get response content
-            result = client.send_message(
-                chat_id=chat_id,
-                message=message,
-                model=model,
-                stream=True,
-                system_prompt=system_prompt,
-                thinking_enabled=thinking_enabled,
-                search_enabled=search_enabled
-            )
-            
-            # Get the captured output
-            response_content = sys.stdout.getvalue()
-            
-        finally:
-            sys.stdout = old_stdout
+        result = client.send_message(
+            chat_id=chat_id,
+            message=message,
+            model=model,
+            stream=True,
+            system_prompt=system_prompt,
+            thinking_enabled=thinking_enabled,
+            search_enabled=search_enabled
+        )
         
         # Return the response with thinking if available
         response_data = {
-            "content": result.get("content", response_content.strip())
+            "content": result.get("content", "")
         }
         
         # Add thinking content if present
@@ -402,7 +505,7 @@ def send_message():
     except Exception as e:
         import traceback
         traceback.print_exc()
-        return jsonify({"error": str(e)}), 500
+        return jsonify({"error": str(e)}), error_status(e)
 
 @app.route('/api/chat/quick', methods=['POST'])
 @check_security()
@@ -415,6 +518,9 @@ def quick_chat():
         "message": "your message",
         "model": "qwen3-max"  // optional
     }
+    
+    Send "Accept: text/event-stream" to receive Server-Sent Events instead
+    (see /api/chat/stream).
     """
     data = request.get_json()
     message = data.get('message')
@@ -436,34 +542,22 @@ def quick_chat():
         
         chat_id = chats['data'][0]['id']
         
-        # Capture stdout to get the streamed response
-        import sys
-        from io import StringIO
-        
-        old_stdout = sys.stdout
-        sys.stdout = StringIO()
+        if wants_event_stream():
+            return stream_chat_response(client, chat_id, data)
         
-        try:
-            # Call with stream=True to get response content
-            result = client.send_message(
-                chat_id=chat_id,
-                message=message,
-                model=model,
-                stream=True,
-                system_prompt=system_prompt,
-                thinking_enabled=thinking_enabled,
-                search_enabled=search_enabled
-            )
-            
-            # Get the captured output
-            response_content = sys.stdout.getvalue()
-            
-        finally:
-            sys.stdout = old_stdout
+        result = client.send_message(
+            chat_id=chat_id,
+            message=message,
+            model=model,
+            stream=True,
+            system_prompt=system_prompt,
+            thinking_enabled=thinking_enabled,
+            search_enabled=search_enabled
+        )
         
         # Return response with thinking if available
         response_data = {
-            "content": result.get("content", response_content.strip())
+            "content": result.get("content", "")
         }
         
         if "thinking" in result and result["thinking"]:
@@ -479,7 +573,42 @@ def quick_chat():
     except Exception as e:
         import traceback
         traceback.print_exc()
-        return jsonify({"error": str(e)}), 500
+        return jsonify({"error": str(e)}), error_status(e)
+
+@app.route('/api/chat/stream', methods=['POST'])
+@check_security()
+def stream_chat():
+    """
+    Send a message and stream the response as Server-Sent Events
+    
+    Request body: same as /api/chat/send. chat_id is optional; the most
+    recent chat is used when it is omitted.
+    
+    Events: meta, thinking, answer, done, error (see stream_chat_response)
+    """
+    data = request.get_json()
+    chat_id = data.get('chat_id')
+    message = data.get('message')
+    
+    if not message:
+        return jsonify({"error": "message is required"}), 400
+    
+    try:
+        client = get_client()
+        
+        if not chat_id:
+            chats = client.list_chats(page=1)
+            if not chats.get('data'):
+                return jsonify({"error": "No chats found. Please create a chat first."}), 404
+            chat_id = chats['data'][0]['id']
+        
+        return stream_chat_response(client, chat_id, data)
+    except ValueError as e:
+        return jsonify({"error": "No authorization token"}), 401
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), error_status(e)
 
 # ============================================================
 # File Upload
@@ -517,7 +646,7 @@ def get_sts_token():
     except ValueError as e:
         return jsonify({"error": "No authorization token"}), 401
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return jsonify({"error": str(e)}), error_status(e)
 
 @app.route('/api/files/upload', methods=['POST'])
 @check_security()
@@ -531,44 +660,64 @@ def upload_file():
     Form data:
         file: The file to upload
         filetype: (optional) "image" or "file"
+    
+    werkzeug parses the whole form before this view runs, spooling files
+    over 500KB to a temporary file, so multipart uploads reach OSS only
+    after the body has been received.
+    
+    Or send the raw file as the request body (any other Content-Type) with
+    Content-Length set and the name in ?filename= or an X-Filename header
+    (filetype in ?filetype=). The body is piped straight to OSS as it
+    arrives, without buffering the whole file. An X-Content-SHA256 header
+    lets a file uploaded before be answered from the upload cache without
+    reading the body.
+    
+    With "Accept: text/event-stream" the upload progress is streamed as
+    progress events followed by done (or error); see stream_upload_response.
     """
     try:
-        if 'file' not in request.files:
-            return jsonify({"error": "No file provided"}), 400
-        
-        file = request.files['file']
-        if file.filename == '':
+        if request.mimetype == 'multipart/form-data':
+            if 'file' not in request.files:
+                return jsonify({"error": "No file provided"}), 400
+        
+            file = request.files['file']
+            filename = file.filename
+            filetype = request.form.get('filetype')
+            stream, size, sha256 = file.stream, None, None
+        else:
+            filename = request.args.get('filename') or request.headers.get('X-Filename')
+            filetype = request.args.get('filetype')
+            stream, size = request.stream, request.content_length
+            sha256 = request.headers.get('X-Content-SHA256')
+            if size is None:
+                return jsonify({"error": "Content-Length required"}), 411
+        
+        if not filename:
             return jsonify({"error": "Empty filename"}), 400
         
-        filetype = request.form.get('filetype')
-        
-        # Save file temporarily
-        import tempfile
-        import os
-        
-        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file.filename)[1]) as tmp:
-            file.save(tmp.name)
-            tmp_path = tmp.name
+        client = get_client()
         
-        try:
-            client = get_client()
-            file_metadata = client.upload_file(tmp_path, filetype)
+        def upload(progress_callback=None):
+            return client.upload_file(
+                stream, filetype, progress_callback=progress_callback,
+                filename=filename, size=size, sha256=sha256
+            )
             
-            return jsonify({
-                "success": True,
-                "data": file_metadata
-            })
-        finally:
-            # Clean up temp file
-            if os.path.exists(tmp_path):
-                os.remove(tmp_path)
+        if wants_event_stream():
+            return stream_upload_response(upload, filename)
+        
+        file_metadata = upload()
+        return jsonify({
+            "success": True,
+            "data": file_metadata
+        })
                 
     except ValueError as e:
         return jsonify({"error": "No authorization token"}), 401
     except Exception as e:
         import traceback
         traceback.print_exc()
-        return jsonify({"error": str(e)}), 500
+        return jsonify({"error": str(e)}), error_status(e)
 
 @app.route('/api/chat/send-with-files', methods=['POST'])
 @check_security()
@@ -599,27 +748,15 @@ def send_message_with_files():
         if not files:
             return jsonify({"error": "No files provided"}), 400
         
-        import tempfile
-        import os
-        
-        tmp_files = []
+        # Uploaded straight from the parsed form, without saving copies first
+        uploads = [(file.filename, file.stream) for file in files if file.filename]
+        filenames = [name for name, _ in uploads]
         try:
-            # Save files temporarily
-            for file in files:
-                if file.filename:
-                    tmp = tempfile.NamedTemporaryFile(
-                        delete=False, 
-                        suffix=os.path.splitext(file.filename)[1]
-                    )
-                    file.save(tmp.name)
-                    tmp.close()
-                    tmp_files.append(tmp.name)
-            
             # Send message with files
             client = get_client()
             response = client.chat_with_files(
                 message=message,
-                files=tmp_files,
+                files=uploads,
                 chat_id=chat_id,
                 model=model,
                 stream=False
@@ -630,19 +767,16 @@ def send_message_with_files():
                 "chat_id": chat_id,
                 "data": response
             })
-            
-        finally:
-            # Clean up temp files
-            for tmp_path in tmp_files:
-                if os.path.exists(tmp_path):
-                    os.remove(tmp_path)
+        
+        except UploadFailed as e:
+            return jsonify(upload_failed_response(e, filenames)), 502
                     
     except ValueError as e:
         return jsonify({"error": "No authorization token"}), 401
     except Exception as e:
         import traceback
         traceback.print_exc()
-        return jsonify({"error": str(e)}), 500
+        return jsonify({"error": str(e)}), error_status(e)
 
 # ============================================================
 # Statistics & Info
@@ -676,7 +810,7 @@ def get_stats():
     except ValueError as e:
         return jsonify({"error": "No authorization token"}), 401
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return jsonify({"error": str(e)}), error_status(e)
 
 # ============================================================
 # Error Handlers
@@ -707,6 +841,7 @@ if __name__ == '__main__':
     print("\n📚 Available Endpoints:")
     print(f"  GET  /health                    - Health check")
     print(f"  GET  /api/user/status           - User status")
+    print(f"  GET  /api/admin/pool           - Client pool stats (admin)")
     print(f"  POST /api/token/refresh         - Refresh token")
     print(f"  GET  /api/token/info            - Token info")
     print(f"  GET  /api/chats                 - List chats")
@@ -714,6 +849,7 @@ if __name__ == '__main__':
     print(f"  DELETE /api/chats/<id>          - Delete chat")
     print(f"  POST /api/chat/send             - Send message")
     print(f"  POST /api/chat/quick            - Quick chat")
+    print(f"  POST /api/chat/stream           - Send message (SSE stream)")
     print(f"  POST /api/files/sts-token       - Get STS token for upload")
     print(f"  POST /api/files/upload          - Upload file")
     print(f"  POST /api/chat/send-with-files  - Send message with files")
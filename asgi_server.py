@@ -0,0 +1,705 @@
+"""
+Qwen API Backend Server (ASGI)
+Async version of api_server.py on Starlette + AsyncQwenClient
+
+Every handler is a coroutine, so one worker process can hold hundreds of
+open chat streams without a thread per request. api_server.py (Flask) keeps
+working as the compatibility mode with the same routes and responses.
+
+Run:
+    uvicorn asgi_server:app --host 0.0.0.0 --port 5001
+    python asgi_server.py [port]
+"""
+
+import asyncio
+import contextlib
+import io
+import os
+import time
+from functools import wraps
+
+import httpx
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from async_qwen_client import AsyncQwenClient, create_http_client
+from qwen_client import POOL_TIMEOUT, UploadFailed
+from qwen_cache import ClientPool, shared_async_single_flight, shared_model_cache, shared_tip_cache
+from server_common import (
+    ALLOWED_ORIGINS,
+    ALLOWED_REFERERS,
+    ENVIRONMENT,
+    POOL_MAX_CLIENTS,
+    POOL_MAX_CONNECTIONS,
+    POOL_TTL,
+    TOKEN_REFRESH_INTERVAL,
+    TOKEN_REFRESH_MARGIN,
+    catalog_headers,
+    etag_matches,
+    format_sse,
+    load_stored_token,
+    progress_reporter,
+    save_token,
+    token_from_headers,
+    token_refreshed,
+    upload_failed_response,
+)
+from token_refresher import AsyncTokenRefresher
+from image_prep import shared_image_preprocessor
+from oss_upload import bucket_pool
+from response_cache import shared_response_cache
+from upload_cache import shared_upload_cache
+
+# All clients share one HTTP/2 transport, so evicted clients need no closing
+_http_client = None
+client_pool = ClientPool(
+    factory=lambda token: AsyncQwenClient(auth_token=token, http_client=_http_client),
+    max_size=POOL_MAX_CLIENTS,
+    ttl=POOL_TTL
+)
+token_refresher = AsyncTokenRefresher(
+    client_pool,
+    margin=TOKEN_REFRESH_MARGIN,
+    interval=TOKEN_REFRESH_INTERVAL,
+    on_refresh=token_refreshed
+)
+
+def check_security(handler):
+    """Security middleware to check origin and referer"""
+    @wraps(handler)
+    async def decorated_function(request):
+        # Check environment
+        if ENVIRONMENT == 'production':
+            return JSONResponse({
+                "error": "API is only available in development environment"
+            }, status_code=403)
+        
+        # Check Origin header
+        origin = request.headers.get('Origin')
+        if origin and origin not in ALLOWED_ORIGINS:
+            return JSONResponse({
+                "error": "Access denied: Invalid origin",
+                "allowed_origins": ALLOWED_ORIGINS
+            }, status_code=403)
+        
+        # Check Referer header (backup check)
+        referer = request.headers.get('Referer', '')
+        if referer:
+            is_allowed = any(allowed in referer for allowed in ALLOWED_REFERERS)
+            if not is_allowed:
+                return JSONResponse({
+                    "error": "Access denied: Invalid referer",
+                    "allowed_domains": ['jlpt4you.com', 'localhost']
+                }, status_code=403)
+        
+        return await handler(request)
+    return decorated_function
+
+def get_token_from_request(request):
+    """
+    Get token from request or environment variable
+    Priority: Authorization header, QWEN_TOKEN, stored token file
+    """
+    return token_from_headers(request.headers)
+
+def get_client(request):
+    """Get AsyncQwenClient instance for the request's token"""
+    global _http_client
+    
+    token = get_token_from_request(request)
+    if not token:
+        raise ValueError("No token available")
+    
+    if _http_client is None:
+        _http_client = create_http_client(max_connections=POOL_MAX_CONNECTIONS, pool_timeout=POOL_TIMEOUT)
+    
+    return client_pool.get(token)
+
+def error_response(e):
+    """Map client errors to the same JSON errors as api_server.py"""
+    if isinstance(e, ValueError):
+        return JSONResponse({"error": "No authorization token"}, status_code=401)
+    if isinstance(e, httpx.PoolTimeout):
+        return JSONResponse({"error": str(e) or "No free upstream connection"}, status_code=503)
+    import traceback
+    traceback.print_exc()
+    return JSONResponse({"error": str(e)}, status_code=500)
+
+def wants_event_stream(request):
+    """Check whether the caller asked for a Server-Sent Events response"""
+    return 'text/event-stream' in request.headers.get('Accept', '')
+
+def stream_chat_response(client, chat_id, data):
+    """Stream a chat completion as Server-Sent Events (same events as api_server.py)"""
+    async def generate():
+        yield format_sse('meta', {"chat_id": chat_id})
+        try:
+            async for delta in client.stream_message(
+                chat_id=chat_id,
+                message=data.get('message'),
+                model=data.get('model', 'qwen3-max'),
+                system_prompt=data.get('system_prompt'),
+                thinking_enabled=data.get('thinking_enabled', False),
+                search_enabled=data.get('search_enabled', False)
+            ):
+                if delta.type == "content":
+                    yield format_sse('answer', {"content": delta.content})
+                elif delta.type == "reasoning":
+                    yield format_sse('thinking', {"content": delta.content})
+                elif delta.type == "phase":
+                    yield format_sse('phase', {"phase": delta.phase})
+                elif delta.type == "done":
+                    yield format_sse('done', {
+                        "chat_id": chat_id,
+                        "response_id": delta.response_id,
+                        "usage": delta.usage
+                    })
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            yield format_sse('error', {"error": str(e)})
+    
+    return StreamingResponse(
+        generate(),
+        media_type='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+def stream_upload_response(upload, filename, reads_body=False):
+    """
+    Report an upload's progress as Server-Sent Events (same events as api_server.py)
+    
+    reads_body: the upload is still reading the request body (raw uploads)
+    """
+    async def generate():
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        
+        # OSS progress callbacks run in the upload's worker thread
+        def emit(data):
+            loop.call_soon_threadsafe(events.put_nowait, ('progress', data))
+        
+        task = asyncio.create_task(upload(progress_reporter(filename, emit)))
+        task.add_done_callback(lambda _: events.put_nowait(('finished', None)))
+        
+        while True:
+            event, data = await events.get()
+            if event == 'progress':
+                yield format_sse('progress', data)
+                continue
+            try:
+                yield format_sse('done', {"success": True, "data": task.result()})
+            except Exception as e:
+                yield format_sse('error', {"error": str(e)})
+            return
+    
+    response_class = BodyStreamingResponse if reads_body else StreamingResponse
+    return response_class(
+        generate(),
+        media_type='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+async def complete_chat(client, chat_id, data):
+    """Send a message and collect the streamed answer into the JSON response data"""
+    result = await client.send_message(
+        chat_id=chat_id,
+        message=data.get('message'),
+        model=data.get('model', 'qwen3-max'),
+        stream=True,
+        system_prompt=data.get('system_prompt'),
+        thinking_enabled=data.get('thinking_enabled', False),
+        search_enabled=data.get('search_enabled', False)
+    )
+    
+    response_data = {"content": result.get("content", "")}
+    if result.get("thinking"):
+        response_data["thinking"] = result["thinking"]
+    return response_data
+
+# ============================================================
+# Health & Status Endpoints
+# ============================================================
+
+async def health(request):
+    """Health check endpoint"""
+    return JSONResponse({
+        "status": "ok",
+        "service": "qwen-api-server",
+        "mode": "asgi",
+        "timestamp": int(time.time())
+    })
+
+@check_security
+async def list_models(request):
+    """List available Qwen models"""
+    try:
+        client = get_client(request)
+        catalog = await client.get_model_catalog()
+        headers = catalog_headers(catalog)
+        if etag_matches(request.headers.get('If-None-Match'), catalog.etag):
+            return Response(status_code=304, headers=headers)
+        return Response(catalog.body, media_type='application/json', headers=headers)
+    except Exception as e:
+        return error_response(e)
+
+async def update_token(request):
+    """Update server token (for admin use); requires admin_key"""
+    data = await request.json()
+    admin_key = data.get('admin_key')
+    new_token = data.get('token')
+    
+    expected_key = os.getenv('ADMIN_KEY', 'change-me-in-production')
+    if admin_key != expected_key:
+        return JSONResponse({"error": "Invalid admin key"}, status_code=403)
+    
+    if not new_token:
+        return JSONResponse({"error": "Token required"}, status_code=400)
+    
+    save_token(new_token)
+    
+    # Clear pool so new token is used
+    client_pool.clear()
+    
+    return JSONResponse({
+        "success": True,
+        "message": "Token updated successfully",
+        "timestamp": int(time.time())
+    })
+
+async def get_token_info(request):
+    """Get stored token info (masked for security)"""
+    admin_key = request.query_params.get('admin_key')
+    expected_key = os.getenv('ADMIN_KEY', 'change-me-in-production')
+    
+    if admin_key != expected_key:
+        return JSONResponse({"error": "Invalid admin key"}, status_code=403)
+    
+    stored = load_stored_token()
+    if stored:
+        masked = stored[:20] + '...' + stored[-10:] if len(stored) > 30 else stored[:10] + '...'
+        return JSONResponse({"has_token": True, "token_preview": masked})
+    return JSONResponse({"has_token": False})
+
+async def pool_stats(request):
+    """Client pool and cache statistics (for admin use)"""
+    admin_key = request.query_params.get('admin_key')
+    expected_key = os.getenv('ADMIN_KEY', 'change-me-in-production')
+    
+    if admin_key != expected_key:
+        return JSONResponse({"error": "Invalid admin key"}, status_code=403)
+    
+    return JSONResponse({
+        "success": True,
+        "client_pool": dict(client_pool.stats(), max_connections=POOL_MAX_CONNECTIONS, pool_timeout=POOL_TIMEOUT),
+        "tip_cache": shared_tip_cache.stats(),
+        "model_cache": shared_model_cache.stats(),
+        "single_flight": shared_async_single_flight.stats(),
+        "token_refresher": token_refresher.stats(),
+        "upload_cache": shared_upload_cache.stats() if shared_upload_cache else None,
+        "response_cache": shared_response_cache.stats() if shared_response_cache else None,
+        "image_preprocessor": shared_image_preprocessor.stats() if shared_image_preprocessor else None,
+        "oss_pool": bucket_pool.stats()
+    })
+
+@check_security
+async def user_status(request):
+    """Get user status"""
+    try:
+        client = get_client(request)
+        return JSONResponse(await client.get_user_status())
+    except Exception as e:
+        return error_response(e)
+
+@check_security
+async def refresh_token(request):
+    """Refresh authentication token"""
+    try:
+        client = get_client(request)
+        data = await token_refresher.refresh(client)
+        save_token(client.auth_token)
+        return JSONResponse({
+            "success": True,
+            "token": client.auth_token,
+            "expires_at": data.get('expires_at'),
+            "message": "Token refreshed successfully"
+        })
+    except Exception as e:
+        return error_response(e)
+
+@check_security
+async def token_info(request):
+    """Get token information"""
+    token = get_token_from_request(request)
+    if not token:
+        return JSONResponse({"error": "No authorization token"}, status_code=401)
+    
+    return JSONResponse({
+        "token_length": len(token),
+        "token_preview": token[:10] + "..." + token[-10:] if len(token) > 20 else "***",
+        "has_token": True,
+        "source": "header" if request.headers.get('Authorization') else "environment"
+    })
+
+# ============================================================
+# Chat Management
+# ============================================================
+
+@check_security
+async def list_chats(request):
+    """List all chats"""
+    try:
+        page = int(request.query_params.get('page', 1))
+    except ValueError:
+        page = 1
+    
+    try:
+        client = get_client(request)
+        chats = await client.list_chats(page=page)
+        return JSONResponse({
+            "success": True,
+            "data": chats.get('data', []),
+            "total": len(chats.get('data', []))
+        })
+    except Exception as e:
+        return error_response(e)
+
+@check_security
+async def chat_detail(request):
+    """Get (GET) or delete (DELETE) a chat"""
+    chat_id = request.path_params['chat_id']
+    try:
+        client = get_client(request)
+        if request.method == 'DELETE':
+            success = await client.delete_chat(chat_id)
+            return JSONResponse({
+                "success": success,
+                "message": "Chat deleted successfully" if success else "Failed to delete chat"
+            })
+        
+        history = await client.get_chat_history(chat_id)
+        return JSONResponse({"success": True, "data": history})
+    except Exception as e:
+        return error_response(e)
+
+# ============================================================
+# Messaging
+# ============================================================
+
+@check_security
+async def send_message(request):
+    """Send a message to chat (same body as api_server.py /api/chat/send)"""
+    data = await request.json()
+    chat_id = data.get('chat_id')
+    
+    if not chat_id or not data.get('message'):
+        return JSONResponse({"error": "chat_id and message are required"}, status_code=400)
+    
+    try:
+        client = get_client(request)
+        
+        if wants_event_stream(request):
+            return stream_chat_response(client, chat_id, data)
+        
+        return JSONResponse({
+            "success": True,
+            "data": await complete_chat(client, chat_id, data)
+        })
+    except Exception as e:
+        return error_response(e)
+
+@check_security
+async def quick_chat(request):
+    """Quick chat - sends message to most recent chat"""
+    data = await request.json()
+    
+    if not data.get('message'):
+        return JSONResponse({"error": "message is required"}, status_code=400)
+    
+    try:
+        client = get_client(request)
+        
+        chat_id = await client.latest_chat_id()
+        if not chat_id:
+            return JSONResponse({"error": "No chats found. Please create a chat first."}, status_code=404)
+        
+        if wants_event_stream(request):
+            return stream_chat_response(client, chat_id, data)
+        
+        return JSONResponse({
+            "success": True,
+            "chat_id": chat_id,
+            "data": await complete_chat(client, chat_id, data)
+        })
+    except Exception as e:
+        return error_response(e)
+
+@check_security
+async def stream_chat(request):
+    """Send a message and stream the response as Server-Sent Events"""
+    data = await request.json()
+    chat_id = data.get('chat_id')
+    
+    if not data.get('message'):
+        return JSONResponse({"error": "message is required"}, status_code=400)
+    
+    try:
+        client = get_client(request)
+        
+        if not chat_id:
+            chat_id = await client.latest_chat_id()
+            if not chat_id:
+                return JSONResponse({"error": "No chats found. Please create a chat first."}, status_code=404)
+        
+        return stream_chat_response(client, chat_id, data)
+    except Exception as e:
+        return error_response(e)
+
+# ============================================================
+# File Upload
+# ============================================================
+
+class RequestBodyReader(io.RawIOBase):
+    """
+    Blocking file-like view of a request body for the OSS SDK's worker thread
+    
+    Each read() waits for the next body chunk on the event loop, so only the
+    chunk being handed over is held in memory.
+    """
+    
+    def __init__(self, request, loop):
+        self._chunks = request.stream().__aiter__()
+        self._loop = loop
+        self._buffer = b""
+        self._done = False
+    
+    def readable(self):
+        return True
+    
+    def read(self, size=-1):
+        if not self._buffer and not self._done:
+            try:
+                self._buffer = asyncio.run_coroutine_threadsafe(self._chunks.__anext__(), self._loop).result()
+            except StopAsyncIteration:
+                self._done = True
+        if size is None or size < 0:
+            data = self._buffer + b"".join(iter(lambda: self.read(1 << 16), b""))
+            self._buffer = b""
+            return data
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+class BodyStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse for handlers that keep reading the request body
+    
+    Starlette's StreamingResponse watches receive() for a disconnect while it
+    streams, which would swallow body chunks; here a disconnect surfaces as
+    an error from the body reader instead.
+    """
+    
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+
+@check_security
+async def get_sts_token(request):
+    """Get STS token for file upload"""
+    try:
+        data = await request.json()
+        filename = data.get('filename')
+        filesize = data.get('filesize')
+        filetype = data.get('filetype', 'image')
+        
+        if not filename or not filesize:
+            return JSONResponse({"error": "filename and filesize required"}, status_code=400)
+        
+        client = get_client(request)
+        sts_data = await client.get_sts_token(filename, filesize, filetype)
+        return JSONResponse({"success": True, "data": sts_data})
+    except Exception as e:
+        return error_response(e)
+
+@check_security
+async def upload_file(request):
+    """
+    Upload file (complete flow: get STS token + upload to OSS)
+    
+    Accepts multipart/form-data or a raw request body with Content-Length,
+    ?filename= / X-Filename and optionally X-Content-SHA256, like api_server.py.
+    Only the raw body is streamed: the form is parsed first, and Starlette
+    spools form files over 1MB to a temporary file.
+    """
+    try:
+        raw = request.headers.get('content-type', '').split(';')[0].strip() != 'multipart/form-data'
+        if raw:
+            filename = request.query_params.get('filename') or request.headers.get('x-filename')
+            filetype = request.query_params.get('filetype')
+            size = request.headers.get('content-length')
+            if size is None:
+                return JSONResponse({"error": "Content-Length required"}, status_code=411)
+            stream, size = RequestBodyReader(request, asyncio.get_running_loop()), int(size)
+            sha256 = request.headers.get('x-content-sha256')
+        else:
+            form = await request.form()
+            file = form.get('file')
+            if file is None or isinstance(file, str):
+                return JSONResponse({"error": "No file provided"}, status_code=400)
+            filename = file.filename
+            filetype = form.get('filetype')
+            stream, size, sha256 = file.file, None, None
+        
+        if not filename:
+            return JSONResponse({"error": "Empty filename"}, status_code=400)
+        
+        client = get_client(request)
+        
+        async def upload(progress_callback=None):
+            return await client.upload_file(
+                stream, filetype, progress_callback=progress_callback,
+                filename=filename, size=size, sha256=sha256
+            )
+        
+        if wants_event_stream(request):
+            return stream_upload_response(upload, filename, reads_body=raw)
+        
+        file_metadata = await upload()
+        return JSONResponse({"success": True, "data": file_metadata})
+    except Exception as e:
+        return error_response(e)
+
+@check_security
+async def send_message_with_files(request):
+    """Send message with file attachments (multipart/form-data)"""
+    try:
+        form = await request.form()
+        message = form.get('message')
+        chat_id = form.get('chat_id')
+        model = form.get('model', 'qwen3-max')
+        
+        if not message:
+            return JSONResponse({"error": "message required"}, status_code=400)
+        
+        files = [f for f in form.getlist('files') if not isinstance(f, str)]
+        if not files:
+            return JSONResponse({"error": "No files provided"}, status_code=400)
+        
+        client = get_client(request)
+        response = await client.chat_with_files(
+            message=message,
+            files=[(f.filename, f.file) for f in files if f.filename],
+            chat_id=chat_id,
+            model=model,
+            stream=False
+        )
+        
+        return JSONResponse({"success": True, "chat_id": chat_id, "data": response})
+    except UploadFailed as e:
+        filenames = [f.filename for f in files if f.filename]
+        return JSONResponse(upload_failed_response(e, filenames), status_code=502)
+    except Exception as e:
+        return error_response(e)
+
+# ============================================================
+# Statistics & Info
+# ============================================================
+
+@check_security
+async def get_stats(request):
+    """Get user statistics"""
+    try:
+        client = get_client(request)
+        chats, info = await asyncio.gather(client.list_chats(page=1), client.get_token_info())
+        
+        return JSONResponse({
+            "success": True,
+            "stats": {
+                "total_chats": len(chats.get('data', [])),
+                "user": {
+                    "name": info.get('name'),
+                    "email": info.get('email')
+                },
+                "token_expires_at": info.get('expires_at')
+            }
+        })
+    except Exception as e:
+        return error_response(e)
+
+# ============================================================
+# App
+# ============================================================
+
+async def not_found(request, exc):
+    return JSONResponse({"error": "Endpoint not found"}, status_code=404)
+
+async def internal_error(request, exc):
+    return JSONResponse({"error": "Internal server error"}, status_code=500)
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    token_refresher.start()
+    yield
+    await token_refresher.stop()
+    if _http_client is not None:
+        await _http_client.aclose()
+
+routes = [
+    Route('/health', health, methods=['GET']),
+    Route('/api/models', list_models, methods=['GET']),
+    Route('/api/admin/token', update_token, methods=['POST']),
+    Route('/api/admin/token', get_token_info, methods=['GET']),
+    Route('/api/admin/pool', pool_stats, methods=['GET']),
+    Route('/api/user/status', user_status, methods=['GET']),
+    Route('/api/token/refresh', refresh_token, methods=['POST']),
+    Route('/api/token/info', token_info, methods=['GET']),
+    Route('/api/chats', list_chats, methods=['GET']),
+    Route('/api/chats/{chat_id}', chat_detail, methods=['GET', 'DELETE']),
+    Route('/api/chat/send', send_message, methods=['POST']),
+    Route('/api/chat/quick', quick_chat, methods=['POST']),
+    Route('/api/chat/stream', stream_chat, methods=['POST']),
+    Route('/api/files/sts-token', get_sts_token, methods=['POST']),
+    Route('/api/files/upload', upload_file, methods=['POST']),
+    Route('/api/chat/send-with-files', send_message_with_files, methods=['POST']),
+    Route('/api/stats', get_stats, methods=['GET']),
+]
+
+app = Starlette(
+    routes=routes,
+    middleware=[
+        Middleware(
+            CORSMiddleware,
+            allow_origins=ALLOWED_ORIGINS,
+            allow_methods=["GET", "POST", "DELETE"],
+            allow_headers=["Content-Type", "Authorization", "X-Admin-Key"]
+        )
+    ],
+    exception_handlers={404: not_found, 500: internal_error},
+    lifespan=lifespan
+)
+
+# ============================================================
+# Main
+# ============================================================
+
+if __name__ == '__main__':
+    import sys
+    import uvicorn
+    
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 5001
+    
+    print("=" * 60)
+    print("  Qwen API Backend Server (ASGI)")
+    print("=" * 60)
+    print(f"\n✓ Listening on: http://localhost:{port}")
+    print("✓ Same endpoints as api_server.py, served by async handlers")
+    print("\nPress Ctrl+C to stop\n")
+    
+    uvicorn.run(app, host='0.0.0.0', port=port)
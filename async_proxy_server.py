@@ -0,0 +1,218 @@
+"""
+CORS Proxy Server for Qwen API (ASGI)
+Async version of proxy_server.py on Starlette + httpx
+
+Same /api/<path> routing and header forwarding as proxy_server.py, but an
+open SSE stream costs a coroutine and two sockets instead of a thread, so
+one process can hold thousands of idle chat streams. Upstream connections
+come from shared httpx pools (HTTP/2 when h2 is installed), and bodies
+are relayed in both directions without buffering: the next upstream chunk
+is only read once the browser has taken the previous one. With
+QWEN_PROXY_CACHE=memory, GETs matching a proxy_cache rule are answered from
+memory as in proxy_server.py.
+
+Run:
+    uvicorn async_proxy_server:app --host 0.0.0.0 --port 5001
+    python async_proxy_server.py [port]
+"""
+
+import asyncio
+import contextlib
+import itertools
+import os
+from http.cookiejar import DefaultCookiePolicy
+
+import httpx
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from async_qwen_client import create_http_client
+from proxy_cache import shared_proxy_cache as proxy_cache
+from proxy_server import (
+    PREFLIGHT_HEADERS,
+    PROXY_CHUNK_SIZE,
+    PROXY_POOL_SIZE,
+    QWEN_BASE_URL,
+    downstream_headers,
+    upstream_headers,
+)
+
+# httpx scans every connection of a pool on each request, which grows
+# quadratically with thousands of HTTP/1.1 streams; requests are spread
+# round-robin over this many pools instead
+PROXY_POOL_SHARDS = int(os.getenv("QWEN_PROXY_POOL_SHARDS", "16"))
+
+# Created in lifespan, on the server's event loop
+_http_clients = []
+_next_shard = itertools.count()
+# Running stale-while-revalidate refreshes (held so they are not collected)
+_refresh_tasks = set()
+
+def create_upstream_client(keepalive: int = PROXY_POOL_SIZE) -> httpx.AsyncClient:
+    """Pooled async client to the Qwen API, shared by proxied requests"""
+    client = create_http_client(max_connections=None, max_keepalive_connections=keepalive)
+    # Users share the client, so cookies set by upstream must not stick to it
+    client.cookies.jar.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return client
+
+def upstream_client() -> httpx.AsyncClient:
+    return _http_clients[next(_next_shard) % len(_http_clients)]
+
+async def store_response(upstream, key, rule, generation):
+    """Read a cacheable upstream answer whole and keep it; None if it has to be streamed instead"""
+    if not proxy_cache.cacheable(upstream.status_code, upstream.headers):
+        return None
+    try:
+        body = b"".join([chunk async for chunk in upstream.aiter_raw()])
+    finally:
+        await upstream.aclose()
+    proxy_cache.store(key, rule, upstream.status_code, downstream_headers(upstream.headers), body, generation)
+    return body
+
+async def refresh_cached(url, headers, key, rule):
+    """Re-fetch a stale cache entry in the background"""
+    try:
+        generation = proxy_cache.generation(key)
+        http = upstream_client()
+        upstream = await http.send(http.build_request('GET', url, headers=headers), stream=True)
+        if await store_response(upstream, key, rule, generation) is None:
+            await upstream.aclose()
+    except httpx.HTTPError as e:
+        print(f"[CACHE] Refresh of {url} failed: {e}")
+    finally:
+        proxy_cache.end_refresh(key)
+
+async def proxy(request):
+    """Proxy all requests to Qwen API"""
+    
+    # Get authorization header
+    if not request.headers.get('Authorization'):
+        return JSONResponse({"error": "No authorization header"}, status_code=401)
+    
+    # Carries the client's Accept-Encoding (or identity) in place of httpx's default
+    headers = upstream_headers(request.headers)
+    if request.headers.get('Content-Length'):
+        # Keeps the streamed body from being sent with chunked encoding
+        headers['Content-Length'] = request.headers['Content-Length']
+    
+    # Build URL
+    path = request.path_params['path']
+    query = request.url.query
+    url = f"{QWEN_BASE_URL}/{path}"
+    if query:
+        url += f"?{query}"
+    
+    print(f"[PROXY] {request.method} {url}")
+    
+    # Handle OPTIONS preflight
+    if request.method == 'OPTIONS':
+        return Response(headers=PREFLIGHT_HEADERS)
+    
+    # Cached GETs are answered here; changes drop what they may affect
+    auth_header = request.headers['Authorization']
+    cache_rule = None
+    if proxy_cache is not None:
+        if request.method == 'GET':
+            cache_rule = proxy_cache.rule(path)
+        else:
+            proxy_cache.invalidate(auth_header, path, query)
+    if cache_rule:
+        cache_key = proxy_cache.key(auth_header, path, query, headers['Accept-Encoding'])
+        entry, state = proxy_cache.lookup(cache_key)
+        if entry is not None:
+            if state == 'STALE' and proxy_cache.start_refresh(cache_key):
+                task = asyncio.create_task(refresh_cached(url, headers, cache_key, cache_rule))
+                _refresh_tasks.add(task)
+                task.add_done_callback(_refresh_tasks.discard)
+            return Response(entry.body, status_code=entry.status, headers=entry.response_headers(state))
+        generation = proxy_cache.generation(cache_key)
+    
+    # The request body is streamed upstream as the raw bytes received
+    has_body = request.method in ('POST', 'PUT') or 'Content-Length' in headers
+    http = upstream_client()
+    upstream_request = http.build_request(
+        request.method,
+        url,
+        headers=headers,
+        content=request.stream() if has_body else None
+    )
+    try:
+        upstream = await http.send(upstream_request, stream=True)
+    except httpx.HTTPError as e:
+        print(f"[ERROR] {e}")
+        return JSONResponse({"error": str(e)}, status_code=500)
+    
+    if cache_rule:
+        body = await store_response(upstream, cache_key, cache_rule, generation)
+        if body is not None:
+            response_headers = downstream_headers(upstream.headers)
+            response_headers['X-Cache'] = 'MISS'
+            return Response(body, status_code=upstream.status_code, headers=response_headers)
+    
+    async def finish():
+        await upstream.aclose()
+        # A completion changes the chat as it streams, not only when it starts
+        if proxy_cache is not None and request.method != 'GET':
+            proxy_cache.invalidate(auth_header, path, query)
+    
+    response_headers = downstream_headers(upstream.headers)
+    # Events go out as they arrive; other bodies are relayed in PROXY_CHUNK_SIZE pieces
+    event_stream = 'text/event-stream' in upstream.headers.get('Content-Type', '')
+    chunk_size = None if event_stream else PROXY_CHUNK_SIZE
+    
+    # Every body is passed on chunk by chunk, still content-encoded
+    return StreamingResponse(
+        upstream.aiter_raw(chunk_size),
+        status_code=upstream.status_code,
+        headers=response_headers,
+        background=BackgroundTask(finish)
+    )
+
+async def health(request):
+    """Health check endpoint"""
+    if proxy_cache is not None:
+        return JSONResponse({"status": "ok", "proxy": "qwen-api", "mode": "asgi", "cache": proxy_cache.stats()})
+    return JSONResponse({"status": "ok", "proxy": "qwen-api", "mode": "asgi"})
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    shards = max(1, PROXY_POOL_SHARDS)
+    _http_clients[:] = [create_upstream_client(max(1, PROXY_POOL_SIZE // shards)) for _ in range(shards)]
+    yield
+    for client in _http_clients:
+        await client.aclose()
+
+app = Starlette(
+    routes=[
+        Route('/api/{path:path}', proxy, methods=['GET', 'POST', 'DELETE', 'PUT', 'OPTIONS']),
+        Route('/health', health, methods=['GET']),
+    ],
+    middleware=[
+        Middleware(
+            CORSMiddleware,
+            allow_origins=["*"],
+            allow_methods=["GET", "POST", "DELETE", "PUT", "OPTIONS"],
+            allow_headers=["Authorization", "Content-Type", "Accept", "source", "x-accel-buffering"]
+        )
+    ],
+    lifespan=lifespan
+)
+
+if __name__ == '__main__':
+    import sys
+    import uvicorn
+    
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 5001
+    
+    print("=" * 60)
+    print("  Qwen API CORS Proxy Server (ASGI)")
+    print("=" * 60)
+    print(f"\n✓ Listening on: http://localhost:{port}")
+    print(f"✓ Proxying to: {QWEN_BASE_URL} ({PROXY_POOL_SIZE} keep-alive connections in {PROXY_POOL_SHARDS} pools)")
+    print("\nPress Ctrl+C to stop\n")
+    
+    uvicorn.run(app, host='0.0.0.0', port=port, log_level="warning")
@@ -0,0 +1,592 @@
+"""Async Qwen AI Chat Client
+asyncio version of qwen_client.QwenClient on a pooled httpx transport
+"""
+
+import asyncio
+import contextlib
+import os
+import time
+import uuid
+from typing import Callable, Optional, Dict, List, AsyncIterator
+
+import httpx
+
+from oss_upload import MULTIPART_THRESHOLD, file_identity, upload_sessions
+from qwen_cache import (
+    ConversationTipCache,
+    ModelCatalog,
+    ModelCatalogCache,
+    SingleFlight,
+    shared_async_single_flight,
+    shared_model_cache,
+    shared_tip_cache,
+)
+from qwen_client import (
+    CompletionRejected,
+    StreamDelta,
+    StreamRecorder,
+    STREAM_HEADERS,
+    STS_PREFETCH,
+    UPLOAD_CONCURRENCY,
+    CompletionStreamParser,
+    UploadFailed,
+    build_message_payload,
+    build_file_metadata,
+    detect_filetype,
+    put_object_to_oss,
+    replay_stream,
+    upload_item,
+    upload_source,
+    _is_parent_conflict,
+)
+from image_prep import ImagePreprocessor, shared_image_preprocessor
+from response_cache import ResponseCache, response_key, shared_response_cache
+from sse_parser import TextAccumulator, aiter_events
+from upload_cache import HashingReader, UploadCache, token_scope, shared_upload_cache
+
+
+def _http2_available() -> bool:
+    """HTTP/2 needs the optional h2 package (pip install 'httpx[http2]')"""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def create_http_client(
+    http2: bool = True,
+    max_connections: Optional[int] = 100,
+    max_keepalive_connections: Optional[int] = 20,
+    connect_timeout: float = 10.0,
+    pool_timeout: Optional[float] = None
+) -> httpx.AsyncClient:
+    """
+    Create a pooled async HTTP transport suitable for sharing between clients
+    
+    With HTTP/2 every chat stream to chat.qwen.ai is multiplexed over a few
+    connections, so max_connections bounds sockets rather than streams.
+    Streams have no read timeout because answers can pause while thinking.
+    
+    Args:
+        http2: Negotiate HTTP/2 (falls back to HTTP/1.1 if h2 is missing)
+        max_connections: Total connection cap for the pool (None = unlimited)
+        max_keepalive_connections: Idle connections kept open for reuse
+        connect_timeout: Seconds allowed for TCP/TLS connection setup
+        pool_timeout: Seconds to wait for a free connection before httpx.PoolTimeout (None = forever)
+    """
+    return httpx.AsyncClient(
+        http2=http2 and _http2_available(),
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections
+        ),
+        timeout=httpx.Timeout(None, connect=connect_timeout, pool=pool_timeout)
+    )
+
+
+class AsyncQwenClient:
+    """asyncio client for interacting with Qwen AI Chat API"""
+    
+    BASE_URL = os.getenv("QWEN_API_URL", "https://chat.qwen.ai/api")
+    
+    def __init__(
+        self,
+        auth_token: str,
+        auto_refresh: bool = True,
+        base_url: Optional[str] = None,
+        http_client: Optional[httpx.AsyncClient] = None,
+        http2: bool = True,
+        max_connections: Optional[int] = 100,
+        tip_cache: Optional[ConversationTipCache] = None,
+        model_cache: Optional[ModelCatalogCache] = None,
+        single_flight: Optional[SingleFlight] = None,
+        upload_cache: Optional[UploadCache] = None,
+        image_preprocessor: Optional[ImagePreprocessor] = None,
+        response_cache: Optional[ResponseCache] = None
+    ):
+        """
+        Initialize async Qwen client
+        
+        Args:
+            auth_token: JWT authentication token from Qwen
+            auto_refresh: Automatically refresh token when needed
+            base_url: Custom base URL (overrides environment variable)
+            http_client: Shared httpx.AsyncClient from create_http_client().
+                Lets many tokens share one connection pool; it is not closed
+                by aclose(). A private pool is created when omitted.
+            http2: Use HTTP/2 for the private pool
+            max_connections: Connection cap for the private pool
+            tip_cache: Cache of each chat's latest message ID, used as parent_id
+                (defaults to the process-wide qwen_cache.shared_tip_cache)
+            model_cache: Cache of the model catalog
+                (defaults to the process-wide qwen_cache.shared_model_cache)
+            single_flight: AsyncSingleFlight collapsing identical concurrent GETs
+                (defaults to qwen_cache.shared_async_single_flight)
+            upload_cache: Content-hash index of uploaded files; False disables it
+                (defaults to upload_cache.shared_upload_cache)
+            image_preprocessor: Downscales images before upload; False disables it
+                (defaults to image_prep.shared_image_preprocessor)
+            response_cache: Replays answers to repeated prompts; False disables it
+                (defaults to response_cache.shared_response_cache)
+        """
+        self.auth_token = auth_token
+        self.auto_refresh = auto_refresh
+        self.tip_cache = tip_cache or shared_tip_cache
+        self.model_cache = model_cache or shared_model_cache
+        self.single_flight = single_flight or shared_async_single_flight
+        self.upload_cache = shared_upload_cache if upload_cache is None else upload_cache
+        self.image_preprocessor = (
+            shared_image_preprocessor if image_preprocessor is None else image_preprocessor
+        )
+        self.response_cache = shared_response_cache if response_cache is None else response_cache
+        self._refresh_tasks = set()
+        
+        if base_url:
+            self.BASE_URL = base_url
+        
+        self._owns_http = http_client is None
+        self.http = http_client or create_http_client(http2=http2, max_connections=max_connections)
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc):
+        await self.aclose()
+    
+    async def aclose(self):
+        """Close the connection pool if this client created it"""
+        if self._owns_http:
+            await self.http.aclose()
+    
+    @property
+    def headers(self) -> Dict:
+        """Per-request headers (the pool itself is token-agnostic)"""
+        return {
+            "Authorization": f"Bearer {self.auth_token}",
+            "Content-Type": "application/json",
+            "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36"
+        }
+    
+    async def _request(self, method: str, path: str, **kwargs) -> Dict:
+        """
+        Send a request and parse the JSON body ({} when there is none, e.g. a 204)
+        
+        Identical GETs (same token and URL) running at the same time share
+        one upstream request and its parsed result, so treat it as read-only.
+        """
+        url = f"{self.BASE_URL}{path}"
+        
+        async def fetch():
+            response = await self.http.request(method, url, headers=self.headers, **kwargs)
+            response.raise_for_status()
+            return response.json() if response.content else {}
+        
+        if method == "GET" and not kwargs:
+            return await self.single_flight.do((self.auth_token, method, url), fetch)
+        return await fetch()
+    
+    def set_token(self, token: str):
+        """Switch to a new token; requests already in flight keep the old one"""
+        self.auth_token = token
+    
+    async def get_user_settings(self) -> Dict:
+        """Get user settings"""
+        return await self._request("GET", "/v2/users/user/settings")
+    
+    async def refresh_token(self) -> Dict:
+        """
+        Refresh authentication token
+        
+        Returns:
+            Dict with new token info including expires_at
+        """
+        data = await self._request("GET", "/v1/auths/")
+        if 'token' in data:
+            self.set_token(data['token'])
+        return data
+    
+    async def get_token_info(self) -> Dict:
+        """Get current user and token information"""
+        return await self._request("GET", "/v1/auths/")
+    
+    async def get_user_status(self) -> Dict:
+        """Get user status"""
+        return await self._request("GET", "/v2/users/status")
+    
+    async def list_models(self) -> Dict:
+        """List available models with their capabilities"""
+        return (await self.get_model_catalog()).data
+    
+    async def get_model_catalog(self) -> ModelCatalog:
+        """
+        Model list from model_cache, revalidated with upstream when due
+        
+        Near expiry the cached copy is returned and revalidated in a
+        background task; once expired the caller waits for revalidation.
+        """
+        cache, key = self.model_cache, self.BASE_URL
+        catalog, action = cache.lookup(key)
+        if action == "refresh":
+            task = asyncio.create_task(self._background_refresh_models())
+            self._refresh_tasks.add(task)
+            task.add_done_callback(self._refresh_tasks.discard)
+        if action != "fetch":
+            return catalog
+        # The catalog is shared by every token, so concurrent misses share one request
+        return await self.single_flight.do(("models", key), self._refresh_models)
+        
+    async def _background_refresh_models(self):
+        try:
+            await self._refresh_models()
+        finally:
+            self.model_cache.end_refresh(self.BASE_URL)
+    
+    async def _refresh_models(self) -> ModelCatalog:
+        cache, key = self.model_cache, self.BASE_URL
+        try:
+            response = await self.http.get(
+                f"{self.BASE_URL}/models",
+                headers={**self.headers, **cache.request_headers(key)}
+            )
+            if response.status_code != 304:
+                response.raise_for_status()
+            return cache.store(key, response.status_code, response.content, response.headers)
+        except Exception:
+            catalog = cache.failed(key)
+            if catalog is None:
+                raise
+            return catalog
+    
+    async def list_chats(self, page: int = 1) -> Dict:
+        """List all chat conversations"""
+        return await self._request("GET", f"/v2/chats/?page={page}")
+    
+    async def latest_chat_id(self) -> Optional[str]:
+        """Return the ID of the most recent chat, or None if there are none"""
+        chats = await self.list_chats(page=1)
+        if chats.get("success") and chats.get("data") and len(chats["data"]) > 0:
+            return chats["data"][0]["id"]
+        return None
+    
+    async def create_chat(self, title: str = "New Chat", model: str = "qwen3-max") -> Dict:
+        """Create a new chat conversation; returns chat info including 'id'"""
+        result = await self._request("POST", "/v2/chats/new", json={
+            "title": title,
+            "models": [model],
+            "chat_mode": "normal",
+            "chat_type": "t2t",
+            "timestamp": int(time.time() * 1000)  # milliseconds
+        })
+        if result.get("success") and result.get("data"):
+            return result["data"]
+        return result
+    
+    async def get_chat_history(self, chat_id: str) -> Dict:
+        """Get chat conversation history"""
+        return await self._request("GET", f"/v2/chats/{chat_id}")
+    
+    async def delete_chat(self, chat_id: str) -> bool:
+        """Delete a chat conversation"""
+        await self._request("DELETE", f"/v2/chats/{chat_id}")
+        return True
+    
+    async def _record_answer(self, deltas: AsyncIterator[StreamDelta], key: str) -> AsyncIterator[StreamDelta]:
+        """Pass deltas through and cache the answer once the stream has finished"""
+        recorder = StreamRecorder()
+        async for delta in deltas:
+            recorder.add(delta)
+            yield delta
+        answer = recorder.answer()
+        if answer is not None:
+            self.response_cache.put(key, answer)
+    
+    async def _fetch_current_id(self, chat_id: str) -> Optional[str]:
+        """Read the chat's latest message ID from its history"""
+        try:
+            chat_data = await self.get_chat_history(chat_id)
+            if chat_data.get("success") and chat_data.get("data"):
+                return chat_data["data"].get("currentId")
+        except Exception:
+            # For new chats, parent_id should be null
+            pass
+        return None
+    
+    async def stream_message(
+        self,
+        chat_id: str,
+        message,
+        model: str = "qwen3-max",
+        parent_id: Optional[str] = None,
+        system_prompt: Optional[str] = None,
+        thinking_enabled: bool = False,
+        search_enabled: bool = False
+    ) -> AsyncIterator[StreamDelta]:
+        """
+        Send a message and yield StreamDelta objects as they are parsed
+        
+        Same arguments, deltas and parent_id caching as QwenClient.stream_message():
+            async for delta in client.stream_message(chat_id, "Hi"):
+                ...
+        """
+        use_cache = bool(self.response_cache) and not search_enabled
+        if use_cache:
+            key = response_key(
+                token_scope(self.auth_token), model, system_prompt, message, thinking_enabled, search_enabled
+            )
+            answer = self.response_cache.get(key)
+            if answer is not None:
+                for delta in replay_stream(answer):
+                    yield delta
+                return
+        
+        from_cache = False
+        if parent_id is None:
+            parent_id = self.tip_cache.get(chat_id)
+            from_cache = parent_id is not None
+            if not from_cache:
+                parent_id = await self._fetch_current_id(chat_id)
+        
+        def stream(parent):
+            payload = build_message_payload(
+                chat_id, message, model, parent, True,
+                system_prompt, thinking_enabled, search_enabled
+            )
+            deltas = self._stream_completion(chat_id, payload)
+            if use_cache:
+                deltas = self._record_answer(deltas, key)
+            return deltas
+        
+        deltas = stream(parent_id)
+        if from_cache:
+            try:
+                first = await deltas.__anext__()
+            except (CompletionRejected, httpx.HTTPStatusError) as e:
+                if not _is_parent_conflict(e):
+                    raise
+                # Stale tip (e.g. the chat moved on elsewhere): retry from history
+                self.tip_cache.invalidate(chat_id, conflict=True)
+                deltas = stream(await self._fetch_current_id(chat_id))
+            else:
+                yield first
+        
+        async for delta in deltas:
+            yield delta
+    
+    async def _stream_completion(self, chat_id: str, payload: Dict) -> AsyncIterator[StreamDelta]:
+        """Post a streaming completion and yield StreamDelta objects"""
+        parser = CompletionStreamParser()
+        tip = None
+        async with self.http.stream(
+            "POST",
+            f"{self.BASE_URL}/v2/chat/completions?chat_id={chat_id}",
+            json=payload,
+            headers={**self.headers, **STREAM_HEADERS}
+        ) as response:
+            response.raise_for_status()
+            
+            if 'application/json' in response.headers.get('Content-Type', ''):
+                body = (await response.aread()).decode('utf-8', errors='replace')
+                raise CompletionRejected(f"Completion rejected: {body[:500]}")
+            
+            async for event in aiter_events(response.aiter_bytes()):
+                if event.data == "[DONE]":
+                    break
+                deltas = parser.feed(event.data)
+                if parser.response_id != tip:
+                    # The answer is the new tip of the conversation as soon as
+                    # upstream creates it, even if the stream is not read to the end
+                    tip = parser.response_id
+                    self.tip_cache.update(chat_id, tip)
+                for delta in deltas:
+                    yield delta
+        
+        yield parser.done()
+    
+    async def send_message(
+        self,
+        chat_id: str,
+        message,
+        model: str = "qwen3-max",
+        parent_id: Optional[str] = None,
+        stream: bool = True,
+        system_prompt: Optional[str] = None,
+        thinking_enabled: bool = False,
+        search_enabled: bool = False
+    ) -> Dict:
+        """
+        Send a message to a chat conversation
+        
+        With stream=True the deltas are collected into {"content", "thinking"},
+        like QwenClient.send_message().
+        """
+        if stream:
+            content = TextAccumulator()
+            thinking = TextAccumulator()
+            async for delta in self.stream_message(
+                chat_id, message, model, parent_id,
+                system_prompt, thinking_enabled, search_enabled
+            ):
+                if delta.type == "content":
+                    content.append(delta.content)
+                elif delta.type == "reasoning":
+                    thinking.append(delta.content)
+            
+            result = {"content": content.getvalue()}
+            if thinking:
+                result["thinking"] = thinking.getvalue()
+            return result
+        
+        if parent_id is None:
+            parent_id = self.tip_cache.get(chat_id) or await self._fetch_current_id(chat_id)
+        payload = build_message_payload(
+            chat_id, message, model, parent_id, False,
+            system_prompt, thinking_enabled, search_enabled
+        )
+        result = await self._request("POST", f"/v2/chat/completions?chat_id={chat_id}", json=payload)
+        
+        # The new message ID is not parsed from this format; re-read it next time
+        self.tip_cache.invalidate(chat_id)
+        return result
+    
+    async def get_sts_token(self, filename: str, filesize: int, filetype: str = "image") -> Dict:
+        """Get STS token for uploading file to OSS"""
+        return await self._request("POST", "/v2/files/getstsToken", json={
+            "filename": filename,
+            "filesize": filesize,
+            "filetype": filetype
+        })
+    
+    async def upload_file(self, file, filetype: str = None,
+                          progress_callback: Optional[Callable[[int, int], None]] = None,
+                          filename: Optional[str] = None, size: Optional[int] = None,
+                          sha256: Optional[str] = None) -> Dict:
+        """
+        Complete file upload flow: get STS token, upload to OSS, return metadata
+        
+        The OSS SDK is blocking, so the object upload runs in a worker thread
+        (progress_callback is called from that thread, and so are the read()
+        calls on a file-like object). file, filename, size and sha256 are as in
+        QwenClient.upload_file; large files resume an interrupted upload,
+        content uploaded before is returned from upload_cache and images
+        are downscaled in a worker thread when image_preprocessor is set.
+        """
+        return await self._upload_file(file, filetype, progress_callback, filename, size, sha256)
+    
+    async def _upload_file(self, file, filetype=None, progress_callback=None, filename=None,
+                           size=None, sha256=None, upload_slot=None) -> Dict:
+        """upload_file(); upload_slot, if given, is held only while the object is sent to OSS"""
+        source, filename, filesize = upload_source(file, filename, size)
+        is_path = isinstance(source, (str, os.PathLike))
+        
+        scope = digest = hasher = None
+        if self.upload_cache:
+            scope = token_scope(self.auth_token)
+            # Hashing reads the whole file, so keep it off the event loop
+            digest = await asyncio.to_thread(self.upload_cache.source_digest, source)
+            cached = self.upload_cache.get(scope, digest or sha256) if digest or sha256 else None
+            if cached:
+                # Keep the extension of what was uploaded (it may have been re-encoded)
+                return dict(cached, name=os.path.splitext(filename)[0] + os.path.splitext(cached['name'])[1])
+            if digest is None:
+                source = hasher = HashingReader(source)
+        
+        detected_type, mime_type = detect_filetype(filename)
+        filetype = filetype or detected_type
+        
+        # Downscale photos before upload; cached under the original's digest above
+        if self.image_preprocessor and detected_type == "image":
+            source, filename, filesize, mime_type = await asyncio.to_thread(
+                self.image_preprocessor.prepare, source, filename, filesize, mime_type
+            )
+            is_path = isinstance(source, (str, os.PathLike))
+        
+        identity = file_identity(source) if is_path and filesize >= MULTIPART_THRESHOLD else None
+        sts_data = upload_sessions.load(identity) if identity else None
+        
+        if sts_data is None:
+            sts_response = await self.get_sts_token(filename, filesize, filetype)
+            if sts_response.get('success'):
+                sts_data = sts_response['data']
+            else:
+                raise Exception(f"Failed to get STS token: {sts_response}")
+            
+            if identity:
+                upload_sessions.save(identity, sts_data)
+        
+        async with upload_slot or contextlib.nullcontext():
+            file_url = await asyncio.to_thread(put_object_to_oss, source, sts_data, progress_callback, filesize)
+        if identity:
+            upload_sessions.discard(identity)
+        
+        metadata = build_file_metadata(sts_data, file_url, filename, filesize, filetype, mime_type)
+        if scope:
+            self.upload_cache.put(scope, digest or hasher.hexdigest(), metadata)
+        return metadata
+    
+    async def upload_files(self, files: List, max_concurrency: Optional[int] = None,
+                           prefetch: Optional[int] = None) -> List[Dict]:
+        """
+        Upload several files concurrently, at most max_concurrency at a time
+        
+        files holds paths or (filename, data[, size]) tuples, and up to
+        prefetch further files fetch their STS token while earlier files
+        upload, as in QwenClient.upload_files.
+        
+        Returns:
+            File metadata for each file, in input order
+        
+        Raises:
+            UploadFailed: if any file failed; lists every failure
+        """
+        workers = max(1, max_concurrency or UPLOAD_CONCURRENCY)
+        prefetch = STS_PREFETCH if prefetch is None else max(0, prefetch)
+        slots = asyncio.Semaphore(workers)
+        # Files past the upload slots may get as far as their STS token
+        ahead = asyncio.Semaphore(workers + prefetch)
+        
+        async def upload(item):
+            async with ahead:
+                return await self._upload_file(upload_slot=slots, **item)
+        
+        items = [upload_item(item) for item in files]
+        results = await asyncio.gather(*(upload(item) for item in items), return_exceptions=True)
+        
+        uploaded, failures = [], []
+        for index, (item, result) in enumerate(zip(items, results)):
+            if isinstance(result, Exception):
+                name = item.get("filename") or item["file"]
+                failures.append({"index": index, "file": name, "error": str(result)})
+            else:
+                uploaded.append(result)
+        
+        if failures:
+            raise UploadFailed(failures, uploaded)
+        return uploaded
+    
+    async def chat_with_files(
+        self,
+        message: str,
+        files: List = None,
+        chat_id: Optional[str] = None,
+        model: str = "qwen3-max",
+        stream: bool = True,
+        thinking_enabled: bool = False,
+        max_concurrency: Optional[int] = None
+    ):
+        """Upload files concurrently and send a message that attaches them"""
+        file_metadata = []
+        if files:
+            file_metadata = await self.upload_files(files, max_concurrency)
+        
+        # Create or use existing chat
+        if not chat_id:
+            chat_id = str(uuid.uuid4())
+        
+        return await self.send_message(
+            chat_id=chat_id,
+            message={"role": "user", "content": message, "files": file_metadata},
+            model=model,
+            stream=stream,
+            thinking_enabled=thinking_enabled
+        )
@@ -0,0 +1,159 @@
+"""
+Benchmark: concurrent chat streams, AsyncQwenClient vs threaded QwenClient
+
+Starts a local fake Qwen SSE server, then opens N completion streams at once.
+Every stream sends `--events` deltas spaced `--interval` seconds apart, so a
+stream stays open for roughly events * interval seconds, like a real answer.
+
+Usage:
+    python bench_async_streams.py
+    python bench_async_streams.py --levels 100,1000,3000 --events 20 --interval 0.1
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from async_qwen_client import AsyncQwenClient, create_http_client
+from qwen_client import QwenClient
+
+
+def _chunk(data: bytes) -> bytes:
+    return b"%x\r\n%s\r\n" % (len(data), data)
+
+
+async def _handle(reader, writer, events, interval):
+    """Minimal HTTP/1.1 keep-alive server answering every POST with an SSE stream"""
+    try:
+        while True:
+            head = await reader.readuntil(b"\r\n\r\n")
+            length = 0
+            for line in head.split(b"\r\n"):
+                if line.lower().startswith(b"content-length:"):
+                    length = int(line.split(b":")[1])
+            if length:
+                await reader.readexactly(length)
+            
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/event-stream\r\n"
+                b"Transfer-Encoding: chunked\r\n\r\n"
+            )
+            created = {"response.created": {"response_id": "bench"}}
+            writer.write(_chunk(b"data: " + json.dumps(created).encode() + b"\n\n"))
+            for i in range(events):
+                await asyncio.sleep(interval)
+                delta = {"choices": [{"delta": {"content": f"tok{i} ", "phase": "answer"}}]}
+                writer.write(_chunk(b"data: " + json.dumps(delta).encode() + b"\n\n"))
+                await writer.drain()
+            writer.write(_chunk(b"data: [DONE]\n\n") + b"0\r\n\r\n")
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+def start_fake_server(events, interval):
+    """Run the fake server on its own event loop thread; returns base URL"""
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+    holder = {}
+    
+    async def serve():
+        server = await asyncio.start_server(
+            lambda r, w: _handle(r, w, events, interval), "127.0.0.1", 0, backlog=4096
+        )
+        holder["port"] = server.sockets[0].getsockname()[1]
+        ready.set()
+        await server.serve_forever()
+    
+    threading.Thread(target=lambda: loop.run_until_complete(serve()), daemon=True).start()
+    ready.wait()
+    return f"http://127.0.0.1:{holder['port']}/api"
+
+
+async def run_async(base_url, concurrency):
+    http = create_http_client(http2=False, max_connections=None, max_keepalive_connections=concurrency)
+    client = AsyncQwenClient("bench-token", base_url=base_url, http_client=http)
+    first_delta = []
+    
+    async def one():
+        start = time.perf_counter()
+        got_first = False
+        async for delta in client.stream_message("bench-chat", "hi", parent_id="bench"):
+            if delta.type == "content" and not got_first:
+                first_delta.append(time.perf_counter() - start)
+                got_first = True
+    
+    start = time.perf_counter()
+    results = await asyncio.gather(*(one() for _ in range(concurrency)), return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    await http.aclose()
+    errors = sum(1 for r in results if isinstance(r, Exception))
+    return elapsed, errors, first_delta
+
+
+def run_threads(base_url, concurrency):
+    clients = [QwenClient("bench-token", base_url=base_url) for _ in range(concurrency)]
+    
+    def one(client):
+        for _ in client.stream_message("bench-chat", "hi", parent_id="bench"):
+            pass
+    
+    start = time.perf_counter()
+    errors = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(one, c) for c in clients]:
+            try:
+                future.result()
+            except Exception:
+                errors += 1
+    return time.perf_counter() - start, errors
+
+
+def _peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--levels", default="100,500,1000,2000", help="comma separated stream counts")
+    parser.add_argument("--events", type=int, default=20, help="deltas per stream")
+    parser.add_argument("--interval", type=float, default=0.1, help="seconds between deltas")
+    parser.add_argument("--threads-max", type=int, default=500, help="skip the threaded baseline above this level")
+    args = parser.parse_args()
+    
+    # Every stream needs a socket on both ends of the loopback connection
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    
+    base_url = start_fake_server(args.events, args.interval)
+    ideal = args.events * args.interval
+    
+    print("=" * 72)
+    print("  Concurrent stream capacity (fake SSE server on loopback)")
+    print("=" * 72)
+    print(f"  {args.events} deltas x {args.interval}s per stream -> ideal stream time {ideal:.2f}s")
+    print(f"  open file limit: {hard}, pid {os.getpid()}\n")
+    print(f"{'mode':<8}{'streams':>8}{'wall s':>9}{'streams/s':>11}{'TTFD p50':>10}{'TTFD max':>10}{'errors':>8}{'RSS MB':>9}")
+    
+    for level in [int(x) for x in args.levels.split(",")]:
+        elapsed, errors, ttfd = asyncio.run(run_async(base_url, level))
+        ttfd.sort()
+        p50 = ttfd[len(ttfd) // 2] if ttfd else float("nan")
+        worst = ttfd[-1] if ttfd else float("nan")
+        print(f"{'async':<8}{level:>8}{elapsed:>9.2f}{level / elapsed:>11.0f}{p50:>10.3f}{worst:>10.3f}{errors:>8}{_peak_rss_mb():>9.0f}")
+        
+        if level <= args.threads_max:
+            elapsed, errors = run_threads(base_url, level)
+            print(f"{'threads':<8}{level:>8}{elapsed:>9.2f}{level / elapsed:>11.0f}{'-':>10}{'-':>10}{errors:>8}{_peak_rss_mb():>9.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Benchmark: request size over a long DashScope chat, full history vs Conversation
+
+Plays a tutoring session of --turns questions against a stub client (no
+network) and records every request body that would be posted:
+  
+  full          the caller keeps the whole history and passes it to chat()
+  conversation  QwenOfficialClient.conversation() with --budget tokens
+  summarized    the same, with old turns folded into a (stub) summary
+
+For a few turns along the way the table shows the request size, the
+estimated prompt tokens (what upstream has to read before answering, so
+prefill latency follows it) and the time spent building and serializing
+the payload. estimate_tokens() itself is checked against the character
+count of the whole session.
+
+Usage:
+    python bench_official_history.py
+    python bench_official_history.py --turns 1000 --budget 4000
+"""
+
+import argparse
+import json
+import time
+
+from qwen_official_client import Conversation, QwenOfficialClient, estimate_tokens
+
+QUESTION = "Câu {i}: phân biệt ～ようにする và ～ことにする, cho ví dụ N3 nhé?"
+ANSWER = ("「～ようにする」は習慣や努力を表します。Ví dụ: 毎日日本語を勉強するようにしています。"
+          "Còn「～ことにする」là quyết định: 来年日本へ行くことにしました。 ") * 4
+
+
+class StubClient(QwenOfficialClient):
+    """Returns a fixed answer and records the serialized payloads"""
+    
+    def __init__(self):
+        super().__init__(api_key="bench")
+        self.sizes = []
+        self.build_time = 0.0
+    
+    def _chat_payload(self, messages, model, temperature, top_p, max_tokens):
+        start = time.perf_counter()
+        payload = super()._chat_payload(messages, model, temperature, top_p, max_tokens)
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.build_time += time.perf_counter() - start
+        self.sizes.append((len(body), sum(estimate_tokens(m["content"]) + 4 for m in messages)))
+        return payload
+    
+    def _chat_sync(self, payload):
+        return ANSWER
+
+
+def stub_summarizer(summary, dropped):
+    return f"Learner practises N3 grammar; {len(dropped)} more messages covered ようにする/ことにする."
+
+
+def run(mode: str, turns: int, budget: int):
+    client = StubClient()
+    if mode == "full":
+        history = []
+        for i in range(turns):
+            question = QUESTION.format(i=i)
+            answer = client.chat(question, history=history, stream=False)
+            history += [{"role": "user", "content": question}, {"role": "assistant", "content": answer}]
+    else:
+        convo = Conversation(client, system_prompt="Bạn là giáo viên JLPT.", max_history_tokens=budget,
+                             summarizer=stub_summarizer if mode == "summarized" else None)
+        for i in range(turns):
+            convo.send(QUESTION.format(i=i), stream=False)
+    return client
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=500, help="questions in the session")
+    parser.add_argument("--budget", type=int, default=6000, help="Conversation max_history_tokens")
+    args = parser.parse_args()
+    
+    checkpoints = sorted({t for t in (10, 50, 100, 250, 500, 1000, args.turns) if t <= args.turns})
+    
+    print("=" * 78)
+    print(f"  DashScope chat history, {args.turns} turns, budget {args.budget} tokens")
+    print("=" * 78)
+    print(f"{'mode':<14}{'turn':>7}{'request KB':>12}{'est tokens':>12}{'total MB sent':>15}{'build ms total':>16}")
+    
+    for mode in ("full", "conversation", "summarized"):
+        client = run(mode, args.turns, args.budget)
+        for turn in checkpoints:
+            size, tokens = client.sizes[turn - 1]
+            sent = sum(s for s, _ in client.sizes[:turn])
+            print(f"{mode:<14}{turn:>7}{size / 1024:>12.1f}{tokens:>12}{sent / 1e6:>15.2f}", end="")
+            print(f"{client.build_time * 1000:>16.0f}" if turn == checkpoints[-1] else "")
+    
+    text = (QUESTION + ANSWER) * 10
+    print(f"\n  estimate_tokens: {estimate_tokens(text)} tokens for {len(text)} characters "
+          f"({len(text.encode('utf-8'))} UTF-8 bytes)")
+
+
+if __name__ == "__main__":
+    main()
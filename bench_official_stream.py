@@ -0,0 +1,125 @@
+"""
+Benchmark: DashScope stream replay, old diffing loop vs stream_deltas()
+
+Replays generated DashScope streams of growing length through the loop
+QwenOfficialClient._chat_stream used before (Response.iter_lines over the
+replayed body, json.loads, the `len(content) > len(full_response)` diff) and through the current path
+(sse_parser.iter_events + stream_deltas + TextAccumulator), in both modes:
+  
+  incremental  incremental_output=true, every event carries only new text
+  cumulative   every event repeats the whole answer so far
+
+Each tokens value doubles the previous one. Linear scaling shows as a flat
+"ns/byte" column: the time per byte of stream received stays the same. In
+cumulative mode the stream itself grows quadratically with the answer (the
+server resends it every event), so compare ns/byte there, not us/token.
+"correct" tells whether the loop rebuilt the answer the server sent.
+
+Usage:
+    python bench_official_stream.py
+    python bench_official_stream.py --tokens 2000,4000,8000,16000 --chunk-size 1024
+"""
+
+import argparse
+import io
+import json
+import time
+
+import requests
+
+from qwen_official_client import stream_deltas
+from sse_parser import TextAccumulator, iter_events, json_loads
+
+WORDS = [" 日本語", " の", " test", " Xin", " chào", ",", ".", "\n", " kanji", " N3"]
+
+
+def record_stream(tokens: int, incremental: bool):
+    """(SSE bytes, full answer) of a DashScope stream with one token per event"""
+    events = []
+    answer = []
+    for i in range(tokens):
+        answer.append(WORDS[i % len(WORDS)])
+        content = answer[-1] if incremental else "".join(answer)
+        data = {
+            "output": {"choices": [{"message": {"content": content, "role": "assistant"},
+                                    "finish_reason": "null"}]},
+            "usage": {"input_tokens": 12, "output_tokens": i + 1},
+            "request_id": "bench"
+        }
+        events.append(f"id:{i + 1}\nevent:result\n:HTTP_STATUS/200\n"
+                      f"data:{json.dumps(data, ensure_ascii=False)}\n\n")
+    return "".join(events).encode("utf-8"), "".join(answer)
+
+
+def replayed_response(chunks) -> requests.Response:
+    response = requests.Response()
+    response.status_code = 200
+    response.raw = io.BytesIO(b"".join(chunks))
+    return response
+
+
+def old_loop(chunks, incremental) -> str:
+    """The previous _chat_stream body, without printing"""
+    response = replayed_response(chunks)
+    full_response = ""
+    for line in response.iter_lines():
+        if line:
+            line = line.decode('utf-8')
+            if line.startswith('data:'):
+                try:
+                    data = json.loads(line[5:])
+                    if data.get("output"):
+                        choices = data["output"].get("choices", [])
+                        if choices:
+                            content = choices[0]["message"]["content"]
+                            if content:
+                                if len(content) > len(full_response):
+                                    new_content = content[len(full_response):]
+                                full_response = content
+                except json.JSONDecodeError:
+                    continue
+    return full_response
+
+
+def new_loop(chunks, incremental) -> str:
+    answer = TextAccumulator()
+    events = (json_loads(event.data) for event in iter_events(chunks))
+    for delta in stream_deltas(events, incremental):
+        answer.append(delta)
+    return answer.getvalue()
+
+
+def best_time(loop, chunks, incremental, rounds):
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = loop(chunks, incremental)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", default="1000,2000,4000,8000,16000", help="comma separated answer lengths")
+    parser.add_argument("--chunk-size", type=int, default=1024, help="bytes per replayed socket read")
+    parser.add_argument("--rounds", type=int, default=3, help="runs per point (best is reported)")
+    args = parser.parse_args()
+    
+    print("=" * 78)
+    print("  DashScope stream replay")
+    print("=" * 78)
+    
+    for incremental in (True, False):
+        print(f"\n  {'incremental' if incremental else 'cumulative'} mode\n")
+        print(f"{'tokens':>8}{'stream MB':>11}{'loop':>6}{'best s':>10}{'us/token':>10}{'ns/byte':>9}{'correct':>9}")
+        for tokens in [int(x) for x in args.tokens.split(",")]:
+            data, answer = record_stream(tokens, incremental)
+            chunks = [data[i:i + args.chunk_size] for i in range(0, len(data), args.chunk_size)]
+            for name, loop in (("old", old_loop), ("new", new_loop)):
+                best, result = best_time(loop, chunks, incremental, args.rounds)
+                print(f"{tokens:>8}{len(data) / 1e6:>11.2f}{name:>6}{best:>10.4f}"
+                      f"{best / tokens * 1e6:>10.2f}{best / len(data) * 1e9:>9.1f}{str(result == answer):>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""
+Benchmark: idle SSE streams through the Flask proxy vs the async proxy
+
+Starts the fake Qwen SSE server from bench_async_streams.py, and
+proxy_server.py (threaded Flask) and async_proxy_server.py (uvicorn)
+pointed at it, each in its own process, then opens N event streams at
+once through each proxy. Every stream sends `--events` events `--interval` seconds apart,
+so the streams sit mostly idle, like chats waiting on the model.
+
+For every level the table shows whether all streams completed, time to the
+first event, the proxy process's peak threads and RSS while the streams
+were open, and the CPU time it spent per stream. --ramp opens the streams
+over that many seconds instead of all at once.
+
+Usage:
+    python bench_proxy.py
+    python bench_proxy.py --levels 100,1000,3000 --events 10 --interval 1.0 --flask-max 1000
+    python bench_proxy.py --levels 5000 --events 3 --interval 20 --ramp 40 --flask-max 0
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+import httpx
+
+from bench_async_streams import start_fake_server
+
+
+def _serve_upstream(events: int, interval: float, urls):
+    urls.put(start_fake_server(events, interval))
+    threading.Event().wait()
+
+
+def start_upstream(events: int, interval: float):
+    """Run the fake Qwen server in its own process, so it does not share a GIL with the clients"""
+    urls = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve_upstream, args=(events, interval, urls), daemon=True)
+    process.start()
+    return process, urls.get()
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_proxy(script: str, upstream: str):
+    """Run a proxy script as a child process; returns (process, base URL)"""
+    port = _free_port()
+    env = {**os.environ, "QWEN_API_URL": upstream}
+    process = subprocess.Popen(
+        [sys.executable, script, str(port)],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    for _ in range(100):
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/health", timeout=1)
+            break
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    return process, f"http://127.0.0.1:{port}/api"
+
+
+def process_usage(pid: int):
+    """(threads, RSS MB) of a process from /proc"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            status = dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        return 0, 0.0
+    return int(status["Threads"]), int(status["VmRSS"].split()[0]) / 1024
+
+
+def process_cpu(pid: int) -> float:
+    """User + system CPU seconds used by a process so far"""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+async def open_stream(host: str, port: int, path: str, first_event: list):
+    """One POST through the proxy, read to the end of its chunked body"""
+    reader, writer = await asyncio.open_connection(host, port)
+    start = time.perf_counter()
+    body = b'{"stream": true}'
+    writer.write(
+        f"POST {path} HTTP/1.1\r\nHost: {host}\r\nAuthorization: Bearer bench\r\n"
+        f"Accept: text/event-stream\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+    )
+    head = await reader.readuntil(b"\r\n\r\n")
+    if not head.startswith(b"HTTP/1.1 200"):
+        raise IOError(head.split(b"\r\n", 1)[0].decode())
+    tail = b""
+    while not tail.endswith(b"0\r\n\r\n"):
+        data = await reader.read(65536)
+        if not data:
+            raise IOError("stream closed early")
+        if not first_event:
+            first_event.append(time.perf_counter() - start)
+        tail = (tail + data)[-16:]
+    writer.close()
+
+
+async def run_streams(base_url: str, level: int, pid: int, ramp: float = 0.0):
+    # A raw asyncio client: httpx itself cannot open thousands of streams fast enough to load the proxy
+    url = urlsplit(base_url)
+    path = f"{url.path}/v2/chat/completions"
+    first_events = [[] for _ in range(level)]
+    peak = [0, 0.0]
+    
+    async def delayed(i, first):
+        await asyncio.sleep(ramp * i / level)
+        await open_stream(url.hostname, url.port, path, first)
+    
+    async def sample():
+        while True:
+            threads, rss = process_usage(pid)
+            peak[0], peak[1] = max(peak[0], threads), max(peak[1], rss)
+            await asyncio.sleep(0.2)
+    
+    sampler = asyncio.create_task(sample())
+    cpu = process_cpu(pid)
+    start = time.perf_counter()
+    results = await asyncio.gather(
+        *(delayed(i, first) for i, first in enumerate(first_events)),
+        return_exceptions=True
+    )
+    elapsed = time.perf_counter() - start
+    cpu = process_cpu(pid) - cpu
+    sampler.cancel()
+    errors = sum(1 for r in results if isinstance(r, Exception))
+    return elapsed, errors, sorted(f[0] for f in first_events if f), peak, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--levels", default="100,1000,3000", help="comma separated stream counts")
+    parser.add_argument("--events", type=int, default=10, help="events per stream")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between events")
+    parser.add_argument("--ramp", type=float, default=0.0, help="seconds over which the streams are opened")
+    parser.add_argument("--flask-max", type=int, default=1000, help="skip the Flask proxy above this level")
+    args = parser.parse_args()
+    
+    # Every stream holds a socket on each side of both loopback hops
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    
+    upstream_process, upstream = start_upstream(args.events, args.interval)
+    proxies = [("async", "async_proxy_server.py"), ("flask", "proxy_server.py")]
+    
+    print("=" * 78)
+    print("  Idle SSE streams through the proxy (fake upstream on loopback)")
+    print("=" * 78)
+    print(f"  {args.events} events x {args.interval}s per stream -> ideal stream time "
+          f"{args.events * args.interval:.1f}s, open file limit {hard}\n")
+    print(f"{'proxy':<7}{'streams':>8}{'wall s':>9}{'errors':>8}{'TTFE p50':>10}{'TTFE max':>10}"
+          f"{'threads':>9}{'RSS MB':>9}{'CPU ms/stream':>15}")
+    
+    for name, script in proxies:
+        process, base_url = start_proxy(script, upstream)
+        try:
+            for level in [int(x) for x in args.levels.split(",")]:
+                if name == "flask" and level > args.flask_max:
+                    continue
+                elapsed, errors, ttfe, (threads, rss), cpu = asyncio.run(
+                    run_streams(base_url, level, process.pid, args.ramp)
+                )
+                p50 = ttfe[len(ttfe) // 2] if ttfe else float("nan")
+                worst = ttfe[-1] if ttfe else float("nan")
+                print(f"{name:<7}{level:>8}{elapsed:>9.2f}{errors:>8}{p50:>10.3f}{worst:>10.3f}"
+                      f"{threads:>9}{rss:>9.0f}{cpu / level * 1000:>15.2f}")
+        finally:
+            process.terminate()
+            process.wait()
+    upstream_process.terminate()
+
+
+if __name__ == "__main__":
+    main()
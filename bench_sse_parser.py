@@ -0,0 +1,137 @@
+"""
+Benchmark: replay a recorded completion stream through the old and new SSE parsers
+
+The old path is what QwenClient used before sse_parser: sseclient-py over
+the response, json.loads(strict=False) on every event and the answer built
+with `full_response += content`. The new path is sse_parser.iter_events()
+over the raw chunks, sse_parser.json_loads() (orjson when installed) and
+a TextAccumulator. Both walk the event JSON the same way, so the difference
+is decoding, JSON parsing and accumulation.
+
+Without --record a 50k-token stream in Qwen's format is generated (a think
+phase, then the answer, usage on every event). --save writes it out so the
+same bytes can be replayed elsewhere; --record replays a capture of a real
+response body (e.g. `curl -N ... > stream.sse`).
+
+Usage:
+    python bench_sse_parser.py
+    python bench_sse_parser.py --tokens 50000 --chunk-size 512 --rounds 5
+    python bench_sse_parser.py --record stream.sse
+"""
+
+import argparse
+import json
+import random
+import time
+import tracemalloc
+
+import sseclient
+
+from sse_parser import TextAccumulator, iter_events, json_backend, json_loads
+
+WORDS = ["Xin", " chào", " các", " bạn", " 日本語", " の", " 試験", " N3", " là", " một",
+         " bài", " kiểm", " tra", ",", ".", "\n", " 🎌", " grammar", " vocabulary", " kanji"]
+
+
+def record_stream(tokens: int) -> bytes:
+    """A completion stream with one token per event"""
+    rng = random.Random(0)
+    events = [json.dumps({"response.created": {"chat_id": "c1", "response_id": "r1"}})]
+    for i in range(tokens):
+        phase = "think" if i < tokens // 5 else "answer"
+        events.append(json.dumps({
+            "choices": [{"delta": {"role": "assistant", "content": rng.choice(WORDS),
+                                   "phase": phase, "status": "typing"}}],
+            "usage": {"input_tokens": 42, "output_tokens": i + 1, "total_tokens": 43 + i},
+            "response_id": "r1"
+        }, ensure_ascii=False))
+    events.append("[DONE]")
+    return "".join(f"data: {event}\n\n" for event in events).encode("utf-8")
+
+
+def split_chunks(data: bytes, size: int):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def delta_content(data) -> str:
+    choices = data.get("choices") if isinstance(data, dict) else None
+    if choices:
+        return choices[0].get("delta", {}).get("content") or ""
+    return ""
+
+
+def old_parser(chunks) -> str:
+    full_response = ""
+    for event in sseclient.SSEClient(iter(chunks)).events():
+        if event.data == "[DONE]":
+            break
+        content = delta_content(json.loads(event.data, strict=False))
+        if content:
+            full_response += content
+    return full_response
+
+
+def new_parser(chunks) -> str:
+    answer = TextAccumulator()
+    for event in iter_events(chunks):
+        if event.data == "[DONE]":
+            break
+        content = delta_content(json_loads(event.data))
+        if content:
+            answer.append(content)
+    return answer.getvalue()
+
+
+def measure(parse, chunks, rounds):
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = parse(chunks)
+        best = min(best, time.perf_counter() - start)
+    
+    tracemalloc.start()
+    parse(chunks)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=50000, help="tokens in the generated stream")
+    parser.add_argument("--chunk-size", type=int, default=1024, help="bytes per replayed socket read")
+    parser.add_argument("--rounds", type=int, default=3, help="runs per parser (best is reported)")
+    parser.add_argument("--record", help="replay this captured response body instead")
+    parser.add_argument("--save", help="write the generated stream to this file")
+    args = parser.parse_args()
+    
+    if args.record:
+        with open(args.record, "rb") as f:
+            data = f.read()
+    else:
+        data = record_stream(args.tokens)
+        if args.save:
+            with open(args.save, "wb") as f:
+                f.write(data)
+    chunks = split_chunks(data, args.chunk_size)
+    
+    print("=" * 64)
+    print("  SSE parser replay")
+    print("=" * 64)
+    print(f"  {len(data) / 1e6:.1f} MB in {len(chunks)} chunks of {args.chunk_size} bytes, "
+          f"JSON backend: {json_backend}\n")
+    print(f"{'parser':<34}{'best s':>9}{'events/s':>11}{'peak MB':>9}")
+    
+    events = data.count(b"\n\n")
+    results = {}
+    for name, parse in (("old: sseclient + json + str +=", old_parser),
+                        (f"new: sse_parser + {json_backend}", new_parser)):
+        best, peak, results[name] = measure(parse, chunks, args.rounds)
+        print(f"{name:<34}{best:>9.3f}{events / best:>11.0f}{peak / 1e6:>9.1f}")
+    
+    old, new = results.values()
+    print(f"\n  Same answer from both parsers: {old == new} ({len(new)} characters)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Benchmark: a burst of attachments, with and without STS token prefetch
+
+Every file needs its own STS token (the token names the object it may
+write), so a burst of 20 files costs 20 getstsToken round trips. Without
+prefetch each upload slot waits for its token before sending; with prefetch
+the tokens of the next files are fetched while earlier files upload.
+
+Uses the fake STS + OSS server from bench_uploads.py, with separate
+latencies for the Qwen API (--sts-latency) and OSS (--latency).
+
+Usage:
+    python bench_upload_burst.py
+    python bench_upload_burst.py --files 20 --size-kb 256 --concurrency 4 --prefetch 0,2,4,8,16
+"""
+
+import argparse
+import shutil
+import tempfile
+import threading
+import time
+
+from bench_uploads import FakeUploadServer, make_files
+from qwen_client import QwenClient
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=20, help="files in the burst")
+    parser.add_argument("--size-kb", type=int, default=256, help="size of each file")
+    parser.add_argument("--latency", type=float, default=0.1, help="seconds added to every OSS request")
+    parser.add_argument("--sts-latency", type=float, default=0.3, help="seconds added to every getstsToken call")
+    parser.add_argument("--bandwidth", type=float, default=20, help="OSS upload MB/s per object")
+    parser.add_argument("--concurrency", type=int, default=4, help="upload slots (max_concurrency)")
+    parser.add_argument("--prefetch", default="0,2,4,8,16", help="comma separated prefetch values")
+    parser.add_argument("--rounds", type=int, default=3, help="runs per value (best is reported)")
+    args = parser.parse_args()
+    
+    server = FakeUploadServer(args.latency, args.bandwidth, sts_latency=args.sts_latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    # Every round uploads the same files, so the dedup cache would answer them
+    client = QwenClient("bench-token", base_url=f"{server.endpoint}/api", upload_cache=False)
+    
+    directory = tempfile.mkdtemp(prefix="qwen_bench_")
+    try:
+        files = make_files(directory, args.files, args.size_kb)
+        
+        print("=" * 64)
+        print("  Upload burst (fake STS + OSS server on loopback)")
+        print("=" * 64)
+        print(f"  {args.files} files x {args.size_kb} KB, {args.concurrency} upload slots, "
+              f"STS {args.sts_latency}s, OSS {args.latency}s + {args.bandwidth} MB/s\n")
+        print(f"{'prefetch':<10}{'best s':>9}{'files/s':>10}{'speedup':>10}{'STS/round':>11}")
+        
+        baseline = None
+        for prefetch in [int(x) for x in args.prefetch.split(",")]:
+            best = float("inf")
+            sts_before = server.counts["sts"]
+            for _ in range(args.rounds):
+                start = time.perf_counter()
+                client.upload_files(files, max_concurrency=args.concurrency, prefetch=prefetch)
+                best = min(best, time.perf_counter() - start)
+            sts = (server.counts["sts"] - sts_before) / args.rounds
+            baseline = baseline or best
+            print(f"{prefetch:<10}{best:>9.3f}{args.files / best:>10.1f}{baseline / best:>9.1f}x{sts:>11.0f}")
+        
+        print(f"\n  {server.counts['connections']} connections in total")
+    finally:
+        shutil.rmtree(directory)
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""
+Benchmark: multi-file uploads, serial vs concurrent QwenClient.upload_files
+
+Starts a local fake server that plays both roles of an upload:
+    POST /api/v2/files/getstsToken  -> STS credentials pointing back at itself
+    PUT  /<bucket>/<path>           -> OSS object upload (oss2 uses path style
+                                       for IP endpoints), including the
+                                       multipart calls used for large files
+Both add --latency seconds per request, and object uploads are additionally
+throttled to --bandwidth MB/s, roughly like a far-away OSS region.
+
+Usage:
+    python bench_uploads.py
+    python bench_uploads.py --files 8 --size-kb 512 --latency 0.15 --levels 1,2,4,8
+"""
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from qwen_client import QwenClient
+
+
+class FakeUploadServer(ThreadingHTTPServer):
+    """Fake getstsToken + OSS endpoint with per-request latency"""
+    
+    daemon_threads = True
+    
+    def __init__(self, latency: float, bandwidth: float, sts_latency: float = None):
+        self.latency = latency
+        self.sts_latency = latency if sts_latency is None else sts_latency
+        self.bandwidth = bandwidth * 1024 * 1024
+        self.counts = {"sts": 0, "put": 0, "part": 0, "connections": 0}
+        self.parts = {}             # upload ID -> {part number: size}
+        self.fail_parts = set()     # part numbers answered with 503 once
+        self._lock = threading.Lock()
+        super().__init__(("127.0.0.1", 0), FakeUploadHandler)
+    
+    def count(self, name: str):
+        with self._lock:
+            self.counts[name] += 1
+    
+    @property
+    def endpoint(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class FakeUploadHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    
+    def setup(self):
+        super().setup()
+        self.server.count("connections")
+    
+    def log_message(self, *args):
+        pass
+    
+    def _reply(self, status: int, body: bytes = b"", headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def _read_body(self) -> int:
+        length = int(self.headers.get("Content-Length", 0))
+        received = 0
+        while received < length:
+            received += len(self.rfile.read(min(65536, length - received)))
+        return length
+    
+    def _xml(self, body: str):
+        self._reply(200, body.encode(), {"Content-Type": "application/xml"})
+    
+    def do_POST(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query, keep_blank_values=True)
+        self._read_body()
+        if "uploads" not in query and "uploadId" not in query:
+            return self._sts()
+        time.sleep(self.server.latency)
+        
+        if "uploads" in query:
+            upload_id = uuid.uuid4().hex
+            self.server.parts[upload_id] = {}
+            return self._xml(f"<InitiateMultipartUploadResult><UploadId>{upload_id}</UploadId>"
+                             f"</InitiateMultipartUploadResult>")
+        self.server.parts.pop(query["uploadId"][0], None)
+        self._xml('<CompleteMultipartUploadResult><ETag>"fake"</ETag>'
+                  '</CompleteMultipartUploadResult>')
+        
+    def _sts(self):
+        time.sleep(self.server.sts_latency)
+        self.server.count("sts")
+        file_id = str(uuid.uuid4())
+        data = {
+            "access_key_id": "STS.fake",
+            "access_key_secret": "secret",
+            "security_token": "token",
+            "endpoint": self.server.endpoint,
+            "bucketname": "bench-bucket",
+            "file_id": file_id,
+            "file_path": f"user/{file_id}",
+            "file_url": f"{self.server.endpoint}/bench-bucket/user/{file_id}"
+        }
+        self._reply(200, json.dumps({"success": True, "data": data}).encode(),
+                    {"Content-Type": "application/json"})
+    
+    def do_PUT(self):
+        query = parse_qs(urlsplit(self.path).query)
+        length = self._read_body()
+        time.sleep(self.server.latency + length / self.server.bandwidth)
+        
+        if "partNumber" in query:
+            number = int(query["partNumber"][0])
+            if number in self.server.fail_parts:
+                self.server.fail_parts.discard(number)
+                return self._reply(503, b"<Error><Code>ServiceUnavailable</Code></Error>",
+                                   {"Content-Type": "application/xml", "x-oss-request-id": "bench"})
+            self.server.count("part")
+            self.server.parts[query["uploadId"][0]][number] = length
+        else:
+            self.server.count("put")
+        self._reply(200, headers={"ETag": '"fake"', "x-oss-request-id": "bench"})
+    
+    def do_GET(self):
+        # ListParts, used when a multipart upload resumes from its checkpoint
+        query = parse_qs(urlsplit(self.path).query)
+        parts = self.server.parts.get(query.get("uploadId", [""])[0], {})
+        body = "".join(
+            f"<Part><PartNumber>{n}</PartNumber><LastModified>2025-01-01T00:00:00.000Z</LastModified>"
+            f"<ETag>\"fake\"</ETag><Size>{size}</Size></Part>"
+            for n, size in sorted(parts.items())
+        )
+        self._xml(f"<ListPartsResult><IsTruncated>false</IsTruncated>"
+                  f"<NextPartNumberMarker>0</NextPartNumberMarker>{body}</ListPartsResult>")
+
+
+def make_files(directory: str, count: int, size_kb: int):
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f"page_{i}.png")
+        with open(path, "wb") as f:
+            f.write(os.urandom(size_kb * 1024))
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=8, help="files per message")
+    parser.add_argument("--size-kb", type=int, default=512, help="size of each file")
+    parser.add_argument("--latency", type=float, default=0.15, help="seconds added to every request")
+    parser.add_argument("--bandwidth", type=float, default=20, help="OSS upload MB/s per object")
+    parser.add_argument("--levels", default="1,2,4,8", help="comma separated max_concurrency values")
+    parser.add_argument("--rounds", type=int, default=3, help="runs per level (best is reported)")
+    args = parser.parse_args()
+    
+    server = FakeUploadServer(args.latency, args.bandwidth)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    # Every round uploads the same files, so the dedup cache would answer them
+    client = QwenClient("bench-token", base_url=f"{server.endpoint}/api", upload_cache=False)
+    
+    directory = tempfile.mkdtemp(prefix="qwen_bench_")
+    try:
+        files = make_files(directory, args.files, args.size_kb)
+        
+        print("=" * 64)
+        print("  Multi-file upload (fake STS + OSS server on loopback)")
+        print("=" * 64)
+        print(f"  {args.files} files x {args.size_kb} KB, {args.latency}s latency, {args.bandwidth} MB/s\n")
+        print(f"{'concurrency':<13}{'best s':>9}{'files/s':>10}{'speedup':>10}")
+        
+        baseline = None
+        for level in [int(x) for x in args.levels.split(",")]:
+            best = float("inf")
+            for _ in range(args.rounds):
+                start = time.perf_counter()
+                client.upload_files(files, max_concurrency=level)
+                best = min(best, time.perf_counter() - start)
+            baseline = baseline or best
+            print(f"{level:<13}{best:>9.3f}{args.files / best:>10.1f}{baseline / best:>9.1f}x")
+        
+        print(f"\n  requests: {server.counts['sts']} STS, {server.counts['put']} PUT, "
+              f"{server.counts['connections']} connections")
+    finally:
+        shutil.rmtree(directory)
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,382 @@
+"""
+One chat interface over QwenClient and QwenOfficialClient, with failover
+
+The web client (QwenClient) and the DashScope client (QwenOfficialClient)
+take different arguments and stream different things. ChatBackend is the
+shape both are adapted to: a ChatRequest in, StreamDelta objects out (the
+web client's stream format, ending with a "done" delta).
+
+BackendRouter picks a backend for every request:
+
+- Backends that do not serve the requested model, or whose credential is
+  known to be refused (a web token past its exp claim or refused by
+  upstream, a DashScope key answered with 401), are skipped until the
+  credential changes.
+- The rest are ranked by an EWMA of time to first token, weighted by an
+  EWMA of the error rate. A backend that has not answered yet is assumed
+  to be as slow as the slowest measured one. A backend failing
+  max_failures times in a row sits out cooldown seconds, after which its
+  failure count starts again from zero. Every probe_every-th request tries
+  the runner-up first so its numbers stay current.
+- A request that fails before any text was yielded (an expired web token,
+  a connection error, a 5xx) moves on to the next backend within the same
+  stream() call, so the caller never sees the failure. Once text has been
+  yielded the error is raised: the answer cannot be restarted elsewhere
+  without repeating it.
+
+Web chats keep their context upstream, so WebBackend uses request.chat_id
+(or starts a new chat) and only falls back on request.history to brief a
+new chat. OfficialBackend is stateless and sends the history every time.
+"""
+
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Protocol, runtime_checkable
+
+from qwen_client import CompletionRejected, QwenClient, StreamDelta, collect_stream
+from qwen_official_client import QwenOfficialClient, message_text
+from token_refresher import token_expiry
+
+# Weight of the newest sample in the latency and error EWMAs
+ROUTER_EWMA_ALPHA = float(os.getenv("QWEN_ROUTER_EWMA_ALPHA", "0.2"))
+# Consecutive failures before a backend is skipped, and for how many seconds
+ROUTER_MAX_FAILURES = int(os.getenv("QWEN_ROUTER_MAX_FAILURES", "3"))
+ROUTER_COOLDOWN = float(os.getenv("QWEN_ROUTER_COOLDOWN", "30"))
+# A web token expiring within this many seconds is treated as expired
+ROUTER_TOKEN_MARGIN = float(os.getenv("QWEN_ROUTER_TOKEN_MARGIN", "30"))
+
+# Models served by DashScope, by the name requests use
+OFFICIAL_MODELS = {
+    "qwen3-max": "qwen3-max",
+    "qwen-max": "qwen-max",
+    "qwen-plus": "qwen-plus",
+    "qwen-turbo": "qwen-turbo",
+    "qwen3-coder": "qwen3-coder-plus",
+}
+
+
+class NoBackendAvailable(Exception):
+    """No backend could serve the request; errors holds (backend name, error) pairs"""
+    
+    def __init__(self, model: str, errors: List):
+        self.errors = errors
+        details = "; ".join(f"{name}: {error}" for name, error in errors) or "no backend serves it"
+        super().__init__(f"No backend available for {model} ({details})")
+
+
+@dataclass
+class ChatRequest:
+    """One question, in backend-neutral form"""
+    message: str
+    model: str = "qwen3-max"
+    system_prompt: Optional[str] = None
+    history: List[Dict] = field(default_factory=list)  # earlier {"role", "content"} messages
+    chat_id: Optional[str] = None                       # web chat to continue
+    thinking_enabled: bool = False
+    search_enabled: bool = False
+    temperature: float = 0.7
+    max_tokens: int = 1500
+
+
+@runtime_checkable
+class ChatBackend(Protocol):
+    """What BackendRouter needs from a backend"""
+    
+    name: str
+    
+    def serves(self, model: str) -> bool:
+        """Whether the backend has this model"""
+        ...
+    
+    def ready(self) -> bool:
+        """False while the backend is known not to work (e.g. expired token)"""
+        ...
+    
+    def stream(self, request: ChatRequest) -> Iterator[StreamDelta]:
+        """Answer request as StreamDelta objects, ending with a "done" delta"""
+        ...
+
+
+def _status(error: Exception) -> Optional[int]:
+    """HTTP status of a failed request, if it got that far"""
+    return getattr(getattr(error, "response", None), "status_code", None)
+
+
+def _is_auth_error(error: Exception) -> bool:
+    """Whether a failed request was refused because of its token"""
+    if _status(error) in (401, 403):
+        return True
+    if isinstance(error, CompletionRejected):
+        text = str(error).lower()
+        return any(word in text for word in ("unauthorized", "token", "expired", "login"))
+    return False
+
+
+def transcript(messages: List[Dict]) -> str:
+    """Earlier messages as plain text, to brief a chat that has not seen them"""
+    return "\n".join(f"{m['role']}: {message_text(m.get('content'))}" for m in messages)
+
+
+class WebBackend:
+    """ChatBackend over QwenClient (chat.qwen.ai web API)"""
+    
+    def __init__(self, client: QwenClient, name: str = "web", token_margin: float = ROUTER_TOKEN_MARGIN):
+        """
+        Args:
+            client: Web client; its token may be swapped by TokenRefresher at any time
+            token_margin: Seconds before exp at which the token counts as expired
+        """
+        self.client = client
+        self.name = name
+        self.token_margin = token_margin
+        self._rejected_token = None
+        self._models = None  # (catalog fetched_at, set of model IDs)
+    
+    def ready(self) -> bool:
+        token = self.client.auth_token
+        if token == self._rejected_token:
+            # Until the token is refreshed (set_token), it will be refused again
+            return False
+        expires_at = token_expiry(token)
+        return expires_at is None or expires_at - time.time() > self.token_margin
+    
+    def serves(self, model: str) -> bool:
+        try:
+            catalog = self.client.get_model_catalog()
+        except Exception:
+            # Unknown is not unavailable; a real failure shows up in stream()
+            return True
+        if self._models is None or self._models[0] != catalog.fetched_at:
+            ids = {m.get("id") for m in catalog.data.get("data", []) if isinstance(m, dict)}
+            self._models = (catalog.fetched_at, ids)
+        return not self._models[1] or model in self._models[1]
+    
+    def stream(self, request: ChatRequest) -> Iterator[StreamDelta]:
+        token = self.client.auth_token
+        chat_id = request.chat_id
+        system_prompt = request.system_prompt
+        if chat_id is None and request.history:
+            briefing = f"Conversation so far:\n{transcript(request.history)}"
+            system_prompt = f"{system_prompt}\n\n{briefing}" if system_prompt else briefing
+        try:
+            if chat_id is None:
+                chat_id = self.client.create_chat(title=request.message[:50], model=request.model)["id"]
+            yield from self.client.stream_message(
+                chat_id,
+                request.message,
+                model=request.model,
+                system_prompt=system_prompt,
+                thinking_enabled=request.thinking_enabled,
+                search_enabled=request.search_enabled
+            )
+        except Exception as e:
+            if _is_auth_error(e):
+                self._rejected_token = token
+            raise
+
+
+class OfficialBackend:
+    """ChatBackend over QwenOfficialClient (DashScope)"""
+    
+    def __init__(self, client: QwenOfficialClient, name: str = "official",
+                 models: Optional[Dict[str, str]] = None):
+        """
+        Args:
+            client: DashScope client
+            models: Request model name -> DashScope model name (default OFFICIAL_MODELS)
+        """
+        self.client = client
+        self.name = name
+        self.models = OFFICIAL_MODELS if models is None else models
+        self._rejected_key = None
+    
+    def ready(self) -> bool:
+        # Until the key is replaced, it will be refused again
+        return self.client.session.headers.get("Authorization") != self._rejected_key
+    
+    def serves(self, model: str) -> bool:
+        return model in self.models
+    
+    def stream(self, request: ChatRequest) -> Iterator[StreamDelta]:
+        key = self.client.session.headers.get("Authorization")
+        messages = []
+        if request.system_prompt:
+            messages.append({"role": "system", "content": request.system_prompt})
+        messages.extend(request.history)
+        messages.append({"role": "user", "content": request.message})
+        
+        payload = self.client._chat_payload(
+            messages, self.models[request.model], request.temperature, 0.8, request.max_tokens
+        )
+        payload["parameters"]["incremental_output"] = True
+        if request.search_enabled:
+            payload["parameters"]["enable_search"] = True
+        try:
+            for text in self.client._stream_deltas(payload):
+                yield StreamDelta("content", text, phase="answer")
+        except Exception as e:
+            # 401 means the key itself is invalid; a 403 (quota, model access)
+            # only counts towards the cooldown like any other failure
+            if _status(e) == 401:
+                self._rejected_key = key
+            raise
+        yield StreamDelta("done")
+
+
+class BackendHealth:
+    """Live latency and error figures of one backend"""
+    
+    def __init__(self, alpha: float = ROUTER_EWMA_ALPHA):
+        self.alpha = alpha
+        self.latency = None         # EWMA of seconds to the first delta
+        self.error_rate = 0.0       # EWMA of 1 (failed) / 0 (succeeded)
+        self.failures = 0           # consecutive
+        self.down_until = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.failovers = 0
+    
+    def success(self, latency: Optional[float]):
+        if latency is not None:
+            self.latency = latency if self.latency is None else (
+                self.alpha * latency + (1 - self.alpha) * self.latency
+            )
+        self.error_rate *= 1 - self.alpha
+        self.failures = 0
+    
+    def failure(self, max_failures: int, cooldown: float):
+        now = time.monotonic()
+        if self.down_until and self.down_until <= now:
+            # Back from a cooldown: it takes max_failures new failures to sit out again
+            self.failures = 0
+            self.down_until = 0.0
+        self.errors += 1
+        self.error_rate = self.alpha + (1 - self.alpha) * self.error_rate
+        self.failures += 1
+        if self.failures >= max_failures:
+            self.down_until = now + cooldown
+    
+    def score(self, prior: float) -> float:
+        """Lower is better; prior stands in for the latency of a backend without samples"""
+        latency = self.latency if self.latency is not None else prior
+        return latency * (1 + 4 * self.error_rate)
+    
+    def stats(self) -> Dict:
+        return {
+            "latency": round(self.latency, 4) if self.latency is not None else None,
+            "error_rate": round(self.error_rate, 4),
+            "requests": self.requests,
+            "errors": self.errors,
+            "failovers": self.failovers,
+            "cooling_down": self.down_until > time.monotonic()
+        }
+
+
+class BackendRouter:
+    """Routes each ChatRequest to the best working backend, failing over on errors"""
+    
+    def __init__(self, backends: List[ChatBackend], max_failures: int = ROUTER_MAX_FAILURES,
+                 cooldown: float = ROUTER_COOLDOWN, probe_every: int = 20,
+                 alpha: float = ROUTER_EWMA_ALPHA):
+        """
+        Args:
+            backends: Backends in order of preference while nothing is measured
+            max_failures: Consecutive failures before a backend sits out
+            cooldown: Seconds a failing backend sits out
+            probe_every: Every probe_every-th request tries the runner-up first (0 = never)
+            alpha: Weight of the newest sample in the EWMAs
+        """
+        self.backends = list(backends)
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.probe_every = probe_every
+        self.health = {backend.name: BackendHealth(alpha) for backend in self.backends}
+        self._lock = threading.Lock()
+        self._count = 0
+    
+    def candidates(self, model: str) -> List[ChatBackend]:
+        """Backends to try for model, best first (cooling-down ones last)"""
+        now = time.monotonic()
+        usable = [b for b in self.backends if b.ready() and b.serves(model)]
+        with self._lock:
+            self._count += 1
+            probe = self.probe_every and self._count % self.probe_every == 0
+            up = [b for b in usable if self.health[b.name].down_until <= now]
+            down = [b for b in usable if self.health[b.name].down_until > now]
+            # Unmeasured backends rank as the slowest measured one, not ahead of it
+            prior = max((h.latency for h in self.health.values() if h.latency is not None), default=0.0)
+            up.sort(key=lambda b: self.health[b.name].score(prior))
+        if probe and len(up) > 1:
+            up[0], up[1] = up[1], up[0]
+        return up + down
+    
+    def stream(self, request: ChatRequest) -> Iterator[StreamDelta]:
+        """
+        Answer request from the best backend, moving on to the next one if
+        it fails before yielding any text
+        
+        Raises:
+            NoBackendAvailable: If no backend serves the model or all of them failed
+        """
+        errors = []
+        for backend in self.candidates(request.model):
+            health = self.health[backend.name]
+            start = time.perf_counter()
+            latency = None
+            answered = False
+            try:
+                with self._lock:
+                    health.requests += 1
+                for delta in backend.stream(request):
+                    if latency is None:
+                        latency = time.perf_counter() - start
+                    if delta.content:
+                        answered = True
+                    yield delta
+            except Exception as e:
+                with self._lock:
+                    health.failure(self.max_failures, self.cooldown)
+                if answered:
+                    raise
+                print(f"⚠️  Backend {backend.name} failed, trying the next one: {e}")
+                errors.append((backend.name, e))
+                continue
+            with self._lock:
+                health.success(latency)
+                if errors:
+                    health.failovers += 1
+            return
+        raise NoBackendAvailable(request.model, errors)
+    
+    def chat(self, request: ChatRequest) -> Dict:
+        """Complete answer as {"content", "thinking"}"""
+        return collect_stream(self.stream(request))
+    
+    def stats(self) -> Dict:
+        with self._lock:
+            return {name: health.stats() for name, health in self.health.items()}
+
+
+def create_router(web_token: Optional[str] = None, api_key: Optional[str] = None) -> BackendRouter:
+    """
+    Router over the backends that have credentials
+    
+    Args:
+        web_token: chat.qwen.ai token for WebBackend (default QWEN_TOKEN)
+        api_key: DashScope key for OfficialBackend (default DASHSCOPE_API_KEY)
+    
+    Raises:
+        ValueError: If neither credential is set
+    """
+    web_token = web_token or os.getenv("QWEN_TOKEN")
+    api_key = api_key or os.getenv("DASHSCOPE_API_KEY")
+    backends = []
+    if web_token:
+        backends.append(WebBackend(QwenClient(web_token)))
+    if api_key:
+        backends.append(OfficialBackend(QwenOfficialClient(api_key)))
+    if not backends:
+        raise ValueError("Set QWEN_TOKEN and/or DASHSCOPE_API_KEY to create a backend router")
+    return BackendRouter(backends)
@@ -0,0 +1,171 @@
+"""
+Optional downscaling and recompression of images before upload
+
+Phone photos are often 12 MP and several MB, far more than the vision
+models look at. ImagePreprocessor shrinks images so their longest edge is
+at most max_edge pixels and re-encodes them as WebP or JPEG at the given
+quality. Rotation from the EXIF orientation tag is applied to the pixels
+and no metadata (EXIF, GPS, ICC profile) is written to the result.
+
+Derived variants are cached by the SHA-256 of the original plus the
+settings, so the same photo attached again is not decoded and encoded
+twice. Animated images and formats Pillow cannot read are uploaded as is.
+
+Requires Pillow (listed in requirements.txt); it is imported on first use.
+"""
+
+import hashlib
+import io
+import os
+import threading
+from typing import BinaryIO, Dict, Optional, Tuple, Union
+
+from oss_upload import read_exactly
+from qwen_cache import TTLCache
+
+# Longest edge in pixels; 0 disables preprocessing for the shared instance
+IMAGE_MAX_EDGE = int(os.getenv("QWEN_IMAGE_MAX_EDGE", "0"))
+IMAGE_FORMAT = os.getenv("QWEN_IMAGE_FORMAT", "webp").lower()
+IMAGE_QUALITY = int(os.getenv("QWEN_IMAGE_QUALITY", "85"))
+IMAGE_VARIANT_CACHE_SIZE = int(os.getenv("QWEN_IMAGE_VARIANT_CACHE_SIZE", "32"))
+
+_FORMATS = {
+    "webp": ("WEBP", ".webp", "image/webp"),
+    "jpeg": ("JPEG", ".jpg", "image/jpeg"),
+    "jpg": ("JPEG", ".jpg", "image/jpeg"),
+}
+
+
+def import_pil():
+    """Import the optional Pillow package"""
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        raise ImportError("Pillow package required for image preprocessing. Install with: pip install Pillow")
+    return Image, ImageOps
+
+
+class ImagePreprocessor:
+    """Resize and re-encode images, caching the results"""
+    
+    def __init__(self, max_edge: int = 2048, format: str = "webp", quality: int = 85,
+                 cache_size: int = 32):
+        """
+        Args:
+            max_edge: Longest edge of the result in pixels (smaller images keep their size)
+            format: "webp" or "jpeg"
+            quality: Encoder quality, 1-100
+            cache_size: Number of derived variants kept in memory
+        """
+        if format.lower() not in _FORMATS:
+            raise ValueError(f"Unsupported image format: {format} (use webp or jpeg)")
+        self.max_edge = max_edge
+        self.format = format.lower()
+        self.quality = quality
+        self._variants = TTLCache(max_size=cache_size, ttl=None)
+        self._lock = threading.Lock()
+        self.processed = 0
+        self.cache_hits = 0
+        self.skipped = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+    
+    def _encode(self, data: bytes) -> Optional[bytes]:
+        """Re-encoded image, or None if it should be uploaded unchanged"""
+        Image, ImageOps = import_pil()
+        pil_format = _FORMATS[self.format][0]
+        
+        try:
+            image = Image.open(io.BytesIO(data))
+            if getattr(image, "n_frames", 1) > 1:
+                return None
+            has_metadata = bool(image.getexif()) or "icc_profile" in image.info
+            image = ImageOps.exif_transpose(image)
+            resize = max(image.size) > self.max_edge
+            if resize:
+                image.thumbnail((self.max_edge, self.max_edge), Image.LANCZOS)
+            
+            # JPEG has no alpha channel; WebP keeps it
+            if pil_format == "JPEG" or image.mode not in ("RGB", "RGBA"):
+                alpha = "A" in image.getbands() or "transparency" in image.info
+                image = image.convert("RGBA" if pil_format == "WEBP" and alpha else "RGB")
+            
+            out = io.BytesIO()
+            image.save(out, pil_format, quality=self.quality)
+        except (OSError, ValueError, Image.DecompressionBombError):
+            return None
+        
+        encoded = out.getvalue()
+        # A small image without metadata is better left alone if re-encoding grows it
+        if not resize and not has_metadata and len(encoded) >= len(data):
+            return None
+        return encoded
+    
+    def prepare(self, source: Union[str, BinaryIO], filename: str, size: int,
+                mime_type: Optional[str]) -> Tuple[Union[str, BinaryIO], str, int, Optional[str]]:
+        """
+        Downscale and re-encode an image for upload
+        
+        Args:
+            source: Path or binary stream holding size bytes of image data
+            filename: Name the file is uploaded as
+            size: Size of the image in bytes
+            mime_type: Detected MIME type
+        
+        Returns:
+            (source, filename, size, mime_type) to upload instead; the input
+            values when the image is left unchanged (a consumed stream is
+            replaced by an in-memory copy)
+        """
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, 'rb') as f:
+                data = f.read()
+        else:
+            data = read_exactly(source, size)
+        
+        _, extension, new_mime = _FORMATS[self.format]
+        key = (hashlib.sha256(data).hexdigest(), self.max_edge, self.format, self.quality)
+        encoded = self._variants.get(key)
+        hit = encoded is not None
+        if not hit:
+            encoded = self._encode(data) or b""
+            self._variants.set(key, encoded)
+        
+        with self._lock:
+            self.cache_hits += hit
+            if encoded:
+                self.processed += 1
+                self.bytes_in += len(data)
+                self.bytes_out += len(encoded)
+            else:
+                self.skipped += 1
+        
+        if not encoded:
+            if isinstance(source, (str, os.PathLike)):
+                return source, filename, size, mime_type
+            return io.BytesIO(data), filename, len(data), mime_type
+        
+        new_name = os.path.splitext(filename)[0] + extension
+        return io.BytesIO(encoded), new_name, len(encoded), new_mime
+    
+    def stats(self) -> Dict:
+        return {
+            "max_edge": self.max_edge,
+            "format": self.format,
+            "quality": self.quality,
+            "processed": self.processed,
+            "cache_hits": self.cache_hits,
+            "skipped": self.skipped,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "cached_variants": len(self._variants)
+        }
+
+
+# Used by clients that are not given a preprocessor; None unless QWEN_IMAGE_MAX_EDGE is set
+shared_image_preprocessor = ImagePreprocessor(
+    max_edge=IMAGE_MAX_EDGE,
+    format=IMAGE_FORMAT,
+    quality=IMAGE_QUALITY,
+    cache_size=IMAGE_VARIANT_CACHE_SIZE
+) if IMAGE_MAX_EDGE > 0 else None
@@ -0,0 +1,324 @@
+"""
+Object uploads to Alibaba OSS
+
+Small files go up in one put_object. Files of at least MULTIPART_THRESHOLD
+bytes use oss2's resumable multipart upload: parts are sent in parallel and
+a checkpoint file records which parts are done, so a failed upload (or a
+restarted process) continues where it stopped instead of starting over.
+
+Resuming only works if the retry targets the same object key, so the STS
+upload target of an unfinished large upload is kept in UploadSessions and
+reused by the next attempt for the same file.
+
+Streams (an HTTP request body, an in-memory buffer) are uploaded without
+touching the disk: small ones go through put_object with their size as
+Content-Length, large ones are read one part at a time and at most
+MULTIPART_THREADS parts are in flight, so memory stays around
+part size x threads whatever the object size. A stream cannot be rewound,
+so a failed stream upload retries single parts but cannot resume later.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Callable, Dict, Optional, Union
+
+# Files at least this large use resumable multipart uploads
+MULTIPART_THRESHOLD = int(os.getenv("QWEN_MULTIPART_THRESHOLD", str(10 * 1024 * 1024)))
+MULTIPART_PART_SIZE = int(os.getenv("QWEN_MULTIPART_PART_SIZE", str(2 * 1024 * 1024)))
+MULTIPART_THREADS = int(os.getenv("QWEN_MULTIPART_THREADS", "4"))
+# Times a failed multipart upload is resumed before giving up
+MULTIPART_RETRIES = int(os.getenv("QWEN_MULTIPART_RETRIES", "2"))
+CHECKPOINT_DIR = os.getenv(
+    "QWEN_UPLOAD_CHECKPOINT_DIR",
+    os.path.join(tempfile.gettempdir(), "qwen_upload_checkpoints")
+)
+# Seconds an unfinished upload's STS target is reused (must not outlive the credentials)
+SESSION_TTL = float(os.getenv("QWEN_UPLOAD_SESSION_TTL", "900"))
+# Keep-alive connections per OSS endpoint, shared by all uploads
+OSS_POOL_SIZE = int(os.getenv("QWEN_OSS_POOL_SIZE", "16"))
+
+
+def import_oss2():
+    """Import the optional oss2 package"""
+    try:
+        import oss2
+    except ImportError:
+        raise ImportError("oss2 package required. Install with: pip install oss2")
+    return oss2
+
+
+class BucketPool:
+    """
+    oss2.Bucket objects that share one HTTP session per OSS endpoint
+    
+    Building a fresh oss2.Bucket per file also builds a fresh connection
+    pool, so every upload paid for a new TCP + TLS handshake. Here only the
+    oss2.Session (and its keep-alive connections) is kept, per endpoint.
+    Each upload still gets its own Bucket with its own StsAuth: a Bucket is
+    used by every part of a multipart upload, so changing the credentials
+    on a shared one would re-sign another upload's parts.
+    """
+    
+    def __init__(self, pool_size: int = OSS_POOL_SIZE):
+        """
+        Args:
+            pool_size: Keep-alive connections per endpoint; should cover
+                concurrent uploads x MULTIPART_THREADS
+        """
+        self.pool_size = pool_size
+        self._sessions = {}     # endpoint -> oss2.Session
+        self._lock = threading.Lock()
+        self.buckets = 0
+    
+    def bucket(self, sts_data: Dict):
+        """New oss2.Bucket for the STS credentials and upload target from getstsToken"""
+        oss2 = import_oss2()
+        
+        endpoint = sts_data['endpoint']
+        if not endpoint.startswith(("http://", "https://")):
+            endpoint = f"https://{endpoint}"
+        
+        with self._lock:
+            session = self._sessions.get(endpoint)
+            if session is None:
+                session = self._sessions[endpoint] = oss2.Session(pool_size=self.pool_size)
+            self.buckets += 1
+        
+        auth = oss2.StsAuth(sts_data['access_key_id'], sts_data['access_key_secret'], sts_data['security_token'])
+        return oss2.Bucket(auth, endpoint, sts_data['bucketname'], session=session)
+    
+    def stats(self) -> Dict:
+        return {
+            "endpoints": len(self._sessions),
+            "pool_size": self.pool_size,
+            "buckets": self.buckets
+        }
+
+
+bucket_pool = BucketPool()
+
+
+def file_identity(file_path: str) -> str:
+    """Key for a file's unfinished upload: path, size and modification time"""
+    st = os.stat(file_path)
+    raw = f"{os.path.abspath(file_path)}|{st.st_size}|{st.st_mtime_ns}"
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+class UploadSessions:
+    """STS upload targets of unfinished multipart uploads, one JSON file each"""
+    
+    def __init__(self, root: str = CHECKPOINT_DIR, ttl: float = SESSION_TTL):
+        self.root = os.path.join(root, "sessions")
+        self.ttl = ttl
+    
+    def _path(self, identity: str) -> str:
+        return os.path.join(self.root, f"{identity}.json")
+    
+    def load(self, identity: str) -> Optional[Dict]:
+        """STS data saved for identity, or None if missing or expired"""
+        try:
+            with open(self._path(identity), 'r') as f:
+                session = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - session.get('saved_at', 0) > self.ttl:
+            self.discard(identity)
+            return None
+        return session.get('sts_data')
+    
+    def save(self, identity: str, sts_data: Dict):
+        """Remember the upload target until the upload completes"""
+        # The STS credentials are secrets: keep them readable by this user only
+        os.makedirs(self.root, mode=0o700, exist_ok=True)
+        tmp_path = f"{self._path(identity)}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'saved_at': time.time(), 'sts_data': sts_data}, f)
+        os.replace(tmp_path, self._path(identity))
+    
+    def discard(self, identity: str):
+        try:
+            os.remove(self._path(identity))
+        except OSError:
+            pass
+
+
+upload_sessions = UploadSessions()
+
+
+def _retryable(oss2, error: Exception) -> bool:
+    """Network errors and 5xx answers are worth resuming; auth errors are not"""
+    if isinstance(error, oss2.exceptions.RequestError):
+        return True
+    return isinstance(error, oss2.exceptions.ServerError) and error.status >= 500
+
+
+def stream_size(stream: BinaryIO) -> Optional[int]:
+    """Bytes left in a seekable stream, or None if it cannot seek"""
+    try:
+        if not stream.seekable():
+            return None
+        position = stream.tell()
+        end = stream.seek(0, os.SEEK_END)
+        stream.seek(position)
+    except (AttributeError, OSError, ValueError):
+        return None
+    return end - position
+
+
+def read_exactly(stream: BinaryIO, size: int) -> bytes:
+    """Read size bytes, or fewer only at the end of the stream"""
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+class _ExactReader:
+    """read(n) returns exactly n bytes, as oss2's size-based adapters expect"""
+    
+    def __init__(self, stream: BinaryIO):
+        self.stream = stream
+    
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            return self.stream.read()
+        data = read_exactly(self.stream, size)
+        if len(data) < size:
+            raise IOError(f"Stream ended {size - len(data)} bytes short of its declared size")
+        return data
+
+
+def _upload_part(oss2, bucket, key: str, upload_id: str, number: int, data: bytes):
+    """Upload one part, retrying network errors and 5xx answers"""
+    for attempt in range(MULTIPART_RETRIES + 1):
+        try:
+            return oss2.models.PartInfo(number, bucket.upload_part(key, upload_id, number, data).etag)
+        except Exception as e:
+            if attempt == MULTIPART_RETRIES or not _retryable(oss2, e):
+                raise
+
+
+def upload_stream(bucket, key: str, stream: BinaryIO, size: int,
+                  progress_callback: Optional[Callable[[int, int], None]] = None):
+    """
+    Upload size bytes read from stream to an oss2.Bucket under key
+    
+    The stream is read sequentially and never seeked, so it can be a socket
+    or request body; short reads are fine. Memory use is bounded by MULTIPART_PART_SIZE x
+    (MULTIPART_THREADS + 1) for large objects.
+    
+    Args:
+        bucket: oss2.Bucket with write access to key
+        key: Object key
+        stream: Binary file-like object positioned at the first byte
+        size: Number of bytes to upload
+        progress_callback: Called with (bytes_sent, total_bytes) as the upload advances
+    """
+    oss2 = import_oss2()
+    
+    if size < MULTIPART_THRESHOLD:
+        # SizedFileAdapter has a len, so oss2 sends a Content-Length instead of chunking
+        bucket.put_object(key, oss2.utils.SizedFileAdapter(_ExactReader(stream), size),
+                          progress_callback=progress_callback)
+        return
+    
+    upload_id = bucket.init_multipart_upload(key).upload_id
+    slots = threading.BoundedSemaphore(MULTIPART_THREADS)
+    lock = threading.Lock()
+    sent = [0]
+    
+    def send(number, data):
+        try:
+            part = _upload_part(oss2, bucket, key, upload_id, number, data)
+            with lock:
+                sent[0] += len(data)
+                if progress_callback:
+                    progress_callback(sent[0], size)
+            return part
+        finally:
+            slots.release()
+    
+    futures = []
+    try:
+        with ThreadPoolExecutor(max_workers=MULTIPART_THREADS, thread_name_prefix="oss-part") as pool:
+            offset = 0
+            while offset < size:
+                # Wait for a free slot before reading, so unsent parts don't pile up
+                slots.acquire()
+                if any(f.done() and f.exception() for f in futures):
+                    slots.release()
+                    break
+                wanted = min(MULTIPART_PART_SIZE, size - offset)
+                data = read_exactly(stream, wanted)
+                if len(data) < wanted:
+                    slots.release()
+                    raise IOError(f"Stream ended after {offset + len(data)} of {size} bytes")
+                futures.append(pool.submit(send, len(futures) + 1, data))
+                offset += len(data)
+        parts = [f.result() for f in futures]
+        bucket.complete_multipart_upload(key, upload_id, parts)
+    except BaseException:
+        try:
+            bucket.abort_multipart_upload(key, upload_id)
+        except Exception:
+            pass
+        raise
+
+
+def upload_object(bucket, key: str, source: Union[str, BinaryIO],
+                  progress_callback: Optional[Callable[[int, int], None]] = None,
+                  size: Optional[int] = None):
+    """
+    Upload a file or stream to an oss2.Bucket under key
+    
+    Args:
+        bucket: oss2.Bucket with write access to key
+        key: Object key
+        source: Local file path, or a binary file-like object (see upload_stream)
+        progress_callback: Called with (bytes_sent, total_bytes) as the upload advances
+        size: Bytes to read from a stream; required unless the stream is seekable
+    """
+    oss2 = import_oss2()
+    
+    if not isinstance(source, (str, os.PathLike)):
+        if size is None:
+            size = stream_size(source)
+        if size is None:
+            raise ValueError("size is required to upload a non-seekable stream")
+        upload_stream(bucket, key, source, size, progress_callback)
+        return
+    
+    file_path = source
+    if os.path.getsize(file_path) < MULTIPART_THRESHOLD:
+        with open(file_path, 'rb') as f:
+            bucket.put_object(key, f, progress_callback=progress_callback)
+        return
+    
+    store = oss2.ResumableStore(root=CHECKPOINT_DIR)
+    for attempt in range(MULTIPART_RETRIES + 1):
+        try:
+            oss2.resumable_upload(
+                bucket, key, file_path,
+                store=store,
+                multipart_threshold=MULTIPART_THRESHOLD,
+                part_size=MULTIPART_PART_SIZE,
+                num_threads=MULTIPART_THREADS,
+                progress_callback=progress_callback
+            )
+            return
+        except Exception as e:
+            # The checkpoint survives, so the next attempt skips finished parts
+            if attempt == MULTIPART_RETRIES or not _retryable(oss2, e):
+                raise
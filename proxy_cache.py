@@ -0,0 +1,281 @@
+"""
+Opt-in cache of idempotent GETs for the CORS proxies
+
+The web UI polls the same few endpoints (/api/models, the chat list, user
+settings) over and over, and proxy_server.py / async_proxy_server.py used to
+forward every one of them. ProxyCache keeps the upstream answer per
+Authorization token for the paths that match a configured rule:
+    
+    QWEN_PROXY_CACHE_RULES="models=300+3600,v2/chats/=15+60"
+
+Each rule is a glob over the path after /api/, a TTL and an optional
+stale-while-revalidate window, in seconds. Within the TTL a request is
+answered from memory (X-Cache: HIT). Within the stale window the old answer
+is still returned at once (X-Cache: STALE) while one background request
+refreshes it. Bodies are kept as received, still content-encoded, so each
+Accept-Encoding the clients send gets its own entry, and the whole cache
+stays under QWEN_PROXY_CACHE_MAX_BYTES (least recently used entries go
+first).
+
+A POST, PUT or DELETE through the proxy drops that token's cached copies of
+the same path, its cached chat list pages and every cached path that names
+the same chat, e.g. a completion for ?chat_id=X invalidates v2/chats/X.
+"""
+
+import fnmatch
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+# path glob=ttl[+stale], comma separated
+DEFAULT_PROXY_CACHE_RULES = "models=300+3600,v2/users/user/settings=60+300,v2/chats/=15+60,v2/chats/pinned=15+60"
+# Total bytes of cached bodies, and the largest body that is cached at all
+PROXY_CACHE_MAX_BYTES = int(os.getenv("QWEN_PROXY_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+PROXY_CACHE_MAX_ENTRY = int(os.getenv("QWEN_PROXY_CACHE_MAX_ENTRY", str(1024 * 1024)))
+
+_CHAT_ID = re.compile(r"(?:^|/)chats/([0-9A-Za-z][0-9A-Za-z_-]{7,})(?:/|$)")
+
+
+@dataclass
+class CacheRule:
+    pattern: str
+    ttl: float
+    stale: float = 0.0
+    
+    def matches(self, path: str) -> bool:
+        return fnmatch.fnmatchcase(path, self.pattern)
+
+
+@dataclass
+class CachedResponse:
+    """One upstream answer as forwarded to the browser"""
+    status: int
+    headers: Dict[str, str]
+    body: bytes
+    rule: CacheRule
+    stored_at: float = field(default_factory=time.monotonic)
+    
+    def age(self, now: Optional[float] = None) -> float:
+        return (now if now is not None else time.monotonic()) - self.stored_at
+    
+    def response_headers(self, state: str) -> Dict[str, str]:
+        """Stored headers plus X-Cache and Age"""
+        headers = dict(self.headers)
+        headers['X-Cache'] = state
+        headers['Age'] = str(int(self.age()))
+        return headers
+
+
+def parse_rules(spec: str) -> List[CacheRule]:
+    """
+    Rules from "glob=ttl[+stale],..."
+    
+    Raises:
+        ValueError: If an entry has no "=" or a TTL is not a number
+    """
+    rules = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        pattern, sep, times = item.partition("=")
+        if not sep:
+            raise ValueError(f"Proxy cache rule needs glob=ttl[+stale]: {item!r}")
+        ttl, _, stale = times.partition("+")
+        rules.append(CacheRule(pattern.strip().lstrip("/"), float(ttl), float(stale or 0)))
+    return rules
+
+
+def chat_id_of(path: str, query: str = "") -> Optional[str]:
+    """Chat a request path refers to (chats/<id>/... or ?chat_id=<id>), if any"""
+    match = _CHAT_ID.search(path)
+    if match and match.group(1) not in ("new", "pinned"):
+        return match.group(1)
+    values = parse_qs(query).get("chat_id")
+    return values[0] if values else None
+
+
+def _is_chat_path(path: str) -> bool:
+    return path == "v2/chats" or path.startswith("v2/chats/")
+
+
+class ProxyCache:
+    """(token, path, query, accept-encoding) -> CachedResponse, bounded by total body bytes"""
+    
+    def __init__(self, rules: List[CacheRule], max_bytes: int = PROXY_CACHE_MAX_BYTES,
+                 max_entry: int = PROXY_CACHE_MAX_ENTRY):
+        """
+        Args:
+            rules: Cached paths; the first matching rule applies
+            max_bytes: Bytes of bodies kept before least recently used entries are dropped
+            max_entry: Larger bodies are passed through without being cached
+        """
+        self.rules = rules
+        self.max_bytes = max_bytes
+        self.max_entry = max_entry
+        self._entries = OrderedDict()     # key -> CachedResponse
+        self._generations = {}            # token hash -> invalidation count
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+    
+    def rule(self, path: str) -> Optional[CacheRule]:
+        """Rule for a GET of path, or None if it is not cached"""
+        for rule in self.rules:
+            if rule.matches(path):
+                return rule
+        return None
+    
+    @staticmethod
+    def token_id(auth_header: str) -> str:
+        return hashlib.sha256(auth_header.encode("utf-8")).hexdigest()[:32]
+    
+    def key(self, auth_header: str, path: str, query: str = "",
+            accept_encoding: str = "identity") -> Tuple[str, str, str, str]:
+        return (self.token_id(auth_header), path, query, accept_encoding)
+    
+    def generation(self, key) -> int:
+        """Invalidation count of the key's token, taken before fetching it"""
+        with self._lock:
+            return self._generations.get(key[0], 0)
+    
+    def lookup(self, key) -> Tuple[Optional[CachedResponse], str]:
+        """
+        (entry, state) for a GET
+        
+        state is "HIT" (fresh), "STALE" (past its TTL but within the stale
+        window; the caller should refresh it) or "MISS" (entry is None).
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                age = entry.age()
+                if age <= entry.rule.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry, "HIT"
+                if age <= entry.rule.ttl + entry.rule.stale:
+                    self._entries.move_to_end(key)
+                    self.stale_hits += 1
+                    return entry, "STALE"
+                self._drop(key)
+            self.misses += 1
+            return None, "MISS"
+    
+    def start_refresh(self, key) -> bool:
+        """Claim the background refresh of key; False if one is already running"""
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            return True
+    
+    def end_refresh(self, key):
+        with self._lock:
+            self._refreshing.discard(key)
+    
+    def cacheable(self, status: int, headers) -> bool:
+        """Whether an upstream answer may be stored"""
+        if status != 200 or 'no-store' in headers.get('Cache-Control', ''):
+            return False
+        if 'text/event-stream' in headers.get('Content-Type', ''):
+            return False
+        length = headers.get('Content-Length')
+        return length is None or int(length) <= self.max_entry
+    
+    def store(self, key, rule: CacheRule, status: int, headers: Dict[str, str], body: bytes,
+              generation: int) -> bool:
+        """
+        Keep an answer fetched while the token was at generation
+        
+        Returns False (nothing stored) if the body is too large or the token's
+        chats were invalidated while it was being fetched.
+        """
+        if len(body) > self.max_entry:
+            return False
+        entry = CachedResponse(status, headers, body, rule)
+        with self._lock:
+            if self._generations.get(key[0], 0) != generation:
+                return False
+            self._drop(key)
+            self._entries[key] = entry
+            self.size += len(body)
+            while self.size > self.max_bytes and self._entries:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+        return True
+    
+    def invalidate(self, auth_header: str, path: str, query: str = "") -> int:
+        """
+        Forget what a POST/PUT/DELETE of path may have changed
+        
+        Drops the token's entries for path itself (any query), its chat list
+        pages and cached paths of the same chat; returns the number of
+        entries dropped.
+        """
+        token = self.token_id(auth_header)
+        chat_id = chat_id_of(path, query)
+        with self._lock:
+            self._generations[token] = self._generations.get(token, 0) + 1
+            stale = []
+            for key in self._entries:
+                if key[0] != token:
+                    continue
+                if key[1] == path:
+                    stale.append(key)
+                elif _is_chat_path(key[1]):
+                    cached_chat = chat_id_of(key[1], key[2])
+                    if cached_chat is None or cached_chat == chat_id:
+                        stale.append(key)
+            for key in stale:
+                self._drop(key)
+            self.invalidations += len(stale)
+        return len(stale)
+    
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry.body)
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def stats(self) -> Dict:
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_rate": round((self.hits + self.stale_hits) / lookups, 4) if lookups else 0.0
+        }
+
+
+def create_proxy_cache() -> Optional[ProxyCache]:
+    """
+    ProxyCache configured from the environment
+    
+    QWEN_PROXY_CACHE: "off" (default) or "memory"
+    QWEN_PROXY_CACHE_RULES: glob=ttl[+stale],... (default DEFAULT_PROXY_CACHE_RULES)
+    """
+    if os.getenv("QWEN_PROXY_CACHE", "off").lower() != "memory":
+        return None
+    return ProxyCache(parse_rules(os.getenv("QWEN_PROXY_CACHE_RULES", DEFAULT_PROXY_CACHE_RULES)))
+
+
+shared_proxy_cache = create_proxy_cache()
@@ -1,17 +1,100 @@
 """
 CORS Proxy Server for Qwen API
 Allows browser to call Qwen API through this proxy
+Polled GETs can be cached per token (see proxy_cache.py, QWEN_PROXY_CACHE=memory)
 """
 
 from flask import Flask, request, Response, jsonify
 from flask_cors import CORS
+from http.cookiejar import DefaultCookiePolicy
 import requests
 import json
+import os
+import threading
+
+from proxy_cache import shared_proxy_cache as proxy_cache
+from sse_parser import response_chunks
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
-QWEN_BASE_URL = "https://chat.qwen.ai/api"
+QWEN_BASE_URL = os.getenv("QWEN_API_URL", "https://chat.qwen.ai/api")
+# Keep-alive connections to the Qwen API kept open for reuse
+PROXY_POOL_SIZE = int(os.getenv("QWEN_PROXY_POOL_SIZE", "32"))
+# Bytes forwarded per read of an upstream response
+PROXY_CHUNK_SIZE = int(os.getenv("QWEN_PROXY_CHUNK_SIZE", "16384"))
+
+# Upstream response headers passed on to the browser
+FORWARDED_HEADERS = ('Content-Type', 'Content-Encoding', 'Content-Length', 'ETag', 'Last-Modified')
+PREFLIGHT_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, DELETE, PUT, OPTIONS',
+    'Access-Control-Allow-Headers': 'Authorization, Content-Type, Accept, source, x-accel-buffering'
+}
+
+def create_upstream_session() -> requests.Session:
+    """Pooled session to the Qwen API, shared by every proxied request"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=PROXY_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    # Users share the session, so cookies set by upstream must not stick to it
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+upstream = create_upstream_session()
+
+def upstream_headers(request_headers) -> dict:
+    """Headers sent to the Qwen API for a proxied request"""
+    headers = {
+        'Authorization': request_headers.get('Authorization'),
+        'Content-Type': request_headers.get('Content-Type', 'application/json'),
+        'User-Agent': 'Mozilla/5.0',
+        # Bodies are relayed still encoded, so upstream may only use encodings the client accepts
+        'Accept-Encoding': request_headers.get('Accept-Encoding') or 'identity'
+    }
+    
+    # Add additional headers if present
+    for name in ('Accept', 'source', 'x-accel-buffering'):
+        if request_headers.get(name):
+            headers[name] = request_headers.get(name)
+    return headers
+
+def downstream_headers(response_headers) -> dict:
+    """Headers sent back to the browser for an upstream response"""
+    headers = {'Access-Control-Allow-Origin': '*'}
+    for name in FORWARDED_HEADERS:
+        if name in response_headers:
+            headers[name] = response_headers[name]
+    
+    # Handle streaming response
+    if 'text/event-stream' in response_headers.get('Content-Type', ''):
+        headers['Cache-Control'] = 'no-cache'
+        headers['X-Accel-Buffering'] = 'no'
+    return headers
+
+def store_response(resp, key, rule, generation):
+    """Read a cacheable upstream answer whole and keep it; None if it has to be streamed instead"""
+    if not proxy_cache.cacheable(resp.status_code, resp.headers):
+        return None
+    try:
+        body = b"".join(response_chunks(resp, PROXY_CHUNK_SIZE, decode_content=False))
+    finally:
+        resp.close()
+    proxy_cache.store(key, rule, resp.status_code, downstream_headers(resp.headers), body, generation)
+    return body
+
+def refresh_cached(url, headers, key, rule):
+    """Re-fetch a stale cache entry in the background"""
+    try:
+        generation = proxy_cache.generation(key)
+        resp = upstream.get(url, headers=headers, stream=True)
+        if store_response(resp, key, rule, generation) is None:
+            resp.close()
+    except requests.RequestException as e:
+        print(f"[CACHE] Refresh of {url} failed: {e}")
+    finally:
+        proxy_cache.end_refresh(key)
 
 @app.route('/api/<path:path>', methods=['GET', 'POST', 'DELETE', 'PUT', 'OPTIONS'])
 def proxy(path):
@@ -22,77 +105,77 @@ def proxy(path):
     if not auth_header:
         return jsonify({"error": "No authorization header"}), 401
     
-    # Build headers
-    headers = {
-        'Authorization': auth_header,
-        'Content-Type': 'application/json',
-        'User-Agent': 'Mozilla/5.0'
-    }
-    
-    # Add additional headers if present
-    if request.headers.get('Accept'):
-        headers['Accept'] = request.headers.get('Accept')
-    if request.headers.get('source'):
-        headers['source'] = request.headers.get('source')
-    if request.headers.get('x-accel-buffering'):
-        headers['x-accel-buffering'] = request.headers.get('x-accel-buffering')
+    headers = upstream_headers(request.headers)
     
     # Build URL
     url = f"{QWEN_BASE_URL}/{path}"
-    if request.query_string:
-        url += f"?{request.query_string.decode()}"
+    query = request.query_string.decode()
+    if query:
+        url += f"?{query}"
     
     print(f"[PROXY] {request.method} {url}")
     
     try:
         # Handle OPTIONS preflight
         if request.method == 'OPTIONS':
-            response = Response()
-            response.headers['Access-Control-Allow-Origin'] = '*'
-            response.headers['Access-Control-Allow-Methods'] = 'GET, POST, DELETE, PUT, OPTIONS'
-            response.headers['Access-Control-Allow-Headers'] = 'Authorization, Content-Type, Accept, source, x-accel-buffering'
-            return response
+            return Response(headers=PREFLIGHT_HEADERS)
         
-        # Make request to Qwen API
-        if request.method == 'GET':
-            resp = requests.get(url, headers=headers, stream=True)
-        elif request.method == 'POST':
-            data = request.get_json() if request.is_json else None
-            resp = requests.post(url, headers=headers, json=data, stream=True)
-        elif request.method == 'DELETE':
-            resp = requests.delete(url, headers=headers)
-        elif request.method == 'PUT':
-            data = request.get_json() if request.is_json else None
-            resp = requests.put(url, headers=headers, json=data)
-        else:
+        # Make request to Qwen API; the body is forwarded as the raw bytes received
+        if request.method not in ('GET', 'POST', 'DELETE', 'PUT'):
             return jsonify({"error": "Method not allowed"}), 405
         
-        # Handle streaming response
-        if 'text/event-stream' in resp.headers.get('Content-Type', ''):
-            def generate():
-                for chunk in resp.iter_content(chunk_size=1024):
-                    if chunk:
-                        yield chunk
-            
-            return Response(
-                generate(),
-                status=resp.status_code,
-                headers={
-                    'Content-Type': 'text/event-stream',
-                    'Access-Control-Allow-Origin': '*',
-                    'Cache-Control': 'no-cache',
-                    'X-Accel-Buffering': 'no'
-                }
-            )
+        # Cached GETs are answered here; changes drop what they may affect
+        cache_rule = None
+        if proxy_cache is not None:
+            if request.method == 'GET':
+                cache_rule = proxy_cache.rule(path)
+            else:
+                proxy_cache.invalidate(auth_header, path, query)
+        if cache_rule:
+            cache_key = proxy_cache.key(auth_header, path, query, headers['Accept-Encoding'])
+            entry, state = proxy_cache.lookup(cache_key)
+            if entry is not None:
+                if state == 'STALE' and proxy_cache.start_refresh(cache_key):
+                    threading.Thread(
+                        target=refresh_cached,
+                        args=(url, headers, cache_key, cache_rule),
+                        daemon=True
+                    ).start()
+                return Response(entry.body, status=entry.status, headers=entry.response_headers(state))
+            generation = proxy_cache.generation(cache_key)
+        
+        resp = upstream.request(
+            request.method,
+            url,
+            headers=headers,
+            data=request.get_data(cache=False) or None,
+            stream=True
+        )
+        
+        if cache_rule:
+            body = store_response(resp, cache_key, cache_rule, generation)
+            if body is not None:
+                response_headers = downstream_headers(resp.headers)
+                response_headers['X-Cache'] = 'MISS'
+                return Response(body, status=resp.status_code, headers=response_headers)
+        
+        changes_chat = proxy_cache is not None and request.method != 'GET'
+        
+        def generate():
+            try:
+                yield from response_chunks(resp, PROXY_CHUNK_SIZE, decode_content=False)
+            finally:
+                resp.close()
+                # A completion changes the chat as it streams, not only when it starts
+                if changes_chat:
+                    proxy_cache.invalidate(auth_header, path, query)
         
-        # Handle normal response
+        # Every body is passed on chunk by chunk, still content-encoded
         return Response(
-            resp.content,
+            generate(),
             status=resp.status_code,
-            headers={
-                'Content-Type': resp.headers.get('Content-Type', 'application/json'),
-                'Access-Control-Allow-Origin': '*'
-            }
+            headers=downstream_headers(resp.headers),
+            direct_passthrough=True
         )
         
     except requests.RequestException as e:
@@ -102,6 +185,8 @@ def proxy(path):
 @app.route('/health')
 def health():
     """Health check endpoint"""
+    if proxy_cache is not None:
+        return jsonify({"status": "ok", "proxy": "qwen-api", "cache": proxy_cache.stats()})
     return jsonify({"status": "ok", "proxy": "qwen-api"})
 
 if __name__ == '__main__':
@@ -113,7 +198,7 @@ if __name__ == '__main__':
     print("=" * 60)
     print(f"\n✓ Starting proxy server...")
     print(f"✓ Listening on: http://localhost:{port}")
-    print("✓ Proxying to: https://chat.qwen.ai/api")
+    print(f"✓ Proxying to: {QWEN_BASE_URL} ({PROXY_POOL_SIZE} pooled connections)")
     print("\nUpdate index.html:")
     print(f"  const API_BASE = 'http://localhost:{port}/api';")
     print("\nPress Ctrl+C to stop\n")
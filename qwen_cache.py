@@ -0,0 +1,501 @@
+"""
+In-process caches and request coalescing used by the Qwen clients and servers
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries also expire after a fixed TTL
+    
+    Reads refresh recency but not age, so an entry never outlives ttl
+    seconds. on_evict(key, value) is called for entries dropped because of
+    size or age (not for pop/clear) and is called outside the lock.
+    """
+    
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = 600,
+                 on_evict: Optional[Callable[[Any, Any], None]] = None):
+        """
+        Args:
+            max_size: Maximum number of entries before the least recently used is dropped
+            ttl: Seconds an entry stays valid (None = no expiry)
+            on_evict: Optional callback for entries dropped by size or age
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self._data = OrderedDict()  # key -> (value, stored_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def _expired(self, stored_at: float, now: float) -> bool:
+        return self.ttl is not None and now - stored_at > self.ttl
+    
+    def get(self, key, default=None):
+        """Return the cached value, or default on a miss or expired entry"""
+        evicted = None
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and self._expired(item[1], time.monotonic()):
+                evicted = (key, self._data.pop(key)[0])
+                self.evictions += 1
+                item = None
+            
+            if item is None:
+                self.misses += 1
+                value = default
+            else:
+                self._data.move_to_end(key)
+                self.hits += 1
+                value = item[0]
+        
+        if evicted:
+            self._notify([evicted])
+        return value
+    
+    def set(self, key, value):
+        """Store value, evicting expired and least recently used entries as needed"""
+        evicted = []
+        with self._lock:
+            now = time.monotonic()
+            self._data[key] = (value, now)
+            self._data.move_to_end(key)
+            
+            # Oldest entries sit at the front, so expired ones are found first
+            while self._data:
+                oldest_key, (oldest_value, stored_at) = next(iter(self._data.items()))
+                if len(self._data) <= self.max_size and not self._expired(stored_at, now):
+                    break
+                del self._data[oldest_key]
+                evicted.append((oldest_key, oldest_value))
+                self.evictions += 1
+        
+        self._notify(evicted)
+    
+    def pop(self, key, default=None):
+        """Remove and return an entry without calling on_evict"""
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[0]
+    
+    def clear(self):
+        """Drop all entries without calling on_evict"""
+        with self._lock:
+            self._data.clear()
+    
+    def values(self):
+        """Snapshot of the cached values"""
+        with self._lock:
+            return [value for value, _ in self._data.values()]
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def __contains__(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            return item is not None and not self._expired(item[1], time.monotonic())
+    
+    def stats(self) -> Dict:
+        """Size and hit/miss/eviction counters"""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+    
+    def _notify(self, evicted):
+        if self.on_evict:
+            for key, value in evicted:
+                try:
+                    self.on_evict(key, value)
+                except Exception:
+                    pass
+
+
+class ConversationTipCache:
+    """
+    Latest message ID ("currentId") per chat, learned from completion streams
+    
+    send_message() needs the current tip of the conversation as parent_id.
+    Without a cached tip that costs a GET of the whole chat history before
+    every message; with it, the response_id of the previous answer is reused.
+    Entries expire after ttl seconds so edits made from another device are
+    picked up again, and callers invalidate a tip when upstream rejects it.
+    """
+    
+    def __init__(self, max_size: int = 4096, ttl: Optional[float] = 1800):
+        self._cache = TTLCache(max_size=max_size, ttl=ttl)
+        self.conflicts = 0
+    
+    def get(self, chat_id: str) -> Optional[str]:
+        """Cached tip message ID of a chat, or None"""
+        return self._cache.get(chat_id)
+    
+    def update(self, chat_id: str, message_id: Optional[str]):
+        """Record the newest message of a chat"""
+        if message_id:
+            self._cache.set(chat_id, message_id)
+    
+    def invalidate(self, chat_id: str, conflict: bool = False):
+        """Forget a chat's tip; conflict=True counts it as a rejected tip"""
+        self._cache.pop(chat_id)
+        if conflict:
+            self.conflicts += 1
+    
+    def stats(self) -> Dict:
+        stats = self._cache.stats()
+        stats["conflicts"] = self.conflicts
+        return stats
+
+
+# Shared by all clients in the process; chat IDs are globally unique
+shared_tip_cache = ConversationTipCache(
+    max_size=int(os.getenv("QWEN_TIP_CACHE_SIZE", "4096")),
+    ttl=float(os.getenv("QWEN_TIP_CACHE_TTL", "1800"))
+)
+
+
+class ClientPool:
+    """
+    Bounded LRU/TTL pool of API clients keyed by auth token
+    
+    Replaces an unbounded token -> client dict: idle clients are closed when
+    they age out or the pool is full, and get() is safe to call from many
+    request threads at once.
+    """
+    
+    def __init__(self, factory: Callable[[str], Any], max_size: int = 64,
+                 ttl: Optional[float] = 3600, close: Optional[Callable[[Any], None]] = None):
+        """
+        Args:
+            factory: Creates a client for a token
+            max_size: Maximum number of pooled clients
+            ttl: Seconds a client is kept after it was created
+            close: Called with each evicted client (e.g. to close idle connections);
+                request handlers may still hold the client, so it must stay usable
+        """
+        self.factory = factory
+        self.close = close
+        self.created = 0
+        self._lock = threading.Lock()
+        self._cache = TTLCache(max_size=max_size, ttl=ttl, on_evict=self._evicted)
+    
+    def _evicted(self, token, client):
+        if self.close:
+            self.close(client)
+    
+    def get(self, token: str):
+        """Return the pooled client for token, creating it on a miss"""
+        with self._lock:
+            client = self._cache.get(token)
+            if client is None:
+                client = self.factory(token)
+                self._cache.set(token, client)
+                self.created += 1
+            return client
+    
+    def clients(self):
+        """Snapshot of the pooled clients"""
+        return self._cache.values()
+    
+    def clear(self):
+        """Close and drop every pooled client"""
+        with self._lock:
+            clients = self._cache.values()
+            self._cache.clear()
+        for client in clients:
+            self._evicted(None, client)
+    
+    def stats(self) -> Dict:
+        stats = self._cache.stats()
+        stats["created"] = self.created
+        return stats
+
+
+@dataclass
+class ModelCatalog:
+    """A cached /models response"""
+    body: bytes                   # Raw JSON bytes, served as-is by the API servers
+    data: Dict                    # Parsed body
+    etag: str                     # Strong ETag for our own clients (hash of body)
+    upstream_etag: Optional[str]  # Validators from upstream, for revalidation
+    last_modified: Optional[str]
+    fetched_at: float             # time.time() of the last (re)validation
+
+
+class ModelCatalogCache:
+    """
+    Shared cache of the model catalog with conditional revalidation
+    
+    The catalog rarely changes, so it is served from memory for ttl seconds.
+    Past refresh_ahead * ttl a background refresh is started while the cached
+    copy keeps being served; past ttl callers wait for revalidation. Requests
+    are conditional (If-None-Match / If-Modified-Since) when upstream sent
+    validators, and an upstream error falls back to the stale copy.
+    
+    fetch(headers) callbacks do the HTTP request and return
+    (status_code, body_bytes, response_headers).
+    """
+    
+    def __init__(self, ttl: float = 3600, refresh_ahead: float = 0.8):
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self._entries = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        # Concurrent misses for a key share one upstream request
+        self._flight = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.fetches = 0
+        self.not_modified = 0
+        self.background_refreshes = 0
+        self.errors = 0
+    
+    def state(self, key: str):
+        """
+        Returns:
+            (catalog or None, "fresh" | "refresh" | "expired" | "missing")
+        """
+        catalog = self._entries.get(key)
+        if catalog is None:
+            return None, "missing"
+        age = time.time() - catalog.fetched_at
+        if age > self.ttl:
+            return catalog, "expired"
+        if age > self.ttl * self.refresh_ahead:
+            return catalog, "refresh"
+        return catalog, "fresh"
+    
+    def max_age(self, catalog: ModelCatalog) -> int:
+        """Seconds the catalog stays fresh (for Cache-Control)"""
+        return max(0, int(self.ttl - (time.time() - catalog.fetched_at)))
+    
+    def request_headers(self, key: str) -> Dict:
+        """Conditional request headers for revalidating key"""
+        catalog = self._entries.get(key)
+        headers = {}
+        if catalog and catalog.upstream_etag:
+            headers["If-None-Match"] = catalog.upstream_etag
+        if catalog and catalog.last_modified:
+            headers["If-Modified-Since"] = catalog.last_modified
+        return headers
+    
+    def store(self, key: str, status: int, body: bytes, headers) -> ModelCatalog:
+        """Record an upstream response (200 or 304) and return the current catalog"""
+        with self._lock:
+            catalog = self._entries.get(key)
+            self.fetches += 1
+            if status == 304 and catalog is not None:
+                self.not_modified += 1
+                catalog.fetched_at = time.time()
+                return catalog
+            
+            catalog = ModelCatalog(
+                body=body,
+                data=json.loads(body),
+                etag='"%s"' % hashlib.sha256(body).hexdigest()[:32],
+                upstream_etag=headers.get("ETag"),
+                last_modified=headers.get("Last-Modified"),
+                fetched_at=time.time()
+            )
+            self._entries[key] = catalog
+            return catalog
+    
+    def lookup(self, key: str):
+        """
+        Count a lookup of key and tell the caller what to do
+        
+        Returns:
+            (catalog, action) where action is "hit" (serve catalog),
+            "refresh" (serve catalog and refresh it in the background; the
+            refresh is claimed for this caller, who must call end_refresh)
+            or "fetch" (missing or expired; fetch and wait)
+        """
+        with self._lock:
+            catalog, state = self.state(key)
+            if state == "fresh":
+                self.hits += 1
+                return catalog, "hit"
+            if state == "refresh":
+                self.hits += 1
+                if key in self._refreshing:
+                    return catalog, "hit"
+                self._refreshing.add(key)
+                self.background_refreshes += 1
+                return catalog, "refresh"
+            self.misses += 1
+            return catalog, "fetch"
+    
+    def end_refresh(self, key: str):
+        with self._lock:
+            self._refreshing.discard(key)
+    
+    def failed(self, key: str) -> Optional[ModelCatalog]:
+        """Count a failed fetch; returns the stale copy to serve instead, if any"""
+        with self._lock:
+            self.errors += 1
+            return self._entries.get(key)
+    
+    def get(self, key: str, fetch: Callable) -> ModelCatalog:
+        """Return the catalog for key, fetching or revalidating as needed"""
+        catalog, action = self.lookup(key)
+        if action == "refresh":
+            threading.Thread(target=self._background_refresh, args=(key, fetch), daemon=True).start()
+        if action != "fetch":
+            return catalog
+        return self._flight.do(key, lambda: self._refresh(key, fetch))
+        
+    def _background_refresh(self, key: str, fetch: Callable):
+        try:
+            self._refresh(key, fetch)
+        finally:
+            self.end_refresh(key)
+    
+    def _refresh(self, key: str, fetch: Callable) -> ModelCatalog:
+        try:
+            status, body, headers = fetch(self.request_headers(key))
+            return self.store(key, status, body, headers)
+        except Exception:
+            catalog = self.failed(key)
+            if catalog is None:
+                raise
+            # Serve the stale copy rather than failing
+            return catalog
+    
+    def invalidate(self, key: Optional[str] = None):
+        """Drop one catalog, or all of them"""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+    
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "ttl": self.ttl,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "upstream_fetches": self.fetches,
+            "not_modified": self.not_modified,
+            "background_refreshes": self.background_refreshes,
+            "errors": self.errors
+        }
+
+
+class _Call:
+    """One in-flight SingleFlight call"""
+    
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Collapse concurrent identical calls into one
+    
+    While a call for a key is running, other callers with the same key wait
+    for it and receive the same result (or exception) instead of starting
+    their own. Results are shared objects, so callers must not mutate them.
+    Nothing is cached: the next call after completion runs again.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.calls = 0
+        self.collapsed = 0
+    
+    def do(self, key, fn: Callable[[], Any]):
+        """Run fn() for key, or wait for the identical call already running"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+            else:
+                self.collapsed += 1
+        
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+    
+    def stats(self) -> Dict:
+        total = self.calls + self.collapsed
+        return {
+            "in_flight": len(self._calls),
+            "upstream_calls": self.calls,
+            "collapsed": self.collapsed,
+            "collapse_rate": round(self.collapsed / total, 4) if total else 0.0
+        }
+
+
+class AsyncSingleFlight(SingleFlight):
+    """SingleFlight for coroutines; use from a single event loop"""
+    
+    async def do(self, key, fn: Callable[[], Any]):
+        """
+        Await fn() for key, or wait for the identical call already running
+        
+        fn() runs in its own task, so cancelling the caller that started it
+        does not cancel the call for the others waiting on it.
+        """
+        task = self._calls.get(key)
+        if task is not None:
+            self.collapsed += 1
+        else:
+            task = self._calls[key] = asyncio.get_running_loop().create_task(fn())
+            task.add_done_callback(lambda done: self._finished(key, done))
+            self.calls += 1
+        return await asyncio.shield(task)
+    
+    def _finished(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Mark the exception as retrieved when every caller was cancelled
+        if not task.cancelled():
+            task.exception()
+
+
+# Identical concurrent GETs are keyed by (token, method, URL)
+shared_single_flight = SingleFlight()
+shared_async_single_flight = AsyncSingleFlight()
+
+# Model catalog shared by all clients in the process, keyed by API base URL
+shared_model_cache = ModelCatalogCache(ttl=float(os.getenv("QWEN_MODELS_TTL", "3600")))
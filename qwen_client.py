@@ -3,14 +3,472 @@ Unofficial Python client for interacting with Qwen AI Chat API
 """
 
 import requests
+import contextlib
+import io
 import json
 import os
-from typing import Optional, Dict, List
-import sseclient
+from dataclasses import dataclass
+from typing import Callable, Optional, Dict, List, Iterator
 import sys
+import threading
 import uuid
 import time
 
+from urllib3.exceptions import EmptyPoolError
+
+from oss_upload import (
+    MULTIPART_THRESHOLD, bucket_pool, file_identity, stream_size, upload_object, upload_sessions
+)
+from qwen_cache import (
+    ConversationTipCache,
+    ModelCatalog,
+    ModelCatalogCache,
+    SingleFlight,
+    shared_model_cache,
+    shared_single_flight,
+    shared_tip_cache,
+)
+from image_prep import ImagePreprocessor, shared_image_preprocessor
+from response_cache import ResponseCache, response_key, shared_response_cache
+from sse_parser import TextAccumulator, iter_events, json_loads, response_chunks
+from upload_cache import HashingReader, UploadCache, token_scope, shared_upload_cache
+
+
+# Extra headers for the completion event stream
+STREAM_HEADERS = {
+    "Accept": "text/event-stream",
+    "x-accel-buffering": "no",
+    "source": "web"
+}
+
+
+# Files uploaded at once by upload_files() / chat_with_files()
+UPLOAD_CONCURRENCY = int(os.getenv("QWEN_UPLOAD_CONCURRENCY", "4"))
+# Extra files whose STS token is fetched while earlier files upload
+STS_PREFETCH = int(os.getenv("QWEN_UPLOAD_STS_PREFETCH", "4"))
+# Seconds a request waits for a free connection under a connection cap
+POOL_TIMEOUT = float(os.getenv("QWEN_POOL_TIMEOUT", "10"))
+
+
+class CompletionRejected(Exception):
+    """Upstream answered a completion request with an error body instead of a stream"""
+
+
+class UploadFailed(Exception):
+    """
+    Some attachments could not be uploaded
+    
+    failures holds one {"index", "file", "error"} dict per failed file (index
+    into the list passed in); uploaded holds the metadata of the files that
+    did succeed, in input order.
+    """
+    
+    def __init__(self, failures: List[Dict], uploaded: List[Dict]):
+        self.failures = failures
+        self.uploaded = uploaded
+        details = "; ".join(f"{os.path.basename(f['file'])}: {f['error']}" for f in failures)
+        super().__init__(f"{len(failures)} file(s) failed to upload ({details})")
+
+
+class UpstreamBusy(EmptyPoolError):
+    """Every connection allowed to the API host stayed in use for the whole pool timeout"""
+
+
+class _PoolTimeout:
+    """Connection pool mixin: wait pool_timeout for a free connection, then raise UpstreamBusy"""
+    pool_timeout = None
+    
+    def _get_conn(self, timeout=None):
+        timeout = self.pool_timeout if timeout is None else timeout
+        try:
+            return super()._get_conn(timeout=timeout)
+        except EmptyPoolError:
+            raise UpstreamBusy(self, f"No free connection to {self.host} within {timeout}s") from None
+
+
+class HostConnectionLimit(requests.adapters.HTTPAdapter):
+    """
+    Transport adapter capping open connections per host, with a pool timeout
+    
+    Mount one instance on many sessions to share a single cap between them.
+    A request that finds all max_connections in use waits up to
+    pool_timeout seconds for one to be released and then raises
+    UpstreamBusy, instead of blocking until some stream ends.
+    """
+    
+    def __init__(self, max_connections: int, pool_timeout: float = POOL_TIMEOUT):
+        self.pool_timeout = pool_timeout
+        super().__init__(pool_connections=4, pool_maxsize=max_connections, pool_block=True)
+    
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: type(cls.__name__, (_PoolTimeout, cls), {"pool_timeout": self.pool_timeout})
+            for scheme, cls in self.poolmanager.pool_classes_by_scheme.items()
+        }
+
+
+@dataclass
+class StreamDelta:
+    """
+    One parsed event from the chat completion stream
+    
+    type is one of:
+        "content"   - answer text delta (content)
+        "reasoning" - thinking text delta (content)
+        "phase"     - output phase changed, e.g. "think" -> "answer" (phase)
+        "usage"     - token usage update (usage)
+        "done"      - stream finished (response_id, usage)
+    """
+    type: str
+    content: str = ""
+    phase: Optional[str] = None
+    usage: Optional[Dict] = None
+    response_id: Optional[str] = None
+
+
+def build_message_payload(
+    chat_id: str,
+    message,
+    model: str,
+    parent_id: Optional[str],
+    stream: bool,
+    system_prompt: Optional[str],
+    thinking_enabled: bool,
+    search_enabled: bool
+) -> Dict:
+    """Build the completion payload in Qwen's web format"""
+    # Handle message as dict (with files) or string
+    if isinstance(message, dict):
+        message_content = message.get('content', '')
+        files = message.get('files', [])
+    else:
+        message_content = message
+        files = []
+    
+    # Prepend system prompt if provided
+    if system_prompt:
+        message_content = f"""[INSTRUCTION]
+{system_prompt}
+
+[MESSAGE]
+{message_content}
+"""
+    # Generate IDs
+    fid = str(uuid.uuid4())
+    
+    timestamp = int(time.time())
+    
+    # Determine chat type based on search mode
+    chat_type = "search" if search_enabled else "t2t"
+    sub_chat_type = "search" if search_enabled else "t2t"
+    
+    # Build payload matching Qwen's format
+    return {
+        "stream": stream,
+        "incremental_output": True,  # True for streaming output
+        "chat_id": chat_id,
+        "chat_mode": "normal",
+        "model": model,
+        "parent_id": parent_id,
+        "messages": [
+            {
+                "fid": fid,
+                "parentId": parent_id,
+                "childrenIds": [],
+                "role": "user",
+                "content": message_content,
+                "user_action": "chat",
+                "files": files,  # Include files here
+                "timestamp": timestamp,
+                "models": [model],
+                "chat_type": chat_type,
+                "feature_config": {
+                    "thinking_enabled": thinking_enabled,  # Enable/disable thinking
+                    "output_schema": "phase"
+                },
+                "extra": {
+                    "meta": {
+                        "subChatType": sub_chat_type
+                    }
+                },
+                "sub_chat_type": sub_chat_type,
+                "parent_id": parent_id
+            }
+        ],
+        "timestamp": timestamp,
+        "size": "1:1"
+    }
+
+
+class CompletionStreamParser:
+    """
+    Turn the data fields of the completion SSE stream into StreamDelta objects
+    
+    Shared by QwenClient and AsyncQwenClient so both report phases, reasoning
+    and usage the same way. Reasoning output (reasoning_content fields or the
+    "think" phase of output_schema=phase) is reported as "reasoning",
+    everything else as "content".
+    """
+    
+    def __init__(self):
+        self.phase = None
+        self.usage = None
+        self.response_id = None
+    
+    def feed(self, raw: str) -> List[StreamDelta]:
+        """Parse one event's data field; returns the deltas it contains"""
+        try:
+            data = json_loads(raw)
+        except json.JSONDecodeError:
+            return []
+        
+        # First event carries the IDs of the new assistant message
+        if "response.created" in data:
+            self.response_id = data["response.created"].get("response_id")
+            return []
+        
+        # Qwen format: check for content in different structures
+        content = None
+        reasoning = None
+        phase = None
+        
+        if "output" in data:
+            content = data["output"].get("text", "")
+            reasoning = data["output"].get("reasoning", "")
+        elif "choices" in data and len(data["choices"]) > 0:
+            choice = data["choices"][0]
+            
+            # Delta format (streaming)
+            if "delta" in choice:
+                delta = choice["delta"]
+                content = delta.get("content", "")
+                reasoning = delta.get("reasoning_content", "")
+                phase = delta.get("phase")
+            
+            # Message format (final)
+            elif "message" in choice:
+                msg = choice["message"]
+                content = msg.get("content", "")
+                reasoning = msg.get("reasoning_content", "")
+        
+        elif "content" in data:
+            content = data.get("content", "")
+            reasoning = data.get("reasoning_content", "")
+        
+        deltas = []
+        
+        if phase and phase != self.phase:
+            self.phase = phase
+            deltas.append(StreamDelta("phase", phase=phase))
+        
+        # Handle thinking/reasoning content
+        if reasoning:
+            if isinstance(reasoning, bytes):
+                reasoning = reasoning.decode('utf-8', errors='replace')
+            deltas.append(StreamDelta("reasoning", reasoning, phase=self.phase))
+        
+        # Handle regular content
+        if content:
+            # Ensure content is properly decoded UTF-8
+            if isinstance(content, bytes):
+                content = content.decode('utf-8', errors='replace')
+            
+            # The "think" phase streams reasoning through delta.content
+            kind = "reasoning" if self.phase == "think" else "content"
+            deltas.append(StreamDelta(kind, content, phase=self.phase))
+        
+        if data.get("usage") and data["usage"] != self.usage:
+            self.usage = data["usage"]
+            deltas.append(StreamDelta("usage", usage=self.usage))
+        
+        return deltas
+    
+    def done(self) -> StreamDelta:
+        """The final "done" delta"""
+        return StreamDelta("done", usage=self.usage, response_id=self.response_id)
+
+
+def collect_stream(deltas) -> Dict:
+    """Accumulate StreamDelta objects into {"content", "thinking"}"""
+    content = TextAccumulator()
+    thinking = TextAccumulator()
+    
+    for delta in deltas:
+        if delta.type == "content":
+            content.append(delta.content)
+        elif delta.type == "reasoning":
+            thinking.append(delta.content)
+    
+    result = {"content": content.getvalue()}
+    if thinking:
+        result["thinking"] = thinking.getvalue()
+    return result
+
+
+class StreamRecorder:
+    """
+    Record a completion stream for ResponseCache
+    
+    Consecutive text deltas of the same kind are merged, so the entry is
+    a short list of [type, value] pairs rather than one pair per token.
+    """
+    
+    def __init__(self):
+        self.events = []
+        self.usage = None
+        self.complete = False
+        self._kind = None
+        self._text = None
+    
+    def _close_text(self):
+        if self._kind is not None:
+            self.events.append([self._kind, self._text.getvalue()])
+            self._kind = None
+    
+    def add(self, delta: StreamDelta):
+        if delta.type in ("content", "reasoning"):
+            if delta.type != self._kind:
+                self._close_text()
+                self._kind = delta.type
+                self._text = TextAccumulator()
+            self._text.append(delta.content)
+        elif delta.type == "phase":
+            self._close_text()
+            self.events.append(["phase", delta.phase])
+        elif delta.type == "usage":
+            self.usage = delta.usage
+        elif delta.type == "done":
+            self._close_text()
+            self.usage = delta.usage or self.usage
+            self.complete = True
+    
+    def answer(self) -> Optional[Dict]:
+        """The recorded answer, or None if the stream did not finish with content"""
+        if not self.complete or not any(kind == "content" for kind, _ in self.events):
+            return None
+        return {"events": self.events, "usage": self.usage}
+
+
+def replay_stream(answer: Dict) -> Iterator[StreamDelta]:
+    """Yield a recorded answer as the deltas of a stream (response_id is None)"""
+    phase = None
+    for kind, value in answer["events"]:
+        if kind == "phase":
+            phase = value
+            yield StreamDelta("phase", phase=value)
+        else:
+            yield StreamDelta(kind, value, phase=phase)
+    if answer.get("usage"):
+        yield StreamDelta("usage", usage=answer["usage"])
+    yield StreamDelta("done", usage=answer.get("usage"))
+
+
+def upload_source(file, filename: Optional[str] = None, size: Optional[int] = None):
+    """
+    Normalize something to upload into (source, filename, size)
+    
+    file may be a path, bytes, or a binary file-like object. For file-like
+    objects the filename defaults to the object's name attribute and the
+    size to the bytes left in it if it is seekable; non-seekable streams
+    (a request body) must pass size.
+    
+    Returns:
+        (path or file-like object, filename, size in bytes)
+    """
+    if isinstance(file, (str, os.PathLike)):
+        if not os.path.exists(file):
+            raise FileNotFoundError(f"File not found: {file}")
+        return file, filename or os.path.basename(file), os.path.getsize(file)
+    
+    if isinstance(file, (bytes, bytearray, memoryview)):
+        file = io.BytesIO(file)
+    
+    filename = filename or os.path.basename(str(getattr(file, 'name', '') or ''))
+    if not filename:
+        raise ValueError("filename is required to upload a stream")
+    if size is None:
+        size = stream_size(file)
+    if size is None:
+        raise ValueError("size is required to upload a non-seekable stream")
+    return file, filename, size
+
+
+def upload_item(item) -> Dict:
+    """
+    upload_file() keyword arguments for one entry of upload_files()
+    
+    An entry is a path, or a (filename, data) or (filename, data, size) tuple
+    where data is bytes or a binary file-like object.
+    """
+    if isinstance(item, tuple):
+        return dict(zip(("filename", "file", "size"), item))
+    return {"file": item}
+
+
+def put_object_to_oss(file_path, sts_data: Dict,
+                      progress_callback: Optional[Callable[[int, int], None]] = None,
+                      size: Optional[int] = None) -> str:
+    """
+    Upload a file to Alibaba OSS with the STS credentials from getstsToken
+    
+    Files above oss_upload.MULTIPART_THRESHOLD use a resumable multipart upload.
+    file_path may also be a binary file-like object, which is streamed to OSS
+    without a temp file (size bytes, see oss_upload.upload_stream).
+    
+    Returns:
+        URL of the uploaded file
+    """
+    # Pooled bucket: connections to the OSS endpoint are kept alive between files
+    bucket = bucket_pool.bucket(sts_data)
+    
+    # Upload file
+    upload_object(bucket, sts_data['file_path'], file_path, progress_callback, size)
+    
+    # Return the file URL (use pre-signed URL from response)
+    file_url = sts_data.get('file_url', f"https://{sts_data['bucketname']}.{sts_data['endpoint']}/{sts_data['file_path']}")
+    return file_url
+
+
+def _is_parent_conflict(error: Exception) -> bool:
+    """Whether a failed completion may be caused by a stale parent_id"""
+    if isinstance(error, CompletionRejected):
+        return True
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    return status in (400, 404, 409, 422)
+
+
+def detect_filetype(filename: str):
+    """
+    Guess the Qwen upload type of a file from its name
+    
+    Returns:
+        ("image" or "file", mime type or None)
+    """
+    import mimetypes
+    
+    mime_type, _ = mimetypes.guess_type(filename)
+    if mime_type and mime_type.startswith('image/'):
+        return "image", mime_type
+    return "file", mime_type
+
+
+def build_file_metadata(sts_data: Dict, file_url: str, filename: str, filesize: int,
+                        filetype: str, mime_type: Optional[str]) -> Dict:
+    """File metadata in the format expected by a message's "files" list"""
+    file_class = "vision" if filetype == "image" else "document"
+    
+    return {
+        "type": filetype,
+        "id": sts_data['file_id'],
+        "url": file_url,
+        "name": filename,
+        "size": filesize,
+        "file_type": mime_type or "application/octet-stream",
+        "file_class": file_class,
+        "status": "uploaded"
+    }
+
 
 class QwenClient:
     """Client for interacting with Qwen AI Chat API"""
@@ -18,7 +476,20 @@ class QwenClient:
     # Get base URL from environment or use default
     BASE_URL = os.getenv("QWEN_API_URL", "https://chat.qwen.ai/api")
     
-    def __init__(self, auth_token: str, auto_refresh: bool = True, base_url: Optional[str] = None):
+    def __init__(
+        self,
+        auth_token: str,
+        auto_refresh: bool = True,
+        base_url: Optional[str] = None,
+        tip_cache: Optional[ConversationTipCache] = None,
+        max_connections: Optional[int] = None,
+        http_adapter: Optional[requests.adapters.HTTPAdapter] = None,
+        model_cache: Optional[ModelCatalogCache] = None,
+        single_flight: Optional[SingleFlight] = None,
+        upload_cache: Optional[UploadCache] = None,
+        image_preprocessor: Optional[ImagePreprocessor] = None,
+        response_cache: Optional[ResponseCache] = None
+    ):
         """
         Initialize Qwen client
         
@@ -26,17 +497,63 @@ class QwenClient:
             auth_token: JWT authentication token from Qwen
             auto_refresh: Automatically refresh token when needed
             base_url: Custom base URL (overrides environment variable)
+            tip_cache: Cache of each chat's latest message ID, used as parent_id
+                (defaults to the process-wide qwen_cache.shared_tip_cache)
+            max_connections: Hard cap on open connections to the API host;
+                extra requests wait up to POOL_TIMEOUT for a free connection,
+                then raise UpstreamBusy (None = requests default)
+            http_adapter: Adapter shared with other clients, e.g. one
+                HostConnectionLimit for a whole server (overrides
+                max_connections; close() leaves it open)
+            model_cache: Cache of the model catalog
+                (defaults to the process-wide qwen_cache.shared_model_cache)
+            single_flight: Collapses identical concurrent GETs into one request
+                (defaults to the process-wide qwen_cache.shared_single_flight)
+            upload_cache: Content-hash index of uploaded files; False disables it
+                (defaults to upload_cache.shared_upload_cache, see QWEN_UPLOAD_CACHE)
+            image_preprocessor: Downscales images before upload; False disables it
+                (defaults to image_prep.shared_image_preprocessor, on when
+                QWEN_IMAGE_MAX_EDGE is set)
+            response_cache: Replays answers to repeated prompts; False disables it
+                (defaults to response_cache.shared_response_cache, off unless
+                QWEN_RESPONSE_CACHE is set)
         """
         self.auth_token = auth_token
         self.auto_refresh = auto_refresh
+        self.tip_cache = tip_cache or shared_tip_cache
+        self.model_cache = model_cache or shared_model_cache
+        self.single_flight = single_flight or shared_single_flight
+        self.upload_cache = shared_upload_cache if upload_cache is None else upload_cache
+        self.image_preprocessor = (
+            shared_image_preprocessor if image_preprocessor is None else image_preprocessor
+        )
+        self.response_cache = shared_response_cache if response_cache is None else response_cache
         
         # Allow custom base URL or use class default (from env)
         if base_url:
             self.BASE_URL = base_url
         
         self.session = requests.Session()
+        self._shared_adapter = http_adapter
+        adapter = http_adapter
+        if adapter is None and max_connections:
+            adapter = HostConnectionLimit(max_connections)
+        if adapter is not None:
+            self.session.mount("https://", adapter)
+            self.session.mount("http://", adapter)
         self._update_session_headers()
     
+    def close(self):
+        """
+        Close pooled connections
+        
+        A shared http_adapter is left open for the other clients. The client
+        stays usable either way: a later request opens a new connection.
+        """
+        for adapter in self.session.adapters.values():
+            if adapter is not self._shared_adapter:
+                adapter.close()
+    
     def _update_session_headers(self):
         """Update session headers with current token"""
         self.session.headers.update({
@@ -45,11 +562,30 @@ class QwenClient:
             "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36"
         })
     
+    def set_token(self, token: str):
+        """Switch to a new token; requests already in flight keep the old one"""
+        self.auth_token = token
+        self._update_session_headers()
+    
+    def _get_json(self, path: str) -> Dict:
+        """
+        GET a JSON resource
+        
+        Identical GETs (same token and URL) running at the same time share
+        one upstream request and its parsed result, so treat it as read-only.
+        """
+        url = f"{self.BASE_URL}{path}"
+        
+        def fetch():
+            response = self.session.get(url)
+            response.raise_for_status()
+            return response.json()
+        
+        return self.single_flight.do((self.auth_token, "GET", url), fetch)
+    
     def get_user_settings(self) -> Dict:
         """Get user settings"""
-        response = self.session.get(f"{self.BASE_URL}/v2/users/user/settings")
-        response.raise_for_status()
-        return response.json()
+        return self._get_json("/v2/users/user/settings")
     
     def refresh_token(self) -> Dict:
         """
@@ -64,8 +600,7 @@ class QwenClient:
         
         # Update token
         if 'token' in data:
-            self.auth_token = data['token']
-            self._update_session_headers()
+            self.set_token(data['token'])
             print(f"✓ Token refreshed. Expires at: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(data['expires_at']))}")
         
         return data
@@ -77,15 +612,11 @@ class QwenClient:
         Returns:
             Dict with user info, token, and expiration
         """
-        response = self.session.get(f"{self.BASE_URL}/v1/auths/")
-        response.raise_for_status()
-        return response.json()
+        return self._get_json("/v1/auths/")
     
     def get_user_status(self) -> Dict:
         """Get user status"""
-        response = self.session.get(f"{self.BASE_URL}/v2/users/status")
-        response.raise_for_status()
-        return response.json()
+        return self._get_json("/v2/users/status")
     
     def list_models(self) -> Dict:
         """
@@ -94,9 +625,27 @@ class QwenClient:
         Returns:
             Dict with models list and their info
         """
-        response = self.session.get(f"{self.BASE_URL}/models")
-        response.raise_for_status()
-        return response.json()
+        return self.get_model_catalog().data
+    
+    def get_model_catalog(self) -> ModelCatalog:
+        """
+        Model list from model_cache, revalidated with upstream when due
+        
+        Returns:
+            ModelCatalog with the raw body, parsed data and validators
+        """
+        return self.model_cache.get(self.BASE_URL, self._fetch_models)
+    
+    def _fetch_models(self, headers: Dict):
+        url = f"{self.BASE_URL}/models"
+        
+        def fetch():
+            response = self.session.get(url, headers=headers)
+            if response.status_code != 304:
+                response.raise_for_status()
+            return response.status_code, response.content, response.headers
+        
+        return self.single_flight.do((self.auth_token, "GET", url), fetch)
     
     def list_chats(self, page: int = 1) -> Dict:
         """
@@ -105,9 +654,7 @@ class QwenClient:
         Args:
             page: Page number for pagination
         """
-        response = self.session.get(f"{self.BASE_URL}/v2/chats/?page={page}")
-        response.raise_for_status()
-        return response.json()
+        return self._get_json(f"/v2/chats/?page={page}")
     
         """Get pinned chat conversations"""
         response = self.session.get(f"{self.BASE_URL}/v2/chats/pinned")
@@ -175,98 +722,122 @@ class QwenClient:
             thinking_enabled: Enable thinking mode (shows reasoning process)
             search_enabled: Enable internet search mode (gets latest information)
         """
+        if stream:
+            return collect_stream(self.stream_message(
+                chat_id, message, model, parent_id,
+                system_prompt, thinking_enabled, search_enabled
+            ))
         
-        # Handle message as dict (with files) or string
-        if isinstance(message, dict):
-            message_content = message.get('content', '')
-            files = message.get('files', [])
-        else:
-            message_content = message
-            files = []
+        if parent_id is None:
+            parent_id = self.tip_cache.get(chat_id) or self._fetch_current_id(chat_id)
+        payload = build_message_payload(
+            chat_id, message, model, parent_id, False,
+            system_prompt, thinking_enabled, search_enabled
+        )
+        response = self.session.post(
+            f"{self.BASE_URL}/v2/chat/completions?chat_id={chat_id}",
+            json=payload
+        )
+        response.raise_for_status()
         
-        # Prepend system prompt if provided
-        if system_prompt:
-            message_content = f"""[INSTRUCTION]
-{system_prompt}
-
-[MESSAGE]
-{message_content}
-"""
-        # Auto-detect parent_id from chat history if not provided
+        # The new message ID is not parsed from this format; re-read it next time
+        self.tip_cache.invalidate(chat_id)
+        return response.json()
+    
+    def stream_message(
+        self,
+        chat_id: str,
+        message,
+        model: str = "qwen3-max",
+        parent_id: Optional[str] = None,
+        system_prompt: Optional[str] = None,
+        thinking_enabled: bool = False,
+        search_enabled: bool = False
+    ) -> Iterator[StreamDelta]:
+        """
+        Send a message and yield response deltas as soon as they are parsed
+        
+        Takes the same arguments as send_message(). Nothing is printed.
+        
+        When parent_id is None the chat's tip comes from tip_cache (filled
+        from the response IDs of earlier streams) and chat history is only
+        fetched on a miss, or when upstream rejects a cached tip.
+        
+        With a response_cache, a prompt this token sent before (same model,
+        prompts, files and flags, in any chat) is replayed from the cache
+        instead; search-enabled requests always go upstream.
+        
+        Yields:
+            StreamDelta objects, ending with a single "done" delta
+        """
+        use_cache = bool(self.response_cache) and not search_enabled
+        if use_cache:
+            key = response_key(
+                token_scope(self.auth_token), model, system_prompt, message, thinking_enabled, search_enabled
+            )
+            answer = self.response_cache.get(key)
+            if answer is not None:
+                yield from replay_stream(answer)
+                return
+        
+        from_cache = False
         if parent_id is None:
-            try:
-                chat_data = self.get_chat_history(chat_id)
-                if chat_data.get("success") and chat_data.get("data"):
-                    parent_id = chat_data["data"].get("currentId")
-            except:
-                # For new chats, parent_id should be null
-                pass
-        
-        # Generate IDs
-        fid = str(uuid.uuid4())
-        
-        timestamp = int(time.time())
-        
-        # Determine chat type based on search mode
-        chat_type = "search" if search_enabled else "t2t"
-        sub_chat_type = "search" if search_enabled else "t2t"
-        
-        # Build payload matching Qwen's format
-        payload = {
-            "stream": stream,
-            "incremental_output": True,  # True for streaming output
-            "chat_id": chat_id,
-            "chat_mode": "normal",
-            "model": model,
-            "parent_id": parent_id,
-            "messages": [
-                {
-                    "fid": fid,
-                    "parentId": parent_id,
-                    "childrenIds": [],
-                    "role": "user",
-                    "content": message_content,
-                    "user_action": "chat",
-                    "files": files,  # Include files here
-                    "timestamp": timestamp,
-                    "models": [model],
-                    "chat_type": chat_type,
-                    "feature_config": {
-                        "thinking_enabled": thinking_enabled,  # Enable/disable thinking
-                        "output_schema": "phase"
-                    },
-                    "extra": {
-                        "meta": {
-                            "subChatType": sub_chat_type
-                        }
-                    },
-                    "sub_chat_type": sub_chat_type,
-                    "parent_id": parent_id
-                }
-            ],
-            "timestamp": timestamp,
-            "size": "1:1"
-        }
+            parent_id = self.tip_cache.get(chat_id)
+            from_cache = parent_id is not None
+            if not from_cache:
+                parent_id = self._fetch_current_id(chat_id)
         
-        if stream:
-            return self._send_message_stream(chat_id, payload)
-        else:
-            response = self.session.post(
-                f"{self.BASE_URL}/v2/chat/completions?chat_id={chat_id}",
-                json=payload
+        def stream(parent):
+            payload = build_message_payload(
+                chat_id, message, model, parent, True,
+                system_prompt, thinking_enabled, search_enabled
             )
-            response.raise_for_status()
-            return response.json()
+            deltas = self._stream_completion(chat_id, payload)
+            if use_cache:
+                deltas = self._record_answer(deltas, key)
+            return deltas
+        
+        deltas = stream(parent_id)
+        if from_cache:
+            try:
+                first = next(deltas)
+            except (CompletionRejected, requests.HTTPError) as e:
+                if not _is_parent_conflict(e):
+                    raise
+                # Stale tip (e.g. the chat moved on elsewhere): retry from history
+                self.tip_cache.invalidate(chat_id, conflict=True)
+                deltas = stream(self._fetch_current_id(chat_id))
+            else:
+                yield first
+        
+        yield from deltas
     
-    def _send_message_stream(self, chat_id: str, payload: Dict):
-        """Handle streaming response"""
+    def _record_answer(self, deltas: Iterator[StreamDelta], key: str) -> Iterator[StreamDelta]:
+        """Pass deltas through and cache the answer once the stream has finished"""
+        recorder = StreamRecorder()
+        for delta in deltas:
+            recorder.add(delta)
+            yield delta
+        answer = recorder.answer()
+        if answer is not None:
+            self.response_cache.put(key, answer)
+    
+    def _fetch_current_id(self, chat_id: str) -> Optional[str]:
+        """Read the chat's latest message ID from its history"""
+        try:
+            chat_data = self.get_chat_history(chat_id)
+            if chat_data.get("success") and chat_data.get("data"):
+                return chat_data["data"].get("currentId")
+        except:
+            # For new chats, parent_id should be null
+            pass
+        return None
+    
+    def _stream_completion(self, chat_id: str, payload: Dict) -> Iterator[StreamDelta]:
+        """Post a streaming completion and yield StreamDelta objects"""
         # Add headers for streaming
         headers = self.session.headers.copy()
-        headers.update({
-            "Accept": "text/event-stream",
-            "x-accel-buffering": "no",
-            "source": "web"
-        })
+        headers.update(STREAM_HEADERS)
         
         response = self.session.post(
             f"{self.BASE_URL}/v2/chat/completions?chat_id={chat_id}",
@@ -276,87 +847,30 @@ class QwenClient:
         )
         response.raise_for_status()
         
-        # Ensure UTF-8 encoding
-        response.encoding = 'utf-8'
-        
-        client = sseclient.SSEClient(response)
-        full_response = ""
-        thinking_content = ""
-        last_printed_length = 0
-        last_thinking_length = 0
-        
-        for event in client.events():
-            if event.data == "[DONE]":
-                break
-            try:
-                # Properly decode JSON with UTF-8
-                data = json.loads(event.data, strict=False)
-                
-                # Qwen format: check for content in different structures
-                content = None
-                reasoning = None
-                
-                if "output" in data:
-                    content = data["output"].get("text", "")
-                    reasoning = data["output"].get("reasoning", "")
-                elif "choices" in data and len(data["choices"]) > 0:
-                    choice = data["choices"][0]
-                    
-                    # Delta format (streaming)
-                    if "delta" in choice:
-                        delta = choice["delta"]
-                        content = delta.get("content", "")
-                        reasoning = delta.get("reasoning_content", "")
-                    
-                    # Message format (final)
-                    elif "message" in choice:
-                        msg = choice["message"]
-                        content = msg.get("content", "")
-                        reasoning = msg.get("reasoning_content", "")
-                
-                elif "content" in data:
-                    content = data.get("content", "")
-                    reasoning = data.get("reasoning_content", "")
-                
-                # Handle thinking/reasoning content
-                if reasoning:
-                    if isinstance(reasoning, bytes):
-                        reasoning = reasoning.decode('utf-8', errors='replace')
-                    
-                    thinking_content = reasoning
-                    
-                    # Print thinking content (in different color if possible)
-                    if len(thinking_content) > last_thinking_length:
-                        new_thinking = thinking_content[last_thinking_length:]
-                        print(f"\n💭 [Thinking: {new_thinking[:100]}...]", end="", flush=True)
-                        last_thinking_length = len(thinking_content)
-                
-                # Handle regular content
-                if content:
-                    # Ensure content is properly decoded UTF-8
-                    if isinstance(content, bytes):
-                        content = content.decode('utf-8', errors='replace')
-                    
-                    # With incremental_output=True, each event contains only new content
-                    full_response += content
-                    
-                    # Print the new content directly
-                    print(content, end="", flush=True)
-                        
-            except json.JSONDecodeError:
-                continue
-            except Exception as e:
-                # Log but continue
-                print(f"\n[Parse error: {e}]", end="", flush=True)
-                continue
+        if 'application/json' in response.headers.get('Content-Type', ''):
+            body = response.text
+            response.close()
+            raise CompletionRejected(f"Completion rejected: {body[:500]}")
         
-        print()  # New line after streaming
+        parser = CompletionStreamParser()
+        tip = None
         
-        result = {"content": full_response}
-        if thinking_content:
-            result["thinking"] = thinking_content
+        try:
+            for event in iter_events(response_chunks(response)):
+                if event.data == "[DONE]":
+                    break
+                deltas = parser.feed(event.data)
+                if parser.response_id != tip:
+                    # The answer is the new tip of the conversation as soon as
+                    # upstream creates it, even if the stream is not read to the end
+                    tip = parser.response_id
+                    self.tip_cache.update(chat_id, tip)
+                for delta in deltas:
+                    yield delta
+        finally:
+            response.close()
         
-        return result
+        yield parser.done()
     
     def get_chat_history(self, chat_id: str) -> Dict:
         """
@@ -365,9 +879,7 @@ class QwenClient:
         Args:
             chat_id: Chat conversation ID
         """
-        response = self.session.get(f"{self.BASE_URL}/v2/chats/{chat_id}")
-        response.raise_for_status()
-        return response.json()
+        return self._get_json(f"/v2/chats/{chat_id}")
     
     def delete_chat(self, chat_id: str) -> bool:
         """
@@ -380,6 +892,13 @@ class QwenClient:
         response.raise_for_status()
         return True
     
+    def latest_chat_id(self) -> Optional[str]:
+        """Return the ID of the most recent chat, or None if there are none"""
+        chats = self.list_chats(page=1)
+        if chats.get("success") and chats.get("data") and len(chats["data"]) > 0:
+            return chats["data"][0]["id"]
+        return None
+    
     def chat(self, message: str, model: str = "qwen3-max", chat_id: Optional[str] = None) -> str:
         """
         Quick chat - sends message to existing or new chat
@@ -387,32 +906,20 @@ class QwenClient:
         Args:
             message: Message to send
             model: Model name (qwen-max, qwen3-max, qwen-plus, qwen-turbo)
-            chat_id: Optional existing chat ID. If None, lists chats to find one or asks user
+            chat_id: Optional existing chat ID. If None, the most recent chat is used
         
         Returns:
             AI response text
         """
-        try:
-            # If no chat_id provided, try to get from existing chats
+        # If no chat_id provided, try to get from existing chats
+        if not chat_id:
+            chat_id = self.latest_chat_id()
             if not chat_id:
-                chats = self.list_chats(page=1)
-                if chats.get("success") and chats.get("data") and len(chats["data"]) > 0:
-                    # Use the most recent chat
-                    chat_id = chats["data"][0]["id"]
-                    print(f"Using existing chat: {chat_id[:16]}...")
-                else:
-                    print("No existing chats found. Please create a chat on web first or provide chat_id.")
-                    print("Visit https://chat.qwen.ai to create a new chat, then run:")
-                    print("  python qwen_client.py --list-chats")
-                    return ""
-            
-            # Send message
-            response = self.send_message(chat_id, message, model=model, stream=True)
-            return response.get("content", "")
-            
-        except Exception as e:
-            print(f"\nError: {e}")
-            raise
+                raise ValueError("No existing chats found. Create a chat on https://chat.qwen.ai first or provide chat_id.")
+        
+        # Send message
+        response = self.send_message(chat_id, message, model=model, stream=True)
+        return response.get("content", "")
     
     def get_sts_token(self, filename: str, filesize: int, filetype: str = "image") -> Dict:
         """
@@ -437,129 +944,200 @@ class QwenClient:
         response.raise_for_status()
         return response.json()
     
-    def upload_file_to_oss(self, file_path: str, sts_data: Dict) -> str:
+    def upload_file_to_oss(self, file_path, sts_data: Dict,
+                           progress_callback: Optional[Callable[[int, int], None]] = None,
+                           size: Optional[int] = None) -> str:
         """
         Upload file to Alibaba OSS using STS credentials
         
         Args:
-            file_path: Path to the file to upload
+            file_path: Path to the file to upload, or a binary file-like object
             sts_data: STS token data from get_sts_token()
+            progress_callback: Called with (bytes_sent, total_bytes) during the upload
+            size: Bytes to read from a file-like object
         
         Returns:
             URL of the uploaded file
         """
-        try:
-            import oss2
-            from oss2 import StsAuth
-        except ImportError:
-            raise ImportError("oss2 package required. Install with: pip install oss2")
-        
-        # Create auth with STS credentials
-        auth = StsAuth(
-            sts_data['access_key_id'],
-            sts_data['access_key_secret'],
-            sts_data['security_token']
-        )
-        
-        # Create bucket instance
-        endpoint = f"https://{sts_data['endpoint']}"
-        bucket = oss2.Bucket(auth, endpoint, sts_data['bucketname'])
-        
-        # Upload file
-        with open(file_path, 'rb') as f:
-            bucket.put_object(sts_data['file_path'], f)
-        
-        # Return the file URL (use pre-signed URL from response)
-        file_url = sts_data.get('file_url', f"https://{sts_data['bucketname']}.{sts_data['endpoint']}/{sts_data['file_path']}")
-        return file_url
+        return put_object_to_oss(file_path, sts_data, progress_callback, size)
     
-    def upload_file(self, file_path: str, filetype: str = None) -> Dict:
+    def upload_file(self, file, filetype: str = None,
+                    progress_callback: Optional[Callable[[int, int], None]] = None,
+                    filename: Optional[str] = None, size: Optional[int] = None,
+                    sha256: Optional[str] = None) -> Dict:
         """
         Complete file upload flow: get STS token, upload to OSS, return metadata
         
+        Large files (oss_upload.MULTIPART_THRESHOLD and up) are uploaded in
+        parallel parts. If such an upload fails, calling upload_file again for
+        the same unchanged file resumes it with the same STS upload target.
+        
+        file can also be bytes or a binary file-like object such as an HTTP
+        request body. It is streamed to OSS as it is read, without a temp
+        file; streams cannot resume a failed upload.
+        
+        Content this account uploaded before is not uploaded again: the
+        metadata of the earlier upload is returned from upload_cache while its
+        URL is still valid. Images may be downscaled and re-encoded by
+        image_preprocessor first, which changes the uploaded name and size.
+        
         Args:
-            file_path: Path to the file to upload
+            file: Path to the file to upload, bytes, or a binary file-like object
             filetype: Type of file ("image" or "file"). Auto-detected if None.
+            progress_callback: Called with (bytes_sent, total_bytes) during the upload
+            filename: Name to upload a stream as (default: its name attribute)
+            size: Bytes to read from a stream (required if it is not seekable)
+            sha256: Hex SHA-256 of the content, if known; lets a stream that
+                cannot be rewound be found in upload_cache without reading it
         
         Returns:
             Dict with file metadata ready to use in messages
         """
-        from pathlib import Path
-        import mimetypes
-        
-        file_path_obj = Path(file_path)
-        if not file_path_obj.exists():
-            raise FileNotFoundError(f"File not found: {file_path}")
+        return self._upload_file(file, filetype, progress_callback, filename, size, sha256)
+    
+    def _upload_file(self, file, filetype=None, progress_callback=None, filename=None,
+                     size=None, sha256=None, upload_slot=None) -> Dict:
+        """upload_file(); upload_slot, if given, is held only while the object is sent to OSS"""
+        source, filename, filesize = upload_source(file, filename, size)
+        is_path = isinstance(source, (str, os.PathLike))
         
-        # Get file info
-        filename = file_path_obj.name
-        filesize = file_path_obj.stat().st_size
+        # Skip the upload entirely if this account already uploaded the same bytes
+        scope = digest = hasher = None
+        if self.upload_cache:
+            scope = token_scope(self.auth_token)
+            digest = self.upload_cache.source_digest(source)
+            cached = self.upload_cache.get(scope, digest or sha256) if digest or sha256 else None
+            if cached:
+                # Keep the extension of what was uploaded (it may have been re-encoded)
+                return dict(cached, name=os.path.splitext(filename)[0] + os.path.splitext(cached['name'])[1])
+            if digest is None:
+                # Hashed while it is uploaded, for the next time
+                source = hasher = HashingReader(source)
         
         # Auto-detect filetype if not provided
-        if filetype is None:
-            mime_type, _ = mimetypes.guess_type(file_path)
-            if mime_type and mime_type.startswith('image/'):
-                filetype = "image"
-            else:
-                filetype = "file"
+        detected_type, mime_type = detect_filetype(filename)
+        filetype = filetype or detected_type
         
-        # Get STS token
-        sts_response = self.get_sts_token(filename, filesize, filetype)
+        # Downscale photos before upload; cached under the original's digest above
+        if self.image_preprocessor and detected_type == "image":
+            source, filename, filesize, mime_type = self.image_preprocessor.prepare(
+                source, filename, filesize, mime_type
+            )
+            is_path = isinstance(source, (str, os.PathLike))
         
-        # Extract data from response
-        if sts_response.get('success'):
-            sts_data = sts_response['data']
-        else:
-            raise Exception(f"Failed to get STS token: {sts_response}")
+        # Reuse the upload target of an interrupted multipart upload
+        identity = file_identity(source) if is_path and filesize >= MULTIPART_THRESHOLD else None
+        sts_data = upload_sessions.load(identity) if identity else None
+        
+        if sts_data is None:
+            # Get STS token
+            sts_response = self.get_sts_token(filename, filesize, filetype)
+            
+            # Extract data from response
+            if sts_response.get('success'):
+                sts_data = sts_response['data']
+            else:
+                raise Exception(f"Failed to get STS token: {sts_response}")
+            
+            if identity:
+                upload_sessions.save(identity, sts_data)
         
         # Upload to OSS
-        file_url = self.upload_file_to_oss(file_path, sts_data)
-        
-        # Prepare file metadata
-        mime_type, _ = mimetypes.guess_type(file_path)
-        file_class = "vision" if filetype == "image" else "document"
-        
-        return {
-            "type": filetype,
-            "id": sts_data['file_id'],
-            "url": file_url,
-            "name": filename,
-            "size": filesize,
-            "file_type": mime_type or "application/octet-stream",
-            "file_class": file_class,
-            "status": "uploaded"
-        }
+        with upload_slot or contextlib.nullcontext():
+            file_url = self.upload_file_to_oss(source, sts_data, progress_callback, filesize)
+        if identity:
+            upload_sessions.discard(identity)
+        
+        metadata = build_file_metadata(sts_data, file_url, filename, filesize, filetype, mime_type)
+        if scope:
+            self.upload_cache.put(scope, digest or hasher.hexdigest(), metadata)
+        return metadata
+    
+    def upload_files(self, files: List, max_concurrency: Optional[int] = None,
+                     prefetch: Optional[int] = None) -> List[Dict]:
+        """
+        Upload several files at once
+        
+        Up to max_concurrency files are sent to OSS at a time. STS tokens are
+        single-use (each names the object it may write), so instead of being
+        shared they are fetched ahead: up to prefetch further files get their
+        token while earlier files are still uploading, and start sending as
+        soon as an upload slot frees up.
+        
+        Args:
+            files: List of file paths or (filename, data[, size]) tuples, see upload_item
+            max_concurrency: Files in flight at once (default QWEN_UPLOAD_CONCURRENCY)
+            prefetch: Files whose STS token is fetched ahead of a free upload
+                slot (default QWEN_UPLOAD_STS_PREFETCH, 0 = fetch on demand)
+        
+        Returns:
+            File metadata for each file, in input order
+        
+        Raises:
+            UploadFailed: if any file failed; lists every failure
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        
+        if not files:
+            return []
+        
+        workers = max(1, min(max_concurrency or UPLOAD_CONCURRENCY, len(files)))
+        prefetch = STS_PREFETCH if prefetch is None else max(0, prefetch)
+        slots = threading.BoundedSemaphore(workers)
+        
+        # Threads beyond the upload slots prepare files and fetch their tokens early
+        threads = min(workers + prefetch, len(files))
+        with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="qwen-upload") as pool:
+            items = [upload_item(item) for item in files]
+            futures = [pool.submit(self._upload_file, upload_slot=slots, **item) for item in items]
+        
+        uploaded, failures = [], []
+        for index, (item, future) in enumerate(zip(items, futures)):
+            error = future.exception()
+            if error is None:
+                uploaded.append(future.result())
+            else:
+                name = item.get("filename") or item["file"]
+                failures.append({"index": index, "file": name, "error": str(error)})
+        
+        if failures:
+            raise UploadFailed(failures, uploaded)
+        return uploaded
     
     def chat_with_files(
         self,
         message: str,
-        files: List[str] = None,
+        files: List = None,
         chat_id: Optional[str] = None,
         model: str = "qwen3-max",
         stream: bool = True,
-        thinking_enabled: bool = False
+        thinking_enabled: bool = False,
+        max_concurrency: Optional[int] = None
     ) -> str:
         """
         Send a chat message with file attachments
         
         Args:
             message: The message text
-            files: List of file paths to upload and attach
+            files: File paths or (filename, data[, size]) tuples to upload and attach
             chat_id: Existing chat ID or None for new chat
             model: Model to use
             stream: Whether to stream the response
             thinking_enabled: Enable thinking mode
+            max_concurrency: Files uploaded at once (default QWEN_UPLOAD_CONCURRENCY)
         
         Returns:
             The AI's response text
+        
+        Raises:
+            UploadFailed: if any attachment failed to upload
         """
         # Upload files if provided
         file_metadata = []
         if files:
-            for file_path in files:
-                print(f"Uploading {file_path}...")
-                metadata = self.upload_file(file_path)
-                file_metadata.append(metadata)
+            print(f"Uploading {len(files)} file(s)...")
+            file_metadata = self.upload_files(files, max_concurrency)
+            for metadata in file_metadata:
                 print(f"✓ Uploaded: {metadata['name']}")
         
         # Create or use existing chat
@@ -637,9 +1215,23 @@ def main():
             # Send message
             message = " ".join(sys.argv[1:])
             print(f"You: {message}\n")
-            print("AI: ", end="")
             try:
-                response = client.chat(message)
+                chat_id = client.latest_chat_id()
+                if not chat_id:
+                    print("No existing chats found. Please create a chat on web first.")
+                    print("Visit https://chat.qwen.ai to create a new chat, then run:")
+                    print("  python qwen_client.py --list-chats")
+                    return
+                
+                print(f"Using existing chat: {chat_id[:16]}...\n")
+                print("AI: ", end="")
+                for delta in client.stream_message(chat_id, message):
+                    if delta.type == "reasoning":
+                        print(f"\n💭 [Thinking: {delta.content[:100]}...]", end="", flush=True)
+                    elif delta.type == "phase" and delta.phase == "answer":
+                        print("\n")
+                    elif delta.type == "content":
+                        print(delta.content, end="", flush=True)
                 print()
             except Exception as e:
                 print(f"\nError: {e}")
@@ -4,10 +4,87 @@ This is the official and recommended way to use Qwen models
 """
 
 import requests
-import json
-from typing import Optional, Dict, List, Generator
+from typing import Optional, Dict, List, Iterable, Iterator, Callable
+import math
+import os
 import sys
 
+from sse_parser import TextAccumulator, iter_events, json_loads, response_chunks
+
+# Estimated prompt tokens of history a Conversation sends per request
+HISTORY_TOKEN_BUDGET = int(os.getenv("QWEN_OFFICIAL_HISTORY_TOKENS", "6000"))
+# Model and length of the rolling summary of turns dropped from a Conversation
+SUMMARY_MODEL = os.getenv("QWEN_OFFICIAL_SUMMARY_MODEL", "qwen-turbo")
+SUMMARY_MAX_TOKENS = int(os.getenv("QWEN_OFFICIAL_SUMMARY_TOKENS", "400"))
+
+SUMMARY_PROMPT = (
+    "You keep the memory of a long tutoring chat. Merge the earlier summary and the new "
+    "messages into one short summary: the learner's goals and level, facts and names "
+    "mentioned, what was explained, and open questions. Write in the language of the chat."
+)
+
+
+def message_text(content) -> str:
+    """Text of a message content: a string, or a list of parts (multimodal models)"""
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content or ""
+
+
+def estimate_tokens(text) -> int:
+    """
+    Rough token count of a text or message content, without a tokenizer
+    
+    ASCII text averages about four characters per token; kana, kanji and
+    other non-ASCII characters are counted as a token each. That overcounts
+    accented Latin text (Vietnamese) a little, which is the safe side for a
+    budget.
+    """
+    text = message_text(text)
+    non_ascii = len(text) - len(text.encode("ascii", "ignore"))
+    return math.ceil((len(text) - non_ascii) / 4) + non_ascii
+
+
+def message_tokens(message: Dict) -> int:
+    """estimate_tokens() of a message plus its role/formatting overhead"""
+    return estimate_tokens(message.get("content")) + 4
+
+
+def stream_deltas(events: Iterable[Dict], incremental: bool = True) -> Iterator[str]:
+    """
+    New text from the events of a DashScope stream
+    
+    With incremental_output the content of every event is only the new
+    text. Without it every event repeats the whole answer so far, and only
+    the part past the length already seen is new. Either way each delta is
+    produced once, in time proportional to its own length.
+    
+    Args:
+        events: Parsed data fields of the stream
+        incremental: Whether the request set incremental_output
+    """
+    seen = 0
+    for data in events:
+        output = data.get("output")
+        if not output:
+            if data.get("code"):
+                raise Exception(f"API Error: {data}")
+            continue
+        
+        choices = output.get("choices")
+        if choices:
+            content = message_text(choices[0].get("message", {}).get("content"))
+        else:
+            # result_format=text
+            content = output.get("text") or ""
+        
+        if incremental:
+            if content:
+                yield content
+        elif len(content) > seen:
+            yield content[seen:]
+            seen = len(content)
+
 
 class QwenOfficialClient:
     """Client for Qwen Official API (DashScope)"""
@@ -45,6 +122,7 @@ class QwenOfficialClient:
             message: User message
             model: Model name (qwen-max, qwen-plus, qwen-turbo, etc.)
             history: Chat history as list of {"role": "user/assistant", "content": "..."}
+                (sent in full and not modified; use conversation() for long chats)
             stream: Enable streaming
             temperature: Sampling temperature (0-2)
             top_p: Nucleus sampling parameter (0-1)
@@ -53,10 +131,88 @@ class QwenOfficialClient:
         Returns:
             AI response text
         """
-        messages = history if history else []
-        messages.append({"role": "user", "content": message})
+        messages = list(history or []) + [{"role": "user", "content": message}]
+        payload = self._chat_payload(messages, model, temperature, top_p, max_tokens)
         
-        payload = {
+        if stream:
+            payload["parameters"]["incremental_output"] = True
+            return self._chat_stream(payload)
+        else:
+            return self._chat_sync(payload)
+    
+    def stream_chat(
+        self,
+        message: str,
+        model: str = "qwen-max",
+        history: Optional[List[Dict]] = None,
+        temperature: float = 0.7,
+        top_p: float = 0.8,
+        max_tokens: int = 1500,
+        incremental: bool = True
+    ) -> Iterator[str]:
+        """
+        Send a chat message and yield the answer as it is generated
+        
+        Args are those of chat(), plus:
+            incremental: Request incremental_output; without it the API
+                repeats the whole answer in every event (the yielded deltas
+                are the same either way)
+        
+        Yields:
+            New text of the answer
+        """
+        messages = list(history or []) + [{"role": "user", "content": message}]
+        payload = self._chat_payload(messages, model, temperature, top_p, max_tokens)
+        payload["parameters"]["incremental_output"] = incremental
+        return self._stream_deltas(payload)
+    
+    def conversation(self, system_prompt: Optional[str] = None, model: str = "qwen-max",
+                     max_history_tokens: int = HISTORY_TOKEN_BUDGET,
+                     summarize: bool = False) -> "Conversation":
+        """
+        Multi-turn chat whose request size stays within a token budget
+        
+        Args:
+            system_prompt: Optional system prompt, always sent
+            model: Model of the conversation
+            max_history_tokens: Estimated tokens of earlier turns sent per request
+            summarize: Fold turns that no longer fit into a rolling summary
+                (one extra SUMMARY_MODEL call each time turns are dropped)
+        """
+        return Conversation(
+            self,
+            system_prompt=system_prompt,
+            model=model,
+            max_history_tokens=max_history_tokens,
+            summarizer=self.summarize_messages if summarize else None
+        )
+    
+    def summarize_messages(self, summary: str, messages: List[Dict],
+                           model: str = SUMMARY_MODEL, max_tokens: int = SUMMARY_MAX_TOKENS) -> str:
+        """
+        Rolling summary: the earlier summary updated with messages
+        
+        Args:
+            summary: Summary so far ("" for none)
+            messages: Turns being dropped from the conversation, oldest first
+        """
+        lines = [f"Earlier summary:\n{summary}\n" if summary else "", "New messages:"]
+        for msg in messages:
+            lines.append(f"{msg['role']}: {message_text(msg.get('content'))}")
+        
+        payload = self._chat_payload(
+            [
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": "\n".join(lines).strip()}
+            ],
+            model, temperature=0.3, top_p=0.8, max_tokens=max_tokens
+        )
+        return self._chat_sync(payload).strip()
+    
+    def _chat_payload(self, messages: List[Dict], model: str,
+                      temperature: float, top_p: float, max_tokens: int) -> Dict:
+        """Request body of a text chat"""
+        return {
             "model": model,
             "input": {
                 "messages": messages
@@ -68,12 +224,6 @@ class QwenOfficialClient:
                 "result_format": "message"
             }
         }
-        
-        if stream:
-            payload["parameters"]["incremental_output"] = True
-            return self._chat_stream(payload)
-        else:
-            return self._chat_sync(payload)
     
     def _chat_sync(self, payload: Dict) -> str:
         """Synchronous chat"""
@@ -89,37 +239,40 @@ class QwenOfficialClient:
         
         raise Exception(f"API Error: {result}")
     
-    def _chat_stream(self, payload: Dict) -> str:
-        """Streaming chat"""
+    def _stream_events(self, payload: Dict) -> Iterator[Dict]:
+        """Post a streaming request and yield the parsed data of each event"""
         response = self.session.post(
             f"{self.BASE_URL}/services/aigc/text-generation/generation",
             json=payload,
+            headers={"X-DashScope-SSE": "enable", "Accept": "text/event-stream"},
             stream=True
         )
         response.raise_for_status()
         
-        full_response = ""
-        for line in response.iter_lines():
-            if line:
-                line = line.decode('utf-8')
-                if line.startswith('data:'):
-                    try:
-                        data = json.loads(line[5:])
-                        if data.get("output"):
-                            choices = data["output"].get("choices", [])
-                            if choices:
-                                content = choices[0]["message"]["content"]
-                                if content:
-                                    # Print incremental content
-                                    if len(content) > len(full_response):
-                                        new_content = content[len(full_response):]
-                                        print(new_content, end="", flush=True)
-                                    full_response = content
-                    except json.JSONDecodeError:
-                        continue
+        try:
+            for event in iter_events(response_chunks(response)):
+                try:
+                    yield json_loads(event.data)
+                except ValueError:
+                    continue
+        finally:
+            response.close()
+    
+    def _stream_deltas(self, payload: Dict) -> Iterator[str]:
+        """Text deltas of a streaming request"""
+        incremental = payload["parameters"].get("incremental_output", False)
+        return stream_deltas(self._stream_events(payload), incremental)
+    
+    def _chat_stream(self, payload: Dict) -> str:
+        """Streaming chat"""
+        full_response = TextAccumulator()
+        for delta in self._stream_deltas(payload):
+            # Print incremental content
+            print(delta, end="", flush=True)
+            full_response.append(delta)
         
         print()  # New line
-        return full_response
+        return full_response.getvalue()
     
     def chat_multimodal(
         self,
@@ -164,6 +317,142 @@ class QwenOfficialClient:
             return self._chat_sync(payload)
 
 
+class Conversation:
+    """
+    History of a multi-turn chat with QwenOfficialClient, bounded by tokens
+    
+    Every request sends the system prompt, the summary of dropped turns (if
+    any), as many recent turns as fit in max_history_tokens and the new
+    message. Token counts come from estimate_tokens() and are kept per
+    message, so fitting the history costs nothing per request. When the
+    history outgrows the budget the oldest turns are dropped down to
+    low_water of it, so turns (and summary calls) are dropped in batches
+    rather than one per message.
+    
+    A turn is recorded once its answer is complete; a failed request leaves
+    the history as it was.
+    """
+    
+    def __init__(self, client: QwenOfficialClient, system_prompt: Optional[str] = None,
+                 model: str = "qwen-max", max_history_tokens: int = HISTORY_TOKEN_BUDGET,
+                 summarizer: Optional[Callable[[str, List[Dict]], str]] = None,
+                 low_water: float = 0.6):
+        """
+        Args:
+            client: Client that sends the requests
+            system_prompt: Optional system prompt, always sent
+            model: Model name
+            max_history_tokens: Estimated tokens of turns and summary sent per request
+            summarizer: summarizer(summary, dropped_messages) -> new summary;
+                None drops old turns without a trace
+            low_water: Fraction of max_history_tokens kept after dropping turns
+        """
+        self.client = client
+        self.system_prompt = system_prompt
+        self.model = model
+        self.max_history_tokens = max_history_tokens
+        self.summarizer = summarizer
+        self.low_water = low_water
+        self.summary = ""
+        self.messages = []        # user/assistant messages still sent, oldest first
+        self._tokens = []         # message_tokens() of each message
+        self._history_tokens = 0
+        self.dropped = 0
+    
+    def send(self, message: str, stream: bool = True, **params) -> str:
+        """
+        Ask the next question; returns the answer (printed as it streams if stream)
+        
+        params are passed to the request: temperature, top_p, max_tokens.
+        """
+        payload = self._payload(message, params)
+        if stream:
+            payload["parameters"]["incremental_output"] = True
+            answer = self.client._chat_stream(payload)
+        else:
+            answer = self.client._chat_sync(payload)
+        self._record(message, answer)
+        return answer
+    
+    def stream(self, message: str, **params) -> Iterator[str]:
+        """Ask the next question and yield the answer as it is generated"""
+        payload = self._payload(message, params)
+        payload["parameters"]["incremental_output"] = True
+        answer = TextAccumulator()
+        for delta in self.client._stream_deltas(payload):
+            answer.append(delta)
+            yield delta
+        self._record(message, answer.getvalue())
+    
+    def build_messages(self, message: str) -> List[Dict]:
+        """Messages sent for the next question (the history itself is not changed)"""
+        messages = []
+        system = self.system_prompt or ""
+        if self.summary:
+            system = f"{system}\n\nSummary of the earlier conversation:\n{self.summary}".strip()
+        if system:
+            messages.append({"role": "system", "content": system})
+        messages.extend(self.messages)
+        messages.append({"role": "user", "content": message})
+        return messages
+    
+    def history_tokens(self) -> int:
+        """Estimated tokens of the turns and summary that will be sent"""
+        return self._history_tokens + (estimate_tokens(self.summary) if self.summary else 0)
+    
+    def clear(self):
+        self.summary = ""
+        self.messages = []
+        self._tokens = []
+        self._history_tokens = 0
+    
+    def _payload(self, message: str, params: Dict) -> Dict:
+        return self.client._chat_payload(
+            self.build_messages(message),
+            self.model,
+            temperature=params.get("temperature", 0.7),
+            top_p=params.get("top_p", 0.8),
+            max_tokens=params.get("max_tokens", 1500)
+        )
+    
+    def _record(self, message: str, answer: str):
+        for msg in ({"role": "user", "content": message}, {"role": "assistant", "content": answer}):
+            tokens = message_tokens(msg)
+            self.messages.append(msg)
+            self._tokens.append(tokens)
+            self._history_tokens += tokens
+        if self.history_tokens() > self.max_history_tokens:
+            self._trim()
+    
+    def _trim(self):
+        """Drop the oldest turns down to low_water of the budget, folding them into the summary"""
+        target = self.max_history_tokens * self.low_water
+        if self.summary:
+            target -= estimate_tokens(self.summary)
+        
+        cut = 0
+        remaining = self._history_tokens
+        # Whole turns go, so the history never starts with an answer
+        while cut < len(self.messages) and remaining > target:
+            remaining -= sum(self._tokens[cut:cut + 2])
+            cut += 2
+        if not cut:
+            return
+        
+        dropped = self.messages[:cut]
+        self.messages = self.messages[cut:]
+        self._tokens = self._tokens[cut:]
+        self._history_tokens = remaining
+        self.dropped += cut
+        
+        if self.summarizer:
+            try:
+                self.summary = self.summarizer(self.summary, dropped)
+            except Exception as e:
+                # The turns are gone either way; the old summary is kept
+                print(f"⚠️  Conversation summary failed: {e}")
+
+
 def main():
     """Example usage"""
     import os
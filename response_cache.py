@@ -0,0 +1,145 @@
+"""
+Opt-in cache of chat answers for repeated prompts
+
+Tooling that asks the same thing over and over ("explain this grammar
+point" with the same system prompt and model) pays for a full completion
+every time. ResponseCache maps a normalized hash of the prompt (model,
+system prompt, message, attached files, thinking and search flags) to the
+recorded answer, which the clients replay as a synthetic stream.
+
+Keys are scoped per token (upload_cache.token_scope), so one account never
+replays another's answers. The chat and the earlier turns are not part of
+the key: the same prompt asked again, in the same chat or a new one, is
+answered from the cache even if the conversation has moved on since.
+
+Search-enabled requests are never cached: their answers depend on the day's
+results. A replayed answer is not posted to the chat, so the conversation
+upstream does not record that turn.
+
+Storage reuses the upload_cache backends: MemoryBackend (per process),
+SQLiteBackend (shared by the workers of one host) or FileBackend.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+import unicodedata
+from typing import Dict, Optional
+
+from upload_cache import FileBackend, MemoryBackend, SQLiteBackend
+
+# Seconds a recorded answer is replayed
+RESPONSE_CACHE_TTL = float(os.getenv("QWEN_RESPONSE_CACHE_TTL", "86400"))
+
+
+def normalize_prompt(text: Optional[str]) -> str:
+    """Prompt text as compared by the cache: NFC, LF line ends, no trailing spaces"""
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFC", text).replace("\r\n", "\n").replace("\r", "\n")
+    return "\n".join(line.rstrip() for line in text.strip().split("\n"))
+
+
+def response_key(scope: str, model: str, system_prompt: Optional[str], message,
+                 thinking_enabled: bool, search_enabled: bool) -> str:
+    """
+    Cache key of a chat request
+    
+    Args:
+        scope: Account the answer is kept for (upload_cache.token_scope)
+        message: Message text, or a message dict with "content" and "files"
+    """
+    if isinstance(message, dict):
+        content = message.get("content", "")
+        files = message.get("files") or []
+    else:
+        content = message
+        files = []
+    
+    request = {
+        "scope": scope,
+        "model": model,
+        "system_prompt": normalize_prompt(system_prompt),
+        "message": normalize_prompt(content),
+        "files": [f.get("id") or f.get("url") for f in files],
+        "thinking_enabled": bool(thinking_enabled),
+        "search_enabled": bool(search_enabled)
+    }
+    encoded = json.dumps(request, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Request key -> recorded answer ({"events": [[type, value], ...], "usage"})"""
+    
+    def __init__(self, backend=None, ttl: float = RESPONSE_CACHE_TTL):
+        """
+        Args:
+            backend: MemoryBackend, SQLiteBackend or FileBackend (default MemoryBackend())
+            ttl: Seconds an answer is replayed before it is asked again
+        """
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.expired = 0
+    
+    def get(self, key: str) -> Optional[Dict]:
+        """Recorded answer for key, or None"""
+        entry = self.backend.get(key)
+        if entry is not None and entry[1] <= time.time():
+            self.backend.delete(key)
+            self.expired += 1
+            entry = None
+        
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0]
+    
+    def put(self, key: str, answer: Dict):
+        self.backend.set(key, answer, time.time() + self.ttl)
+        self.stores += 1
+    
+    def invalidate(self, key: str):
+        self.backend.delete(key)
+    
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self.backend).__name__,
+            "size": len(self.backend),
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "expired": self.expired,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+
+def create_response_cache() -> Optional[ResponseCache]:
+    """
+    ResponseCache configured from the environment
+    
+    QWEN_RESPONSE_CACHE: "off" (default), "memory", "sqlite" or "file"
+    QWEN_RESPONSE_CACHE_PATH: database file or directory for sqlite/file
+    """
+    kind = os.getenv("QWEN_RESPONSE_CACHE", "off").lower()
+    default_path = os.path.join(tempfile.gettempdir(), "qwen_response_cache")
+    path = os.getenv("QWEN_RESPONSE_CACHE_PATH")
+    
+    if kind == "sqlite":
+        return ResponseCache(SQLiteBackend(path or f"{default_path}.sqlite3", table="responses"))
+    if kind == "file":
+        return ResponseCache(FileBackend(path or default_path))
+    if kind == "memory":
+        return ResponseCache(MemoryBackend(int(os.getenv("QWEN_RESPONSE_CACHE_SIZE", "1024"))))
+    return None
+
+
+shared_response_cache = create_response_cache()
@@ -0,0 +1,133 @@
+"""
+Configuration and helpers shared by api_server.py (Flask) and asgi_server.py
+
+Nothing here depends on a web framework or opens connections, so each server
+imports it without building the other one's app, client pool or transport.
+"""
+
+import json
+import os
+
+from qwen_cache import shared_model_cache
+from token_store import TokenStore
+
+# Security: Configure CORS to only allow specific origins
+ALLOWED_ORIGINS = [
+    'https://jlpt4you.com',
+    'https://www.jlpt4you.com',
+    'http://localhost:3000',  # For local development
+    'http://localhost:5000',
+    'http://127.0.0.1:3000',
+    'http://127.0.0.1:5000'
+]
+
+# Security configuration
+ENVIRONMENT = os.getenv('ENVIRONMENT', 'development')  # production, development
+ALLOWED_REFERERS = [
+    'https://jlpt4you.com',
+    'https://www.jlpt4you.com',
+    'http://localhost',
+    'http://127.0.0.1'
+]
+
+# Pool of clients keyed by token. Bounded so unused tokens don't keep
+# sessions and sockets open forever.
+POOL_MAX_CLIENTS = int(os.getenv('QWEN_POOL_MAX_CLIENTS', '64'))
+POOL_TTL = float(os.getenv('QWEN_POOL_TTL', '3600'))
+# Total connections to the Qwen API host, shared by all pooled clients. A
+# request that finds them all busy for QWEN_POOL_TIMEOUT seconds gets a 503.
+POOL_MAX_CONNECTIONS = int(os.getenv('QWEN_POOL_MAX_CONNECTIONS', '256'))
+
+# Refresh pooled clients' tokens shortly before their JWT expires
+TOKEN_REFRESH_MARGIN = float(os.getenv('QWEN_TOKEN_REFRESH_MARGIN', '300'))
+TOKEN_REFRESH_INTERVAL = float(os.getenv('QWEN_TOKEN_REFRESH_INTERVAL', '60'))
+
+# Token storage file (for persistence), kept in memory and reloaded when it changes
+TOKEN_FILE = os.path.join(os.path.dirname(__file__), '.token_storage.json')
+token_store = TokenStore(TOKEN_FILE, check_interval=float(os.getenv('QWEN_TOKEN_FILE_CHECK_INTERVAL', '1')))
+
+
+def load_stored_token():
+    """Load token from the in-memory token store (file is re-read only when it changes)"""
+    return token_store.get()
+
+
+def save_token(token):
+    """Save token to file atomically and update the in-memory copy"""
+    token_store.save(token)
+
+
+def token_refreshed(old_token, new_token):
+    """Keep the stored token in step when the refresher renews it"""
+    if load_stored_token() == old_token:
+        save_token(new_token)
+
+
+def token_from_headers(headers):
+    """
+    Get token from request headers or environment variable
+    Priority: Authorization header, QWEN_TOKEN, stored token file
+    """
+    token = headers.get('Authorization', '').replace('Bearer ', '')
+    if token:
+        return token
+    return os.getenv('QWEN_TOKEN') or load_stored_token() or None
+
+
+def format_sse(event, data):
+    """Format one Server-Sent Events frame"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def progress_reporter(filename, emit):
+    """
+    OSS progress callback that emits {"filename", "uploaded", "total", "percent"}
+    
+    Only whole-percent changes are emitted, so a large upload produces at most
+    about a hundred events.
+    """
+    last = [-1]
+    
+    def callback(consumed, total):
+        percent = int(consumed * 100 / total) if total else 100
+        if percent > last[0]:
+            last[0] = percent
+            emit({"filename": filename, "uploaded": consumed, "total": total, "percent": percent})
+    
+    return callback
+
+
+def upload_failed_response(error, filenames):
+    """Report each attachment that failed to upload, by its original filename"""
+    return {
+        "error": "Some files failed to upload",
+        "failed_files": [
+            {"filename": filenames[f['index']], "error": f['error']}
+            for f in error.failures
+        ],
+        "uploaded": len(error.uploaded)
+    }
+
+
+def catalog_headers(catalog):
+    """
+    HTTP caching headers for a cached model catalog
+    
+    Browsers and CDNs may keep the response until the server-side copy is
+    due for revalidation, and then revalidate with If-None-Match.
+    """
+    headers = {
+        'ETag': catalog.etag,
+        'Cache-Control': f'public, max-age={shared_model_cache.max_age(catalog)}'
+    }
+    if catalog.last_modified:
+        headers['Last-Modified'] = catalog.last_modified
+    return headers
+
+
+def etag_matches(if_none_match, etag):
+    """Check an If-None-Match header against a strong ETag"""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or f'W/{etag}' in tags
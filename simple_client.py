@@ -5,6 +5,8 @@ Simple Qwen Client - No chat_id needed!
 """
 
 import os
+import re
+import time
 import requests
 from typing import Optional
 
@@ -35,6 +37,7 @@ class SimpleQwenClient:
             "Authorization": f"Bearer {self.token}",
             "Content-Type": "application/json"
         }
+        self._models = None          # (names, etag, fresh_until)
     
     def chat(
         self,
@@ -85,14 +88,35 @@ class SimpleQwenClient:
         return data["data"]["content"]
     
     def models(self) -> list:
-        """List available models"""
+        """
+        List available models
+        
+        The list is kept for the server's Cache-Control max-age and then
+        revalidated with If-None-Match, so unchanged lists cost a 304.
+        """
+        headers = dict(self.headers)
+        if self._models:
+            names, etag, fresh_until = self._models
+            if time.time() < fresh_until:
+                return list(names)
+            if etag:
+                headers["If-None-Match"] = etag
+        
         response = requests.get(
             f"{self.api_base}/api/models",
-            headers=self.headers
+            headers=headers
         )
-        response.raise_for_status()
-        data = response.json()
-        return [m["name"] for m in data.get("data", [])]
+        if response.status_code == 304 and self._models:
+            names = self._models[0]
+        else:
+            response.raise_for_status()
+            data = response.json()
+            names = [m["name"] for m in data.get("data", [])]
+        
+        max_age = re.search(r"max-age=(\d+)", response.headers.get("Cache-Control", ""))
+        fresh_until = time.time() + int(max_age.group(1)) if max_age else 0
+        self._models = (names, response.headers.get("ETag"), fresh_until)
+        return list(names)
 
 
 # Convenience function for even simpler usage
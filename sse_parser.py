@@ -0,0 +1,214 @@
+"""
+Incremental Server-Sent Events decoder for the completion stream
+
+SSEDecoder is fed the raw bytes of the response as they come off the
+socket, in chunks of any size, and returns the events completed by each
+chunk. Only the unfinished last line is kept between chunks (as a list of
+pieces, joined once its newline arrives), so a long answer is decoded in
+linear time without copying what was already parsed. Lines are split on
+bytes before decoding, so a UTF-8 character or a CRLF split across two
+chunks is handled.
+
+json_loads() parses event data with orjson when it is installed
+(pip install orjson) and the standard library otherwise; QWEN_JSON_BACKEND
+selects "orjson" or "json" explicitly. TextAccumulator collects the
+streamed answer.
+"""
+
+import json
+import os
+from dataclasses import dataclass
+from typing import AsyncIterator, Iterable, Iterator, List, Optional
+
+# "auto" uses orjson if it is installed
+JSON_BACKEND = os.getenv("QWEN_JSON_BACKEND", "auto").lower()
+# Bytes asked of the socket per read; a read returns what has arrived so far
+SSE_READ_SIZE = int(os.getenv("QWEN_SSE_READ_SIZE", "65536"))
+
+
+def _stdlib_loads(data):
+    return json.loads(data, strict=False)
+
+
+def _load_json_backend():
+    """(name, loads) of the JSON parser selected by QWEN_JSON_BACKEND"""
+    if JSON_BACKEND == "json":
+        return "json", _stdlib_loads
+    try:
+        import orjson
+    except ImportError:
+        if JSON_BACKEND == "orjson":
+            raise ImportError("orjson package required for QWEN_JSON_BACKEND=orjson. Install with: pip install orjson")
+        return "json", _stdlib_loads
+    
+    def orjson_loads(data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # orjson rejects raw control characters in strings, json(strict=False) does not
+            return _stdlib_loads(data)
+    
+    return "orjson", orjson_loads
+
+
+json_backend, json_loads = _load_json_backend()
+
+
+@dataclass
+class SSEEvent:
+    """One dispatched event"""
+    data: str
+    event: str = "message"
+    id: Optional[str] = None
+
+
+class SSEDecoder:
+    """Turn chunks of an event stream into SSEEvent objects"""
+    
+    def __init__(self):
+        self._partial = []       # pieces of the unfinished last line
+        self._data = []          # data lines of the event being read
+        self._event = None
+        self.last_event_id = None
+        self.retry = None
+    
+    def feed(self, chunk: bytes) -> List[SSEEvent]:
+        """Decode one chunk; returns the events it completes"""
+        if b"\n" not in chunk and b"\r" not in chunk:
+            if chunk:
+                self._partial.append(chunk)
+            return []
+        
+        if self._partial:
+            self._partial.append(chunk)
+            chunk = b"".join(self._partial)
+            self._partial = []
+        
+        if b"\r" in chunk:
+            # A trailing CR may be the first half of a CRLF
+            if chunk.endswith(b"\r"):
+                self._partial.append(b"\r")
+                chunk = chunk[:-1]
+            chunk = chunk.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        
+        lines = chunk.split(b"\n")
+        tail = lines.pop()
+        if tail:
+            self._partial.insert(0, tail)
+        
+        events = []
+        for line in lines:
+            event = self._line(line)
+            if event is not None:
+                events.append(event)
+        return events
+    
+    def _line(self, line: bytes) -> Optional[SSEEvent]:
+        if not line:
+            return self._dispatch()
+        if line.startswith(b"data:"):
+            value = line[6:] if line.startswith(b"data: ") else line[5:]
+            self._data.append(value.decode("utf-8", errors="replace"))
+            return None
+        if line.startswith(b":"):
+            return None
+        
+        field, _, value = line.partition(b":")
+        if value.startswith(b" "):
+            value = value[1:]
+        if field == b"data":
+            self._data.append("")
+        elif field == b"event":
+            self._event = value.decode("utf-8", errors="replace")
+        elif field == b"id" and b"\0" not in value:
+            self.last_event_id = value.decode("utf-8", errors="replace")
+        elif field == b"retry" and value.isdigit():
+            self.retry = int(value)
+        return None
+    
+    def _dispatch(self) -> Optional[SSEEvent]:
+        event_type = self._event or "message"
+        self._event = None
+        if not self._data:
+            return None
+        data = self._data[0] if len(self._data) == 1 else "\n".join(self._data)
+        self._data = []
+        return SSEEvent(data, event_type, self.last_event_id)
+    
+    def flush(self) -> List[SSEEvent]:
+        """Events left when the stream ends (an unterminated last line is dropped)"""
+        self._partial = []
+        event = self._dispatch()
+        return [event] if event is not None else []
+
+
+class TextAccumulator:
+    """
+    Append-only text buffer for streamed answers
+    
+    Pieces are joined in blocks of block_size, so building the answer stays
+    linear (unlike `text += piece`) without holding one small string object
+    per token until the end.
+    """
+    
+    def __init__(self, block_size: int = 512):
+        self.block_size = block_size
+        self._blocks = []
+        self._pieces = []
+        self._length = 0
+    
+    def append(self, text: str):
+        self._pieces.append(text)
+        self._length += len(text)
+        if len(self._pieces) >= self.block_size:
+            self._blocks.append("".join(self._pieces))
+            self._pieces = []
+    
+    def getvalue(self) -> str:
+        return "".join(self._blocks + self._pieces)
+    
+    def __len__(self):
+        return self._length
+
+
+def iter_events(chunks: Iterable[bytes]) -> Iterator[SSEEvent]:
+    """SSEEvent objects from an iterable of raw byte chunks"""
+    decoder = SSEDecoder()
+    for chunk in chunks:
+        yield from decoder.feed(chunk)
+    yield from decoder.flush()
+
+
+async def aiter_events(chunks) -> AsyncIterator[SSEEvent]:
+    """SSEEvent objects from an async iterable of raw byte chunks"""
+    decoder = SSEDecoder()
+    async for chunk in chunks:
+        for event in decoder.feed(chunk):
+            yield event
+    for event in decoder.flush():
+        yield event
+
+
+def response_chunks(response, read_size: int = SSE_READ_SIZE,
+                    decode_content: bool = True) -> Iterator[bytes]:
+    """
+    Bytes of a streamed requests response as they arrive
+    
+    read1() returns whatever the socket has (up to read_size) instead of
+    waiting for read_size bytes, so events are not held back on responses
+    without chunked transfer encoding. With decode_content=False the bytes
+    are passed on still gzip/deflate encoded, as a proxy forwards them.
+    """
+    raw = response.raw
+    if not hasattr(raw, "read1"):
+        # urllib3 < 2
+        if decode_content:
+            yield from response.iter_content(chunk_size=None)
+        else:
+            yield from raw.stream(read_size, decode_content=False)
+        return
+    while True:
+        chunk = raw.read1(read_size, decode_content=decode_content)
+        if not chunk:
+            break
+        yield chunk
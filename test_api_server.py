@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""Test api_server and asgi_server routes against a loopback fake Qwen API (no token or network needed)"""
+
+import asyncio
+import io
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeAuthAPI(BaseHTTPRequestHandler):
+    """Answers GET /api/v1/auths/ with a renewed token"""
+    protocol_version = "HTTP/1.1"
+    
+    def do_GET(self):
+        token = self.headers.get("Authorization", "").replace("Bearer ", "")
+        body = json.dumps({"token": f"{token}-renewed", "expires_at": 1900000000}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, *args):
+        pass
+
+
+upstream_server = ThreadingHTTPServer(("127.0.0.1", 0), FakeAuthAPI)
+threading.Thread(target=upstream_server.serve_forever, daemon=True).start()
+os.environ["QWEN_API_URL"] = f"http://127.0.0.1:{upstream_server.server_port}/api"
+
+import api_server  # noqa: E402  (QwenClient reads QWEN_API_URL at import)
+import asgi_server  # noqa: E402
+import server_common  # noqa: E402
+from starlette.testclient import TestClient  # noqa: E402
+
+# Keep the test from overwriting .token_storage.json
+saved_tokens = []
+server_common.token_store.save = saved_tokens.append
+
+
+def test_token_refresh_response():
+    """Both servers answer /api/token/refresh with the new token string and its expiry"""
+    flask_client = api_server.app.test_client()
+    response = flask_client.post("/api/token/refresh", headers={"Authorization": "Bearer flask-token"})
+    assert response.status_code == 200
+    assert response.get_json()["token"] == "flask-token-renewed"
+    assert response.get_json()["expires_at"] == 1900000000
+    
+    with TestClient(asgi_server.app) as asgi_client:
+        response = asgi_client.post("/api/token/refresh", headers={"Authorization": "Bearer asgi-token"})
+    assert response.status_code == 200
+    assert response.json()["token"] == "asgi-token-renewed"
+    assert response.json()["expires_at"] == 1900000000
+    
+    assert saved_tokens == ["flask-token-renewed", "asgi-token-renewed"]
+
+
+def reading_upload(received):
+    """upload_file stub that reads the body stream in chunks, as the OSS SDK does"""
+    def upload_file(client, stream, filetype=None, progress_callback=None, filename=None, size=None, sha256=None):
+        chunks = iter(lambda: stream.read(64 * 1024), b"")
+        received.append((filename, size, isinstance(stream, bytes), b"".join(chunks)))
+        if progress_callback:
+            progress_callback(size, size)
+        return {"id": "file-1", "name": filename}
+    return upload_file
+
+
+def test_raw_body_upload():
+    """A raw request body reaches upload_file as a stream with its Content-Length"""
+    body = os.urandom(300 * 1024)
+    headers = {"Authorization": "Bearer upload-token", "Content-Type": "application/octet-stream",
+               "Content-Length": str(len(body))}
+    received = []
+    
+    original = api_server.QwenClient.upload_file
+    api_server.QwenClient.upload_file = reading_upload(received)
+    try:
+        flask_client = api_server.app.test_client()
+        response = flask_client.post("/api/files/upload?filename=exam.pdf", input_stream=io.BytesIO(body), headers=headers)
+        assert response.status_code == 200 and response.get_json()["data"]["name"] == "exam.pdf"
+        
+        response = flask_client.post("/api/files/upload", input_stream=io.BytesIO(body),
+                                     headers=dict(headers, **{"X-Filename": "notes.pdf", "Accept": "text/event-stream"}))
+        events = response.get_data(as_text=True)
+        assert "event: progress" in events and "event: done" in events and "notes.pdf" in events
+    finally:
+        api_server.QwenClient.upload_file = original
+    
+    read_upload = reading_upload(received)
+    
+    async def upload_file(client, stream, *args, **kwargs):
+        # The body reader blocks on the event loop, so it is read from a worker thread like OSS does
+        return await asyncio.to_thread(read_upload, client, stream, *args, **kwargs)
+    
+    original = asgi_server.AsyncQwenClient.upload_file
+    asgi_server.AsyncQwenClient.upload_file = upload_file
+    try:
+        with TestClient(asgi_server.app) as asgi_client:
+            response = asgi_client.post("/api/files/upload?filename=exam.pdf", content=body, headers=headers)
+        assert response.status_code == 200 and response.json()["data"]["name"] == "exam.pdf"
+    finally:
+        asgi_server.AsyncQwenClient.upload_file = original
+    
+    assert [name for name, *_ in received] == ["exam.pdf", "notes.pdf", "exam.pdf"]
+    for _, size, buffered, data in received:
+        assert size == len(body) and not buffered and data == body
+
+
+def test_asgi_without_flask():
+    """asgi_server imports the shared helpers without building the Flask app"""
+    import subprocess
+    import sys
+    
+    code = "import sys, asgi_server; print('api_server' in sys.modules, 'flask' in sys.modules)"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    assert result.stdout.split() == ["False", "False"]
+
+
+def main():
+    print("=" * 60)
+    print("Testing api_server / asgi_server")
+    print("=" * 60)
+    
+    for test in (test_token_refresh_response, test_raw_body_upload, test_asgi_without_flask):
+        test()
+        print(f"   ✅ {test.__name__}")
+
+
+if __name__ == "__main__":
+    main()
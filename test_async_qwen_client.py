@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""Test AsyncQwenClient request handling against an in-process httpx transport (no token or network needed)"""
+
+import asyncio
+import json
+
+import httpx
+
+from async_qwen_client import AsyncQwenClient
+
+
+def make_client(handler):
+    http = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return AsyncQwenClient("token", base_url="https://qwen.test/api", http_client=http, response_cache=False)
+
+
+def test_empty_bodies():
+    """DELETE answered with an empty 200 or 204 succeeds; JSON bodies are still parsed"""
+    statuses = iter([200, 204])
+    
+    def handler(request):
+        if request.method == "DELETE":
+            return httpx.Response(next(statuses))
+        return httpx.Response(200, content=json.dumps({"success": True}).encode())
+    
+    async def scenario():
+        client = make_client(handler)
+        assert await client.delete_chat("chat-1") is True
+        assert await client.delete_chat("chat-2") is True
+        assert await client.get_user_settings() == {"success": True}
+        await client.http.aclose()
+    
+    asyncio.run(scenario())
+
+
+def main():
+    print("=" * 60)
+    print("Testing async_qwen_client")
+    print("=" * 60)
+    
+    for test in (test_empty_bodies,):
+        test()
+        print(f"   ✅ {test.__name__}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""Test chat_backend routing and failover with stub clients (no token or network needed)"""
+
+import itertools
+import time
+
+import jwt
+import requests
+
+from chat_backend import (
+    BackendRouter,
+    ChatBackend,
+    ChatRequest,
+    NoBackendAvailable,
+    OfficialBackend,
+    WebBackend,
+)
+from qwen_cache import ModelCatalog
+from qwen_client import QwenClient, StreamDelta
+from qwen_official_client import QwenOfficialClient
+
+
+_serial = itertools.count()
+
+
+def make_token(expires_in):
+    claims = {"id": "user", "jti": next(_serial), "exp": int(time.time() + expires_in)}
+    return jwt.encode(claims, "secret", algorithm="HS256")
+
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(f"{status} Client Error", response=response)
+
+
+class StubWebClient(QwenClient):
+    """Web client answering from memory; fail_with is raised before the first delta"""
+    
+    def __init__(self, token, models=("qwen3-max", "qwen-plus")):
+        super().__init__(token, response_cache=False)
+        self.models = models
+        self.fail_with = None
+        self.sent = []
+    
+    def get_model_catalog(self):
+        data = {"data": [{"id": model} for model in self.models]}
+        return ModelCatalog(b"", data, '"x"', None, None, fetched_at=1.0)
+    
+    def create_chat(self, title="New Chat", model="qwen3-max"):
+        return {"id": "chat-new"}
+    
+    def stream_message(self, chat_id, message, model="qwen3-max", parent_id=None,
+                       system_prompt=None, thinking_enabled=False, search_enabled=False):
+        self.sent.append((chat_id, message, system_prompt))
+        if self.fail_with:
+            raise self.fail_with
+        yield StreamDelta("content", "web answer", phase="answer")
+        yield StreamDelta("done", response_id="msg-1")
+
+
+class StubOfficialClient(QwenOfficialClient):
+    """DashScope client answering from memory; fail_with is raised instead"""
+    
+    def __init__(self):
+        super().__init__(api_key="test")
+        self.payloads = []
+        self.fail_with = None
+    
+    def _stream_deltas(self, payload):
+        self.payloads.append(payload)
+        if self.fail_with:
+            raise self.fail_with
+        return iter(["official ", "answer"])
+
+
+class StubBackend:
+    """Scripted backend: each call pops the next behaviour ("ok", "fail", "fail-after-phase", "fail-midway")"""
+    
+    def __init__(self, name, delay=0.0, script=(), models=("qwen3-max",)):
+        self.name = name
+        self.delay = delay
+        self.script = list(script)
+        self.models = models
+        self.calls = 0
+    
+    def ready(self):
+        return True
+    
+    def serves(self, model):
+        return model in self.models
+    
+    def stream(self, request):
+        self.calls += 1
+        behaviour = self.script.pop(0) if self.script else "ok"
+        time.sleep(self.delay)
+        if behaviour == "fail":
+            raise ConnectionError(f"{self.name} down")
+        if behaviour == "fail-after-phase":
+            yield StreamDelta("phase", phase="answer")
+            raise ConnectionError(f"{self.name} dropped the stream")
+        yield StreamDelta("content", self.name)
+        if behaviour == "fail-midway":
+            raise ConnectionError(f"{self.name} dropped the stream")
+        yield StreamDelta("done")
+
+
+def answer(router, **kwargs):
+    return router.chat(ChatRequest("こんにちは", **kwargs))["content"]
+
+
+def test_protocol():
+    """Both adapters satisfy ChatBackend"""
+    assert isinstance(WebBackend(StubWebClient(make_token(3600))), ChatBackend)
+    assert isinstance(OfficialBackend(StubOfficialClient()), ChatBackend)
+
+
+def test_expired_token_failover():
+    """A 401 from the web backend fails over within the same request and parks the token"""
+    web_client = StubWebClient(make_token(3600))
+    web_client.fail_with = http_error(401)
+    router = BackendRouter([WebBackend(web_client), OfficialBackend(StubOfficialClient())])
+    
+    assert answer(router, chat_id="chat-1") == "official answer"
+    assert router.stats()["web"]["errors"] == 1 and router.stats()["official"]["failovers"] == 1
+    assert not router.backends[0].ready()
+    
+    # A refreshed token is usable again
+    web_client.fail_with = None
+    web_client.set_token(make_token(3600))
+    assert router.backends[0].ready()
+    assert answer(BackendRouter([router.backends[0]]), chat_id="chat-1") == "web answer"
+
+
+def test_token_expiry_and_models():
+    """Tokens past their exp claim and models a backend lacks are skipped without a request"""
+    web_client = StubWebClient(make_token(-60))
+    official = StubOfficialClient()
+    router = BackendRouter([WebBackend(web_client), OfficialBackend(official)])
+    assert answer(router) == "official answer" and not web_client.sent
+    
+    web_client.set_token(make_token(3600))
+    assert answer(router, model="qwen3-max", search_enabled=True) == "web answer"
+    assert answer(router, model="qwen-turbo") == "official answer"
+    assert official.payloads[-1]["model"] == "qwen-turbo"
+    
+    try:
+        answer(router, model="qwen-vl-unknown")
+    except NoBackendAvailable as e:
+        assert e.errors == []
+    else:
+        raise AssertionError("unknown model was routed")
+
+
+def test_history_for_each_backend():
+    """The official backend sends history as messages; a new web chat gets it as a briefing"""
+    web_client = StubWebClient(make_token(3600))
+    official = StubOfficialClient()
+    history = [{"role": "user", "content": "N3 là gì?"}, {"role": "assistant", "content": "Trình độ trung cấp."}]
+    
+    BackendRouter([OfficialBackend(official)]).chat(ChatRequest("Còn N2?", system_prompt="Giáo viên", history=history))
+    messages = official.payloads[-1]["input"]["messages"]
+    assert [m["role"] for m in messages] == ["system", "user", "assistant", "user"]
+    
+    BackendRouter([WebBackend(web_client)]).chat(ChatRequest("Còn N2?", history=history))
+    chat_id, message, system_prompt = web_client.sent[-1]
+    assert chat_id == "chat-new" and message == "Còn N2?" and "N3 là gì?" in system_prompt
+
+
+def test_latency_ranking():
+    """The faster backend takes the traffic once both are measured; probes keep the other one measured"""
+    slow = StubBackend("slow", delay=0.02)
+    fast = StubBackend("fast", delay=0.0)
+    router = BackendRouter([slow, fast], probe_every=10)
+    for _ in range(40):
+        answer(router)
+    # Unmeasured, fast ranks with slow until the 10th request probes it
+    assert slow.calls == 12 and fast.calls == 28
+    assert router.stats()["fast"]["latency"] < router.stats()["slow"]["latency"]
+
+
+def test_unmeasured_backend():
+    """A backend that never answered ranks behind a measured one, not ahead of it"""
+    broken = StubBackend("broken", script=["fail"] * 10)
+    working = StubBackend("working", delay=0.01)
+    router = BackendRouter([broken, working], max_failures=10, probe_every=0)
+    for _ in range(5):
+        assert answer(router) == "working"
+    assert broken.calls == 1
+
+
+def test_cooldown():
+    """A backend failing max_failures times in a row is tried last until its cooldown ends, then counts afresh"""
+    flaky = StubBackend("flaky", script=["ok"] + ["fail"] * 4)
+    backup = StubBackend("backup", delay=0.01)
+    router = BackendRouter([flaky, backup], max_failures=3, cooldown=0.1, probe_every=0)
+    assert [answer(router) for _ in range(6)] == ["flaky"] + ["backup"] * 5
+    assert flaky.calls == 4 and router.stats()["flaky"]["cooling_down"]
+    
+    time.sleep(0.1)
+    assert answer(router) == "backup" and flaky.calls == 5
+    assert not router.stats()["flaky"]["cooling_down"]
+    assert answer(router) == "flaky"
+
+
+def test_official_key_rejection():
+    """A 401 parks the DashScope key until it is replaced; a 403 is an ordinary failure"""
+    official = StubOfficialClient()
+    backend = OfficialBackend(official)
+    for status, ready in ((403, True), (401, False)):
+        official.fail_with = http_error(status)
+        try:
+            list(backend.stream(ChatRequest("hi")))
+        except requests.HTTPError:
+            pass
+        assert backend.ready() is ready
+    
+    official.fail_with = None
+    assert answer(BackendRouter([backend, StubBackend("backup")])) == "backup"
+    official.session.headers["Authorization"] = "Bearer rotated"
+    assert backend.ready() and answer(BackendRouter([backend])) == "official answer"
+
+
+def test_midstream_error():
+    """An error after text was yielded is raised, not retried elsewhere; one after a phase change fails over"""
+    router = BackendRouter([StubBackend("a", script=["fail-midway"]), StubBackend("b", delay=0.01)])
+    try:
+        answer(router)
+    except ConnectionError as e:
+        assert "dropped" in str(e)
+    else:
+        raise AssertionError("mid-stream error was swallowed")
+    
+    router = BackendRouter([StubBackend("a", script=["fail-after-phase"]), StubBackend("b", delay=0.01)])
+    assert answer(router) == "b"
+    
+    all_down = BackendRouter([StubBackend("a", script=["fail"]), StubBackend("b", script=["fail"])])
+    try:
+        answer(all_down)
+    except NoBackendAvailable as e:
+        assert [name for name, _ in e.errors] == ["a", "b"]
+    else:
+        raise AssertionError("failures of every backend were swallowed")
+
+
+def main():
+    print("=" * 60)
+    print("Testing chat_backend")
+    print("=" * 60)
+    
+    for test in (test_protocol, test_expired_token_failover, test_token_expiry_and_models,
+                 test_history_for_each_backend, test_latency_ranking, test_unmeasured_backend, test_cooldown,
+                 test_official_key_rejection, test_midstream_error):
+        test()
+        print(f"   ✅ {test.__name__}")
+
+
+if __name__ == "__main__":
+    main()
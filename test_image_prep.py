@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""Test image downscaling before upload (needs Pillow, no token or network)"""
+
+import io
+import os
+
+from image_prep import ImagePreprocessor
+
+
+def make_photo(size=(4000, 3000), exif=True) -> bytes:
+    from PIL import Image
+    
+    image = Image.new("RGB", size, (200, 120, 40))
+    out = io.BytesIO()
+    if exif:
+        tags = Image.Exif()
+        tags[0x0112] = 6            # Orientation: rotated 90 degrees
+        tags[0x010F] = "PhoneMaker"
+        image.save(out, "JPEG", quality=95, exif=tags)
+    else:
+        # Noise compresses badly, so re-encoding at a higher quality grows it
+        Image.frombytes("RGB", size, os.urandom(size[0] * size[1] * 3)).save(out, "JPEG", quality=20)
+    return out.getvalue()
+
+
+def test_downscale_and_strip_exif():
+    """Large photos shrink to max_edge, honour the orientation and lose EXIF"""
+    from PIL import Image
+    
+    data = make_photo()
+    prep = ImagePreprocessor(max_edge=1024, format="webp", quality=80)
+    source, name, size, mime = prep.prepare(io.BytesIO(data), "photo.JPG", len(data), "image/jpeg")
+    
+    assert name == "photo.webp" and mime == "image/webp"
+    assert size == len(source.getvalue()) < len(data)
+    image = Image.open(source)
+    assert image.size == (768, 1024)    # rotated by the orientation tag
+    assert not image.getexif()
+
+
+def test_variant_cache():
+    """The same original is encoded once"""
+    data = make_photo()
+    prep = ImagePreprocessor(max_edge=1024, format="jpeg")
+    first = prep.prepare(io.BytesIO(data), "a.jpg", len(data), "image/jpeg")
+    second = prep.prepare(io.BytesIO(data), "b.jpg", len(data), "image/jpeg")
+    assert first[0].getvalue() == second[0].getvalue()
+    assert second[1] == "b.jpg"
+    assert prep.stats()["cache_hits"] == 1 and prep.stats()["processed"] == 2
+
+
+def test_small_or_unreadable_left_alone():
+    """Images that would not get smaller, and non-images, upload unchanged"""
+    prep = ImagePreprocessor(max_edge=1024)
+    small = make_photo((64, 64), exif=False)
+    source, name, size, _ = prep.prepare(io.BytesIO(small), "icon.jpg", len(small), "image/jpeg")
+    assert name == "icon.jpg" and source.getvalue() == small
+    
+    svg = b"<svg xmlns='http://www.w3.org/2000/svg'/>"
+    source, name, size, mime = prep.prepare(io.BytesIO(svg), "logo.svg", len(svg), "image/svg+xml")
+    assert source.getvalue() == svg and mime == "image/svg+xml"
+    assert prep.stats()["skipped"] == 2
+
+
+def main():
+    print("=" * 60)
+    print("Testing image_prep")
+    print("=" * 60)
+    
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        print("   ⏭️  Pillow not installed (pip install Pillow), skipping")
+        return
+    
+    for test in (test_downscale_and_strip_exif, test_variant_cache, test_small_or_unreadable_left_alone):
+        test()
+        print(f"   ✅ {test.__name__}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""Test oss_upload multipart, resumable and pooled uploads against fake buckets (no OSS account needed)"""
+
+import io
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlsplit
+
+import oss2
+
+import oss_upload
+
+PART = 100 * 1024
+
+
+class FakeBucket:
+    """Just enough of oss2.Bucket for put_object, multipart and resumable uploads"""
+    bucket_name = "fake-bucket"
+    
+    def __init__(self, fail_part=None):
+        self.fail_part = fail_part      # part number that fails once, with an error that is not retried
+        self.objects = {}
+        self.uploads = {}               # upload_id -> {part number: bytes}
+        self.sent_parts = []
+        self.puts = 0
+    
+    def put_object(self, key, data, headers=None, progress_callback=None):
+        self.puts += 1
+        self.objects[key] = data.read()
+    
+    def init_multipart_upload(self, key, headers=None, params=None):
+        upload_id = f"upload-{len(self.uploads) + 1}"
+        self.uploads[upload_id] = {}
+        return SimpleNamespace(upload_id=upload_id)
+    
+    def upload_part(self, key, upload_id, number, data, headers=None, progress_callback=None):
+        if number == self.fail_part:
+            self.fail_part = None
+            raise RuntimeError(f"connection lost while sending part {number}")
+        body = data if isinstance(data, bytes) else data.read()
+        self.uploads[upload_id][number] = body
+        self.sent_parts.append(number)
+        return SimpleNamespace(etag=f'"{number}-{len(body)}"', crc=None)
+    
+    def list_parts(self, key, upload_id, marker="", max_parts=1000, headers=None):
+        if upload_id not in self.uploads:
+            raise oss2.exceptions.NoSuchUpload(404, {}, "", {})
+        uploaded = self.uploads[upload_id]
+        parts = [oss2.models.PartInfo(n, f'"{n}-{len(uploaded[n])}"', size=len(uploaded[n])) for n in sorted(uploaded)]
+        return SimpleNamespace(parts=parts[:max_parts], is_truncated=False, next_marker="")
+    
+    def complete_multipart_upload(self, key, upload_id, parts, headers=None):
+        numbers = sorted(p.part_number for p in parts)
+        self.objects[key] = b"".join(self.uploads[upload_id][n] for n in numbers)
+        return SimpleNamespace(status=200)
+    
+    def abort_multipart_upload(self, key, upload_id):
+        self.uploads.pop(upload_id, None)
+
+
+class FakeOSS(BaseHTTPRequestHandler):
+    """Loopback OSS endpoint for multipart uploads; records the STS token that signed each request"""
+    protocol_version = "HTTP/1.1"
+    tokens = {}         # object key -> security tokens seen
+    lock = threading.Lock()
+    
+    def reply(self, body=b"", headers=()):
+        self.send_response(200)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def handle_request(self):
+        url = urlsplit(self.path)
+        key = url.path.split("/", 2)[2]
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.lock:
+            self.tokens.setdefault(key, set()).add(self.headers.get("x-oss-security-token"))
+        query = parse_qs(url.query, keep_blank_values=True)
+        if "uploads" in query:
+            self.reply(b"<InitiateMultipartUploadResult><UploadId>%s</UploadId></InitiateMultipartUploadResult>" % key.encode())
+        elif self.command == "GET":
+            # No parts uploaded yet (oss2 lists them after starting an upload)
+            self.reply(b"<ListPartsResult><IsTruncated>false</IsTruncated>"
+                       b"<NextPartNumberMarker>0</NextPartNumberMarker></ListPartsResult>")
+        else:
+            self.reply(headers=[("ETag", '"%s"' % query.get("partNumber", ["0"])[0])])
+    
+    do_GET = do_PUT = do_POST = handle_request
+    
+    def log_message(self, *args):
+        pass
+
+
+class Settings:
+    """Small multipart thresholds and a private checkpoint directory for one test"""
+    
+    def __enter__(self):
+        self.saved = {name: getattr(oss_upload, name) for name in
+                      ("MULTIPART_THRESHOLD", "MULTIPART_PART_SIZE", "MULTIPART_RETRIES", "CHECKPOINT_DIR")}
+        self.directory = tempfile.mkdtemp()
+        oss_upload.MULTIPART_THRESHOLD = 4 * PART
+        oss_upload.MULTIPART_PART_SIZE = PART
+        oss_upload.CHECKPOINT_DIR = os.path.join(self.directory, "checkpoints")
+        return self
+    
+    def __exit__(self, *exc):
+        for name, value in self.saved.items():
+            setattr(oss_upload, name, value)
+        shutil.rmtree(self.directory)
+    
+    def file(self, size):
+        path = os.path.join(self.directory, f"exam-{size}.pdf")
+        with open(path, "wb") as f:
+            f.write(os.urandom(size))
+        return path
+
+
+def checkpoints():
+    """Checkpoint records left under CHECKPOINT_DIR"""
+    return [name for _, _, files in os.walk(oss_upload.CHECKPOINT_DIR) for name in files]
+
+
+def test_threshold():
+    """Files and streams below MULTIPART_THRESHOLD go up in one put_object, larger ones in parts"""
+    with Settings() as settings:
+        bucket = FakeBucket()
+        small = settings.file(4 * PART - 1)
+        oss_upload.upload_object(bucket, "small", small)
+        assert bucket.puts == 1 and not bucket.uploads
+        
+        large = settings.file(4 * PART)
+        oss_upload.upload_object(bucket, "large", large)
+        assert bucket.puts == 1 and sorted(bucket.sent_parts) == [1, 2, 3, 4]
+        assert bucket.objects["large"] == open(large, "rb").read()
+        
+        data = os.urandom(5 * PART + 7)
+        oss_upload.upload_object(bucket, "stream", io.BytesIO(data))
+        assert bucket.objects["stream"] == data and len(bucket.uploads) == 2
+
+
+def test_resume_from_checkpoint():
+    """An interrupted upload resumes from its checkpoint, sending only the parts it was missing"""
+    with Settings() as settings:
+        oss_upload.MULTIPART_RETRIES = 0
+        path = settings.file(6 * PART + 123)
+        bucket = FakeBucket(fail_part=4)
+        progress = []
+        try:
+            oss_upload.upload_object(bucket, "exam.pdf", path)
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("interrupted upload did not fail")
+        assert "exam.pdf" not in bucket.objects
+        assert checkpoints()
+        sent_before = list(bucket.sent_parts)
+        assert 4 not in sent_before
+        
+        oss_upload.upload_object(bucket, "exam.pdf", path, progress_callback=lambda done, total: progress.append(done))
+        resumed = bucket.sent_parts[len(sent_before):]
+        assert sorted(sent_before + resumed) == [1, 2, 3, 4, 5, 6, 7]
+        assert 4 in resumed and len(bucket.uploads) == 1
+        assert bucket.objects["exam.pdf"] == open(path, "rb").read()
+        assert progress[-1] == os.path.getsize(path)
+        assert not checkpoints()
+
+
+def test_retry_within_call():
+    """A network error is resumed from the checkpoint within the same call"""
+    with Settings() as settings:
+        oss_upload.MULTIPART_RETRIES = 1
+        path = settings.file(5 * PART)
+        bucket = FakeBucket()
+        original = bucket.upload_part
+        failed = []
+        
+        def flaky(key, upload_id, number, data, **kwargs):
+            if number == 3 and not failed:
+                failed.append(number)
+                raise oss2.exceptions.RequestError(ConnectionError("reset by peer"))
+            return original(key, upload_id, number, data, **kwargs)
+        
+        bucket.upload_part = flaky
+        oss_upload.upload_object(bucket, "exam.pdf", path)
+        assert bucket.objects["exam.pdf"] == open(path, "rb").read()
+        assert len(bucket.uploads) == 1 and bucket.sent_parts.count(3) == 1
+
+
+def test_buckets_per_upload():
+    """Concurrent uploads with the same access key but different tokens each sign with their own token"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOSS)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    pool = oss_upload.BucketPool(pool_size=4)
+    
+    def sts_data(token):
+        return {"endpoint": f"http://127.0.0.1:{server.server_port}", "bucketname": "bucket",
+                "access_key_id": "STS.shared", "access_key_secret": "secret", "security_token": token}
+    
+    try:
+        with Settings() as settings:
+            oss_upload.MULTIPART_THREADS = 2
+            # Both buckets exist before either upload starts, as when a second file gets its token mid-upload
+            first, second = pool.bucket(sts_data("token-a")), pool.bucket(sts_data("token-b"))
+            paths = [settings.file(6 * PART), settings.file(6 * PART + 1)]
+            errors = []
+            
+            def upload(bucket, key, path):
+                try:
+                    oss_upload.upload_object(bucket, key, path)
+                except Exception as e:
+                    errors.append(e)
+            
+            uploads = [threading.Thread(target=upload, args=(bucket, key, path))
+                       for bucket, key, path in ((first, "a.pdf", paths[0]), (second, "b.pdf", paths[1]))]
+            for upload in uploads:
+                upload.start()
+            for upload in uploads:
+                upload.join()
+            oss_upload.MULTIPART_THREADS = 1
+        
+        assert not errors, errors
+        assert FakeOSS.tokens == {"a.pdf": {"token-a"}, "b.pdf": {"token-b"}}
+        assert first is not second and first.session is second.session
+        assert pool.stats() == {"endpoints": 1, "pool_size": 4, "buckets": 2}
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def main():
+    # oss2 logs the injected part failures with full backtraces
+    logging.getLogger("oss2").setLevel(logging.CRITICAL)
+    
+    print("=" * 60)
+    print("Testing oss_upload")
+    print("=" * 60)
+    
+    for test in (test_threshold, test_resume_from_checkpoint, test_retry_within_call, test_buckets_per_upload):
+        test()
+        print(f"   ✅ {test.__name__}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""Test proxy_server and async_proxy_server against a loopback fake Qwen API (no token or network needed)"""
+
+import gzip
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeQwenAPI(BaseHTTPRequestHandler):
+    """Answers JSON with a cookie (gzip-encoded if accepted), and /api/sse as an event stream"""
+    protocol_version = "HTTP/1.1"
+    connections = set()
+    bodies = []
+    paths = []
+    encodings = []
+    
+    def _reply(self):
+        self.connections.add(self.client_address)
+        self.paths.append(self.path)
+        self.encodings.append(self.headers.get("Accept-Encoding"))
+        self.bodies.append(self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+        if self.path.startswith("/api/sse"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i in range(3):
+                event = f"data: {i}\n\n".encode()
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(event), event))
+            self.wfile.write(b"0\r\n\r\n")
+            return
+        
+        body = json.dumps({"success": True, "path": self.path}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Set-Cookie", "sid=private; Path=/")
+        self.end_headers()
+        self.wfile.write(body)
+    
+    do_GET = do_POST = do_DELETE = do_PUT = _reply
+    
+    def log_message(self, *args):
+        pass
+
+
+upstream_server = ThreadingHTTPServer(("127.0.0.1", 0), FakeQwenAPI)
+threading.Thread(target=upstream_server.serve_forever, daemon=True).start()
+os.environ["QWEN_API_URL"] = f"http://127.0.0.1:{upstream_server.server_port}/api"
+os.environ["QWEN_PROXY_POOL_SHARDS"] = "1"
+
+import proxy_server  # noqa: E402  (reads QWEN_API_URL at import)
+import async_proxy_server  # noqa: E402
+from proxy_cache import ProxyCache, parse_rules  # noqa: E402
+from starlette.testclient import TestClient  # noqa: E402
+
+client = proxy_server.app.test_client()
+AUTH = {"Authorization": "Bearer test-token"}
+GZIP = {**AUTH, "Accept-Encoding": "gzip"}
+
+
+def test_pooled_and_encoded():
+    """Requests reuse one upstream connection; encoded bodies pass through untouched"""
+    FakeQwenAPI.connections.clear()
+    for page in range(5):
+        response = client.get(f"/api/v2/chats?page={page}", headers=GZIP)
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert json.loads(gzip.decompress(response.get_data()))["path"] == f"/api/v2/chats?page={page}"
+    assert len(FakeQwenAPI.connections) == 1
+    assert len(proxy_server.upstream.cookies) == 0
+
+
+def test_accept_encoding():
+    """Upstream only encodes bodies the way the client accepts"""
+    response = client.get("/api/v2/chats/pinned", headers=AUTH)
+    assert FakeQwenAPI.encodings[-1] == "identity"
+    assert "Content-Encoding" not in response.headers
+    assert json.loads(response.get_data())["path"] == "/api/v2/chats/pinned"
+    
+    client.get("/api/v2/chats/pinned", headers={**AUTH, "Accept-Encoding": "br, gzip"})
+    assert FakeQwenAPI.encodings[-1] == "br, gzip"
+
+
+def test_raw_request_body():
+    """Request bodies are forwarded byte for byte"""
+    raw = '{"content":  "Đề N3",\n "files": []}'.encode()
+    client.post("/api/v2/chat/completions", headers={**AUTH, "Content-Type": "application/json"}, data=raw)
+    assert FakeQwenAPI.bodies[-1] == raw
+
+
+def test_event_stream():
+    """Event streams keep their type and are not buffered by intermediaries"""
+    response = client.get("/api/sse", headers=AUTH)
+    assert response.headers["Content-Type"] == "text/event-stream"
+    assert response.headers["X-Accel-Buffering"] == "no"
+    assert response.get_data() == b"data: 0\n\ndata: 1\n\ndata: 2\n\n"
+
+
+def test_missing_auth():
+    assert client.get("/api/v2/chats").status_code == 401
+
+
+def test_async_proxy():
+    """The ASGI proxy pools, passes encoded bodies and streams events the same way"""
+    FakeQwenAPI.connections.clear()
+    raw = '{"content":  "Đề N3"}'.encode()
+    with TestClient(async_proxy_server.app) as async_client:
+        for page in range(3):
+            response = async_client.get(f"/api/v2/chats?page={page}", headers=AUTH)
+            assert response.headers["Content-Encoding"] == "gzip"
+            assert json.loads(response.content)["path"] == f"/api/v2/chats?page={page}"
+        assert len(FakeQwenAPI.connections) == 1
+        assert all(len(c.cookies) == 0 for c in async_proxy_server._http_clients)
+        
+        async_client.post("/api/v2/chat/completions", headers={**AUTH, "Content-Type": "application/json"}, content=raw)
+        assert FakeQwenAPI.bodies[-1] == raw
+        
+        response = async_client.get("/api/sse", headers=AUTH)
+        assert response.headers["X-Accel-Buffering"] == "no"
+        assert response.content == b"data: 0\n\ndata: 1\n\ndata: 2\n\n"
+        assert async_client.get("/api/v2/chats").status_code == 401
+
+
+def test_async_accept_encoding():
+    """httpx's own Accept-Encoding is replaced by the client's, or identity"""
+    with TestClient(async_proxy_server.app) as async_client:
+        response = async_client.get("/api/v2/chats/pinned", headers={**AUTH, "Accept-Encoding": "identity"})
+        assert FakeQwenAPI.encodings[-1] == "identity"
+        assert "Content-Encoding" not in response.headers
+        assert json.loads(response.content)["path"] == "/api/v2/chats/pinned"
+        
+        async_client.get("/api/v2/chats/pinned", headers={**AUTH, "Accept-Encoding": "br"})
+        assert FakeQwenAPI.encodings[-1] == "br"
+
+
+def upstream_gets(path):
+    return sum(1 for p in FakeQwenAPI.paths if p == path)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_get_cache():
+    """Matching GETs are cached per token, refreshed when stale and dropped by changes to the chat"""
+    cache = ProxyCache(parse_rules("models=60,v2/chats/=0+60,v2/chats/*=60"))
+    proxy_server.proxy_cache = cache
+    try:
+        first = client.get("/api/models", headers=GZIP)
+        second = client.get("/api/models", headers=GZIP)
+        assert (first.headers["X-Cache"], second.headers["X-Cache"]) == ("MISS", "HIT")
+        assert second.get_data() == first.get_data() and second.headers["Content-Encoding"] == "gzip"
+        assert upstream_gets("/api/models") == 1
+        assert client.get("/api/models", headers={"Authorization": "Bearer other"}).headers["X-Cache"] == "MISS"
+        
+        # Past its TTL the list is served at once and refreshed in the background
+        assert client.get("/api/v2/chats/?page=1", headers=AUTH).headers["X-Cache"] == "MISS"
+        assert client.get("/api/v2/chats/?page=1", headers=AUTH).headers["X-Cache"] == "STALE"
+        wait_for(lambda: upstream_gets("/api/v2/chats/?page=1") == 2)
+        
+        for chat in ("chat-aaaaaaaa", "chat-bbbbbbbb"):
+            client.get(f"/api/v2/chats/{chat}", headers=AUTH)
+            assert client.get(f"/api/v2/chats/{chat}", headers=AUTH).headers["X-Cache"] == "HIT"
+        client.post("/api/v2/chat/completions?chat_id=chat-aaaaaaaa", headers=AUTH, data=b"{}")
+        assert client.get("/api/v2/chats/chat-aaaaaaaa", headers=AUTH).headers["X-Cache"] == "MISS"
+        assert client.get("/api/v2/chats/chat-bbbbbbbb", headers=AUTH).headers["X-Cache"] == "HIT"
+        assert cache.stats()["invalidations"] >= 2
+        
+        # Each accepted encoding is cached separately, since bodies are kept encoded
+        plain = client.get("/api/models", headers=AUTH)
+        assert plain.headers["X-Cache"] == "MISS" and "Content-Encoding" not in plain.headers
+        assert json.loads(plain.get_data())["path"] == "/api/models"
+        assert client.get("/api/models", headers=AUTH).headers["X-Cache"] == "HIT"
+        
+        # Event streams and bypassed paths are not touched
+        assert "X-Cache" not in client.get("/api/sse", headers=AUTH).headers
+    finally:
+        proxy_server.proxy_cache = None
+
+
+def test_cache_bounds():
+    """Bodies stay under max_bytes, and answers fetched before an invalidation are not kept"""
+    rule = parse_rules("models=60")[0]
+    cache = ProxyCache([rule], max_bytes=250, max_entry=100)
+    for name in ("a", "b", "c"):
+        key = cache.key("Bearer t", f"v2/chats/{name}")
+        assert cache.store(key, rule, 200, {}, b"x" * 100, cache.generation(key))
+    assert len(cache) == 2 and cache.size == 200 and cache.stats()["evictions"] == 1
+    assert not cache.store(cache.key("Bearer t", "models"), rule, 200, {}, b"x" * 101, 0)
+    
+    key = cache.key("Bearer t", "v2/chats/", "page=1")
+    generation = cache.generation(key)
+    cache.invalidate("Bearer t", "v2/chats/new")
+    assert not cache.store(key, rule, 200, {}, b"[]", generation)
+
+
+def test_async_get_cache():
+    """async_proxy_server answers from the same cache"""
+    async_proxy_server.proxy_cache = ProxyCache(parse_rules("v2/users/user/settings=0+60"))
+    try:
+        with TestClient(async_proxy_server.app) as async_client:
+            states = [async_client.get("/api/v2/users/user/settings", headers=AUTH).headers["X-Cache"]
+                      for _ in range(2)]
+            assert states == ["MISS", "STALE"]
+            wait_for(lambda: not async_proxy_server._refresh_tasks)
+            assert upstream_gets("/api/v2/users/user/settings") == 2
+            assert async_proxy_server.proxy_cache.stats()["entries"] == 1
+            
+            # Saving the settings drops the cached GET of the same path
+            async_client.post("/api/v2/users/user/settings", headers=AUTH, content=b"{}")
+            assert async_client.get("/api/v2/users/user/settings", headers=AUTH).headers["X-Cache"] == "MISS"
+    finally:
+        async_proxy_server.proxy_cache = None
+
+
+def main():
+    print("=" * 60)
+    print("Testing proxy_server")
+    print("=" * 60)
+    
+    for test in (test_pooled_and_encoded, test_accept_encoding, test_raw_request_body, test_event_stream,
+                 test_missing_auth, test_async_proxy, test_async_accept_encoding, test_get_cache, test_cache_bounds,
+                 test_async_get_cache):
+        test()
+        print(f"   ✅ {test.__name__}")
+    upstream_server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
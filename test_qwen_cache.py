@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""Test in-process caches (no token or network needed)"""
+
+import asyncio
+import threading
+import time
+
+import httpx
+
+from async_qwen_client import AsyncQwenClient
+from bench_async_streams import start_fake_server
+from qwen_cache import TTLCache, AsyncSingleFlight, ClientPool, ConversationTipCache, ModelCatalogCache, SingleFlight
+from qwen_client import HostConnectionLimit, QwenClient, UpstreamBusy
+
+
+def test_lru_eviction():
+    """Least recently used entry is dropped first"""
+    evicted = []
+    cache = TTLCache(max_size=2, ttl=None, on_evict=lambda k, v: evicted.append(k))
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert evicted == ["b"]
+
+
+def test_ttl_expiry():
+    """Entries expire after ttl seconds"""
+    cache = TTLCache(max_size=10, ttl=0.05)
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    time.sleep(0.06)
+    assert cache.get("a") is None
+    stats = cache.stats()
+    assert stats["hits"] == 1 and stats["misses"] == 1 and stats["evictions"] == 1
+
+
+def test_tip_cache():
+    """Tips are updated from response IDs and invalidated on conflict"""
+    tips = ConversationTipCache(max_size=10, ttl=60)
+    assert tips.get("chat") is None
+    tips.update("chat", "msg-1")
+    tips.update("chat", None)
+    assert tips.get("chat") == "msg-1"
+    tips.invalidate("chat", conflict=True)
+    assert tips.get("chat") is None
+    stats = tips.stats()
+    assert stats["hits"] == 1 and stats["misses"] == 2 and stats["conflicts"] == 1
+
+
+def test_model_catalog_revalidation():
+    """Catalog is served from memory, then revalidated with its ETag"""
+    calls = []
+    
+    def fetch(headers):
+        calls.append(headers)
+        if headers.get("If-None-Match") == '"v1"':
+            return 304, b"", {"ETag": '"v1"'}
+        return 200, b'{"data": []}', {"ETag": '"v1"'}
+    
+    cache = ModelCatalogCache(ttl=0.05)
+    first = cache.get("api", fetch)
+    assert cache.get("api", fetch) is first and len(calls) == 1
+    time.sleep(0.06)
+    assert cache.get("api", fetch).data == {"data": []}
+    assert calls[-1] == {"If-None-Match": '"v1"'}
+    assert cache.stats()["not_modified"] == 1
+    
+    def failing(headers):
+        raise ConnectionError("upstream down")
+    
+    time.sleep(0.06)
+    assert cache.get("api", failing) is first
+    assert cache.stats()["errors"] == 1
+
+
+def test_model_catalog_cold_misses():
+    """Concurrent requests for a missing catalog share one upstream fetch"""
+    calls = []
+    
+    def slow_fetch(headers):
+        calls.append(headers)
+        time.sleep(0.05)
+        return 200, b'{"data": []}', {}
+    
+    cache = ModelCatalogCache(ttl=60)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get("api", slow_fetch))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1 and len(results) == 8
+    assert all(result is results[0] for result in results)
+    assert cache.stats()["misses"] == 8 and cache.stats()["upstream_fetches"] == 1
+    
+    async def cold_async():
+        async_cache = ModelCatalogCache(ttl=60)
+        requests_seen = []
+        
+        def handler(request):
+            requests_seen.append(request)
+            return httpx.Response(200, content=b'{"data": []}')
+        
+        http = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        clients = [AsyncQwenClient(f"token-{i}", base_url="https://qwen.test/api", http_client=http,
+                                   model_cache=async_cache, response_cache=False) for i in range(5)]
+        await asyncio.gather(*(client.get_model_catalog() for client in clients))
+        await http.aclose()
+        return len(requests_seen)
+    
+    assert asyncio.run(cold_async()) == 1
+
+
+def test_single_flight():
+    """Concurrent calls with the same key share one execution"""
+    flight = SingleFlight()
+    runs = []
+    
+    def slow():
+        runs.append(1)
+        time.sleep(0.05)
+        return {"data": []}
+    
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do("k", slow))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(runs) == 1 and len(results) == 8
+    assert all(result is results[0] for result in results)
+    assert flight.stats()["collapsed"] == 7
+
+
+def test_async_single_flight_leader_cancelled():
+    """Cancelling the caller that started a shared call leaves the other callers their result"""
+    flight = AsyncSingleFlight()
+    runs = []
+    
+    async def slow():
+        runs.append(1)
+        await asyncio.sleep(0.05)
+        return {"data": []}
+    
+    async def scenario():
+        leader = asyncio.ensure_future(flight.do("k", slow))
+        await asyncio.sleep(0)
+        waiters = [asyncio.ensure_future(flight.do("k", slow)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        results = await asyncio.gather(*waiters)
+        assert leader.cancelled()
+        assert all(result == {"data": []} for result in results)
+        await asyncio.sleep(0)
+        assert flight.stats()["in_flight"] == 0
+    
+    asyncio.run(scenario())
+    assert len(runs) == 1
+
+
+def test_tip_from_abandoned_stream():
+    """The tip is recorded when upstream creates the answer, even if the stream is not read to the end"""
+    base_url = start_fake_server(events=5, interval=0.01)
+    
+    tips = ConversationTipCache()
+    client = QwenClient("token", base_url=base_url, tip_cache=tips, response_cache=False)
+    deltas = client.stream_message("chat-sync", "hi", parent_id="msg-0")
+    next(d for d in deltas if d.type == "content")
+    deltas.close()
+    assert tips.get("chat-sync") == "bench"
+    
+    async def abandon():
+        async_client = AsyncQwenClient("token", base_url=base_url, tip_cache=tips, response_cache=False)
+        deltas = async_client.stream_message("chat-async", "hi", parent_id="msg-0")
+        async for delta in deltas:
+            if delta.type == "content":
+                break
+        await deltas.aclose()
+        await async_client.aclose()
+    
+    asyncio.run(abandon())
+    assert tips.get("chat-async") == "bench"
+
+
+def test_shared_connection_limit():
+    """Clients sharing a HostConnectionLimit get UpstreamBusy after the pool timeout instead of hanging"""
+    base_url = start_fake_server(events=20, interval=0.05)
+    adapter = HostConnectionLimit(2, pool_timeout=0.2)
+    clients = [QwenClient(f"token-{i}", base_url=base_url, http_adapter=adapter, response_cache=False)
+               for i in range(3)]
+    streams = [client.stream_message("chat", "hi", parent_id="msg-0") for client in clients[:2]]
+    for deltas in streams:
+        next(deltas)
+    
+    start = time.monotonic()
+    try:
+        next(clients[2].stream_message("chat", "hi", parent_id="msg-0"))
+    except UpstreamBusy:
+        assert 0.2 <= time.monotonic() - start < 2
+    else:
+        raise AssertionError("third stream got a connection past the limit")
+    
+    # Closing one client leaves the shared adapter usable for the others
+    for deltas in streams:
+        deltas.close()
+    clients[0].close()
+    assert next(clients[2].stream_message("chat", "hi", parent_id="msg-0")) is not None
+
+
+def test_evicted_client_still_usable():
+    """A client evicted (and closed) while a handler still holds it keeps working"""
+    base_url = start_fake_server(events=3, interval=0.01)
+    adapter = HostConnectionLimit(4)
+    pool = ClientPool(
+        factory=lambda token: QwenClient(token, base_url=base_url, http_adapter=adapter, response_cache=False),
+        max_size=1,
+        close=lambda client: client.close()
+    )
+    held = pool.get("token-a")
+    deltas = held.stream_message("chat", "hi", parent_id="msg-0")
+    pool.get("token-b")  # evicts token-a
+    assert pool.get("token-a") is not held
+    assert [d.type for d in deltas][-1] == "done"
+    assert list(held.stream_message("chat", "again", parent_id="msg-0"))[-1].type == "done"
+    
+    private = QwenClient("token-c", base_url=base_url, response_cache=False)
+    private.close()
+    assert list(private.stream_message("chat", "hi", parent_id="msg-0"))[-1].type == "done"
+
+
+def main():
+    print("=" * 60)
+    print("Testing qwen_cache")
+    print("=" * 60)
+    
+    for test in (test_lru_eviction, test_ttl_expiry, test_tip_cache,
+                 test_model_catalog_revalidation, test_model_catalog_cold_misses,
+                 test_single_flight, test_async_single_flight_leader_cancelled,
+                 test_tip_from_abandoned_stream,
+                 test_shared_connection_limit, test_evicted_client_still_usable):
+        test()
+        print(f"   ✅ {test.__name__}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""Test DashScope stream handling and Conversation in qwen_official_client (no API key or network needed)"""
+
+from qwen_official_client import Conversation, QwenOfficialClient, estimate_tokens, stream_deltas
+
+
+class FakeClient(QwenOfficialClient):
+    """Answers every request with a fixed text and keeps the payloads sent"""
+    
+    def __init__(self, answer="Đúng rồi. " * 20):
+        super().__init__(api_key="test")
+        self.answer = answer
+        self.payloads = []
+    
+    def _chat_sync(self, payload):
+        self.payloads.append(payload)
+        return self.answer
+    
+    def _stream_deltas(self, payload):
+        self.payloads.append(payload)
+        return iter([self.answer[:10], self.answer[10:]])
+
+
+def event(content):
+    return {"output": {"choices": [{"message": {"role": "assistant", "content": content}}]}}
+
+
+def test_incremental():
+    """incremental_output events are yielded as they are"""
+    events = [event("Xin"), event(" chào"), event(""), event(" 日本")]
+    assert list(stream_deltas(events, incremental=True)) == ["Xin", " chào", " 日本"]
+
+
+def test_cumulative():
+    """Cumulative events yield only the text past what was already seen"""
+    events = [event("Xin"), event("Xin chào"), event("Xin chào"), event("Xin chào 日本")]
+    assert list(stream_deltas(events, incremental=False)) == ["Xin", " chào", " 日本"]
+
+
+def test_multimodal_and_text_format():
+    """List contents (VL models) and result_format=text are read too"""
+    events = [event([{"text": "a"}, {"text": "b"}]), {"output": {"text": "c"}}]
+    assert list(stream_deltas(events)) == ["ab", "c"]
+
+
+def test_error_event():
+    """An error event raises"""
+    try:
+        list(stream_deltas([event("a"), {"code": "Throttling", "message": "Requests rate limit exceeded"}]))
+    except Exception as e:
+        assert "Throttling" in str(e)
+    else:
+        raise AssertionError("error event was ignored")
+
+
+def test_estimate_tokens():
+    """ASCII counts about a token per four characters, kana and kanji one each"""
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("a" * 400) == 100
+    assert estimate_tokens("日本語を勉強します") == 9
+    assert estimate_tokens([{"text": "abcd"}, {"image": "x.png"}]) == 1
+
+
+def test_chat_keeps_history():
+    """chat() no longer appends to the caller's history list"""
+    client = FakeClient()
+    history = [{"role": "user", "content": "a"}, {"role": "assistant", "content": "b"}]
+    client.chat("c", history=history, stream=False)
+    assert len(history) == 2
+    assert [m["content"] for m in client.payloads[-1]["input"]["messages"]] == ["a", "b", "c"]
+
+
+def test_conversation_budget():
+    """Requests stay within the budget however long the chat gets; whole turns are dropped"""
+    client = FakeClient()
+    convo = Conversation(client, system_prompt="Bạn là giáo viên JLPT", max_history_tokens=500)
+    for i in range(100):
+        convo.send(f"Câu hỏi số {i}: giải thích ngữ pháp ～ようにする", stream=False)
+        assert convo.history_tokens() <= 500
+    
+    messages = client.payloads[-1]["input"]["messages"]
+    assert messages[0] == {"role": "system", "content": "Bạn là giáo viên JLPT"}
+    assert messages[1]["role"] == "user" and messages[-1]["content"].startswith("Câu hỏi số 99")
+    assert convo.dropped > 0 and len(convo.messages) % 2 == 0
+
+
+def test_conversation_summary():
+    """Dropped turns go to the summarizer in batches and the summary is sent as system context"""
+    calls = []
+    
+    def summarizer(summary, dropped):
+        calls.append(len(dropped))
+        return f"{len(calls)} summaries"
+    
+    client = FakeClient()
+    convo = Conversation(client, max_history_tokens=400, summarizer=summarizer)
+    for i in range(30):
+        list(convo.stream(f"Question {i}"))
+    
+    assert calls and all(n % 2 == 0 and n >= 4 for n in calls)
+    assert len(calls) < 30 // 2
+    assert convo.build_messages("next")[0]["content"].endswith(f"{len(calls)} summaries")
+    assert convo.messages[-1]["content"] == client.answer
+
+
+def test_conversation_failed_request():
+    """A request that fails leaves the history unchanged"""
+    client = FakeClient()
+    convo = Conversation(client)
+    convo.send("a", stream=False)
+    client._chat_sync = lambda payload: (_ for _ in ()).throw(Exception("API Error"))
+    try:
+        convo.send("b", stream=False)
+    except Exception:
+        pass
+    assert [m["content"] for m in convo.messages] == ["a", client.answer]
+
+
+def main():
+    print("=" * 60)
+    print("Testing qwen_official_client streaming")
+    print("=" * 60)
+    
+    for test in (test_incremental, test_cumulative, test_multimodal_and_text_format, test_error_event,
+                 test_estimate_tokens, test_chat_keeps_history, test_conversation_budget,
+                 test_conversation_summary, test_conversation_failed_request):
+        test()
+        print(f"   ✅ {test.__name__}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""Test the response cache (no token or network needed; uses a loopback fake server)"""
+
+import asyncio
+import os
+import shutil
+import tempfile
+
+from async_qwen_client import AsyncQwenClient
+from bench_async_streams import start_fake_server
+from qwen_client import QwenClient, StreamDelta, StreamRecorder, collect_stream, replay_stream
+from response_cache import ResponseCache, response_key
+from upload_cache import FileBackend, MemoryBackend, SQLiteBackend, token_scope
+
+
+def test_key_normalization():
+    """Whitespace and line-end differences share a key; anything that shapes the answer does not"""
+    scope = token_scope("test-token")
+    key = response_key(scope, "qwen3-max", "Bạn là giáo viên", "Giải thích ～ばかり", False, False)
+    assert key == response_key(scope, "qwen3-max", "Bạn là giáo viên  ", "Giải thích ～ばかり\r\n", False, False)
+    assert key == response_key(scope, "qwen3-max", "Bạn là giáo viên", {"content": "Giải thích ～ばかり"}, False, False)
+    assert key != response_key(scope, "qwen-plus", "Bạn là giáo viên", "Giải thích ～ばかり", False, False)
+    assert key != response_key(scope, "qwen3-max", "Bạn là giáo viên", "Giải thích ～ばかり", True, False)
+    with_file = {"content": "Giải thích ～ばかり", "files": [{"id": "f1", "url": "https://b.oss/f1"}]}
+    assert key != response_key(scope, "qwen3-max", "Bạn là giáo viên", with_file, False, False)
+    # Another account never shares the entry
+    assert key != response_key(token_scope("other-token"), "qwen3-max", "Bạn là giáo viên", "Giải thích ～ばかり", False, False)
+
+
+def test_record_and_replay():
+    """Recorded deltas are merged per run and replay to the same answer"""
+    deltas = [
+        StreamDelta("phase", phase="think"),
+        StreamDelta("reasoning", "Hmm", phase="think"), StreamDelta("reasoning", "...", phase="think"),
+        StreamDelta("phase", phase="answer"),
+        StreamDelta("content", "ばかり", phase="answer"), StreamDelta("content", " = only", phase="answer"),
+        StreamDelta("usage", usage={"output_tokens": 5}),
+        StreamDelta("done", usage={"output_tokens": 5}, response_id="r1")
+    ]
+    recorder = StreamRecorder()
+    for delta in deltas[:-1]:
+        recorder.add(delta)
+    assert recorder.answer() is None  # not finished
+    recorder.add(deltas[-1])
+    answer = recorder.answer()
+    assert len(answer["events"]) == 4
+    
+    replayed = list(replay_stream(answer))
+    assert collect_stream(replayed) == collect_stream(deltas) == {"content": "ばかり = only", "thinking": "Hmm..."}
+    assert replayed[-1].type == "done" and replayed[-1].usage == {"output_tokens": 5}
+
+
+def test_backends():
+    """Answers round-trip through every backend"""
+    directory = tempfile.mkdtemp()
+    try:
+        answer = {"events": [["content", "xin chào"]], "usage": None}
+        for backend in (MemoryBackend(), SQLiteBackend(os.path.join(directory, "r.sqlite3"), table="responses"),
+                        FileBackend(os.path.join(directory, "files"))):
+            cache = ResponseCache(backend, ttl=60)
+            assert cache.get("k") is None
+            cache.put("k", answer)
+            assert cache.get("k") == answer
+            cache.invalidate("k")
+            assert cache.get("k") is None
+        
+        cache = ResponseCache(ttl=-1)
+        cache.put("k", answer)
+        assert cache.get("k") is None and cache.expired == 1
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_client_replay():
+    """A repeated prompt is replayed; search-enabled requests always go upstream"""
+    client = QwenClient("test-token", base_url=start_fake_server(3, 0), response_cache=ResponseCache())
+    
+    first = list(client.stream_message("chat-1", "Giải thích ～ばかり", parent_id="p"))
+    again = list(client.stream_message("chat-2", "Giải thích ～ばかり ", parent_id="p"))
+    assert first[-1].response_id == "bench" and again[-1].response_id is None
+    assert collect_stream(first) == collect_stream(again)
+    
+    searched = list(client.stream_message("chat-3", "Giải thích ～ばかり", parent_id="p", search_enabled=True))
+    searched_again = list(client.stream_message("chat-3", "Giải thích ～ばかり", parent_id="p", search_enabled=True))
+    assert searched[-1].response_id == searched_again[-1].response_id == "bench"
+    assert client.response_cache.stats()["hits"] == 1
+
+
+def test_repeated_prompt_in_chat():
+    """The same prompt asked again in one chat is replayed, for its own token only"""
+    cache = ResponseCache()
+    base_url = start_fake_server(3, 0)
+    client = QwenClient("test-token", base_url=base_url, response_cache=cache)
+    
+    # The chat's tip moves on after each answer, so the parent differs every time
+    first = list(client.stream_message("chat-1", "Giải thích ～ばかり"))
+    again = list(client.stream_message("chat-1", "Giải thích ～ばかり"))
+    assert first[-1].response_id == "bench" and again[-1].response_id is None
+    assert collect_stream(first) == collect_stream(again)
+    
+    other = QwenClient("other-token", base_url=base_url, response_cache=cache)
+    assert list(other.stream_message("chat-2", "Giải thích ～ばかり"))[-1].response_id == "bench"
+    
+    async def ask_async():
+        async with AsyncQwenClient("test-token", base_url=base_url, response_cache=cache) as client:
+            return [delta async for delta in client.stream_message("chat-1", "Giải thích ～ばかり")]
+    
+    assert asyncio.run(ask_async())[-1].response_id is None
+    assert cache.stats()["hits"] == 2 and cache.stats()["stores"] == 2
+
+
+def main():
+    print("=" * 60)
+    print("Testing response_cache")
+    print("=" * 60)
+    
+    for test in (test_key_normalization, test_record_and_replay, test_backends, test_client_replay,
+                 test_repeated_prompt_in_chat):
+        test()
+        print(f"   ✅ {test.__name__}")
+
+
+if __name__ == "__main__":
+    main()
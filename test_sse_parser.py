@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""Test the incremental SSE decoder (no token or network needed)"""
+
+import asyncio
+import json
+
+from qwen_client import CompletionStreamParser, collect_stream
+from sse_parser import SSEDecoder, TextAccumulator, aiter_events, iter_events, json_loads
+
+
+def stream_bytes(texts):
+    events = []
+    for text in texts:
+        chunk = {"choices": [{"delta": {"content": text, "phase": "answer"}}]}
+        events.append(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n")
+    events.append("data: [DONE]\n\n")
+    return "".join(events).encode("utf-8")
+
+
+def split_every(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def test_any_chunking():
+    """Events come out the same whatever the chunk boundaries (split UTF-8 included)"""
+    texts = ["Xin chào", " các bạn", " 日本語", "\n", " 🎌"]
+    data = stream_bytes(texts)
+    for size in (1, 2, 3, 7, 64, len(data)):
+        events = [e.data for e in iter_events(split_every(data, size))]
+        assert events[-1] == "[DONE]"
+        parser = CompletionStreamParser()
+        deltas = [d for raw in events[:-1] for d in parser.feed(raw)]
+        assert collect_stream(deltas)["content"] == "".join(texts), size
+
+
+def test_line_endings_and_fields():
+    """CRLF, CR and LF end lines; comments are skipped; event, id and multi-line data are kept"""
+    data = b": keep-alive\r\nevent: delta\r\nid: 7\r\ndata: a\r\ndata: b\r\n\r\ndata: c\r\rdata:d\n\n"
+    for size in (1, 2, len(data)):
+        events = list(iter_events(split_every(data, size)))
+        assert [(e.event, e.data, e.id) for e in events] == [
+            ("delta", "a\nb", "7"), ("message", "c", "7"), ("message", "d", "7")
+        ], size
+
+
+def test_flush():
+    """An event without its closing blank line is dispatched when the stream ends"""
+    decoder = SSEDecoder()
+    assert decoder.feed(b"data: last\n") == []
+    assert [e.data for e in decoder.flush()] == ["last"]
+    assert decoder.flush() == []
+
+
+def test_async():
+    """aiter_events decodes an async iterable of chunks"""
+    async def chunks():
+        for chunk in split_every(stream_bytes(["a", "b"]), 5):
+            yield chunk
+    
+    async def run():
+        return [e.data async for e in aiter_events(chunks())]
+    
+    assert asyncio.run(run())[-1] == "[DONE]"
+
+
+def test_text_accumulator():
+    """TextAccumulator returns the pieces in order across block boundaries"""
+    pieces = [str(i) for i in range(1000)]
+    text = TextAccumulator(block_size=64)
+    assert not text
+    for piece in pieces:
+        text.append(piece)
+    assert text.getvalue() == "".join(pieces)
+    assert len(text) == len("".join(pieces))
+
+
+def test_json_loads():
+    """The JSON backend accepts the control characters json(strict=False) does"""
+    assert json_loads('{"text": "a\tb"}') == {"text": "a\tb"}
+    assert json_loads('{"text": "Đề N3"}')["text"] == "Đề N3"
+
+
+def main():
+    print("=" * 60)
+    print("Testing sse_parser")
+    print("=" * 60)
+    
+    for test in (test_any_chunking, test_line_endings_and_fields, test_flush, test_async,
+                 test_text_accumulator, test_json_loads):
+        test()
+        print(f"   ✅ {test.__name__}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""Test STS token prefetch and reuse against a loopback fake getstsToken endpoint (no token or network needed)"""
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import oss_upload
+import qwen_client
+from qwen_client import QwenClient
+
+
+class FakeSTSAPI(BaseHTTPRequestHandler):
+    """Answers POST /api/v2/files/getstsToken with a new upload target for each call"""
+    protocol_version = "HTTP/1.1"
+    issued = []
+    lock = threading.Lock()
+    
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with self.lock:
+            self.issued.append(request["filename"])
+            number = len(self.issued)
+        body = json.dumps({"success": True, "data": {
+            "file_id": f"file-{number}",
+            "file_path": f"uploads/{number}/{request['filename']}",
+            "file_url": f"https://bucket.example/uploads/{number}/{request['filename']}",
+            "bucketname": "bucket", "endpoint": "oss.example",
+            "access_key_id": f"STS.key-{number}", "access_key_secret": "secret", "security_token": "token",
+        }}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, *args):
+        pass
+
+
+class Clock:
+    """Stands in for the time module in oss_upload"""
+    
+    def __init__(self):
+        self.now = 1000000.0
+    
+    def time(self):
+        return self.now
+
+
+class SlowOSSClient(QwenClient):
+    """Sends nothing to OSS; the first upload waits until every STS token has been fetched"""
+    
+    def __init__(self, base_url, expected_tokens=0):
+        super().__init__("token", base_url=base_url, upload_cache=False,
+                         image_preprocessor=False, response_cache=False)
+        self.expected_tokens = expected_tokens
+        self.tokens_before_first_upload = None
+        self.used = []
+        self.fail = 0
+    
+    def upload_file_to_oss(self, file_path, sts_data, progress_callback=None, size=None):
+        if self.tokens_before_first_upload is None:
+            for _ in range(200):
+                if len(FakeSTSAPI.issued) >= self.expected_tokens:
+                    break
+                time.sleep(0.01)
+            self.tokens_before_first_upload = len(FakeSTSAPI.issued)
+        self.used.append(sts_data["file_id"])
+        if self.fail:
+            self.fail -= 1
+            raise ConnectionError("OSS connection reset")
+        return sts_data["file_url"]
+
+
+server = ThreadingHTTPServer(("127.0.0.1", 0), FakeSTSAPI)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+BASE_URL = f"http://127.0.0.1:{server.server_port}/api"
+
+
+def test_prefetch():
+    """Tokens for later files are fetched while the first file still holds the only upload slot"""
+    FakeSTSAPI.issued.clear()
+    client = SlowOSSClient(BASE_URL, expected_tokens=3)
+    files = [(f"exam{i}.pdf", b"%PDF-1.4") for i in range(3)]
+    result = client.upload_files(files, max_concurrency=1, prefetch=2)
+    
+    assert client.tokens_before_first_upload == 3
+    assert sorted(FakeSTSAPI.issued) == ["exam0.pdf", "exam1.pdf", "exam2.pdf"]
+    assert [m["name"] for m in result] == ["exam0.pdf", "exam1.pdf", "exam2.pdf"]
+    assert len({m["id"] for m in result}) == 3
+
+
+def test_reuse_until_expiry():
+    """A failed large upload keeps its STS target for the retry until the session TTL passes"""
+    FakeSTSAPI.issued.clear()
+    directory = tempfile.mkdtemp()
+    clock = Clock()
+    saved = (qwen_client.MULTIPART_THRESHOLD, oss_upload.time, oss_upload.upload_sessions.root)
+    qwen_client.MULTIPART_THRESHOLD = 1024
+    oss_upload.time = clock
+    oss_upload.upload_sessions.root = os.path.join(directory, "sessions")
+    try:
+        path = os.path.join(directory, "exam.pdf")
+        with open(path, "wb") as f:
+            f.write(os.urandom(4096))
+        client = SlowOSSClient(BASE_URL)
+        
+        client.fail = 2
+        for _ in range(2):
+            try:
+                client.upload_file(path)
+            except ConnectionError:
+                pass
+            clock.now += oss_upload.upload_sessions.ttl / 2
+        assert FakeSTSAPI.issued == ["exam.pdf"] and client.used == ["file-1", "file-1"]
+        
+        # Past its lifetime the saved target is dropped and a new token fetched
+        clock.now += oss_upload.upload_sessions.ttl
+        metadata = client.upload_file(path)
+        assert len(FakeSTSAPI.issued) == 2 and metadata["id"] == "file-2"
+        
+        # A finished upload forgets its target
+        metadata = client.upload_file(path)
+        assert len(FakeSTSAPI.issued) == 3 and metadata["id"] == "file-3"
+    finally:
+        qwen_client.MULTIPART_THRESHOLD, oss_upload.time, oss_upload.upload_sessions.root = saved
+        shutil.rmtree(directory)
+
+
+def main():
+    print("=" * 60)
+    print("Testing STS token prefetch and reuse")
+    print("=" * 60)
+    
+    for test in (test_prefetch, test_reuse_until_expiry):
+        test()
+        print(f"   ✅ {test.__name__}")
+
+
+if __name__ == "__main__":
+    main()
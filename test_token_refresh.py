@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""Test token_refresher with stub clients (no token or network needed)"""
+
+import asyncio
+import threading
+import time
+
+import jwt
+
+from qwen_cache import ClientPool
+from token_refresher import AsyncTokenRefresher, TokenRefresher, token_expiry
+
+
+class StubClient:
+    """Client whose refresh_token() answers "<token>-renewed" after a delay"""
+    upstream_calls = 0
+    
+    def __init__(self, token, auto_refresh=True):
+        self.auth_token = token
+        self.auto_refresh = auto_refresh
+    
+    def set_token(self, token):
+        self.auth_token = token
+    
+    def refresh_token(self):
+        StubClient.upstream_calls += 1
+        time.sleep(0.05)
+        data = {"token": f"{self.auth_token}-renewed", "expires_at": 1900000000}
+        self.set_token(data["token"])
+        return data
+
+
+class AsyncStubClient(StubClient):
+    async def refresh_token(self):
+        StubClient.upstream_calls += 1
+        await asyncio.sleep(0.05)
+        data = {"token": f"{self.auth_token}-renewed", "expires_at": 1900000000}
+        self.set_token(data["token"])
+        return data
+
+
+def test_token_expiry():
+    """exp is read without the signing key; tokens without one, or not JWTs, have no expiry"""
+    assert token_expiry(jwt.encode({"id": "u", "exp": 1900000000}, "secret", algorithm="HS256")) == 1900000000
+    assert token_expiry(jwt.encode({"id": "u"}, "secret", algorithm="HS256")) is None
+    assert token_expiry("not.a.jwt") is None
+    assert token_expiry("garbage") is None
+    assert token_expiry("") is None
+
+
+def test_due():
+    """Only auto_refresh clients whose token expires within the margin are due"""
+    refresher = TokenRefresher(ClientPool(factory=StubClient), margin=300)
+    soon = jwt.encode({"exp": int(time.time() + 60)}, "secret", algorithm="HS256")
+    later = jwt.encode({"exp": int(time.time() + 3600)}, "secret", algorithm="HS256")
+    assert refresher.due(StubClient(soon))
+    assert not refresher.due(StubClient(later))
+    assert not refresher.due(StubClient(soon, auto_refresh=False))
+    assert not refresher.due(StubClient("garbage"))
+
+
+def test_concurrent_refresh():
+    """Concurrent refreshes of one token make one upstream call and all get the new token"""
+    StubClient.upstream_calls = 0
+    refresher = TokenRefresher(ClientPool(factory=StubClient))
+    clients = [StubClient("old") for _ in range(5)]
+    results = []
+    threads = [threading.Thread(target=lambda c=c: results.append(refresher.refresh(c))) for c in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert StubClient.upstream_calls == 1
+    assert refresher.stats()["refreshes"] == 1 and refresher.stats()["coalesced"] == 4
+    assert all(c.auth_token == "old-renewed" for c in clients)
+    assert all(r["token"] == "old-renewed" for r in results)
+
+
+def test_async_concurrent_refresh():
+    """The async refresher coalesces the same way"""
+    StubClient.upstream_calls = 0
+    refresher = AsyncTokenRefresher(ClientPool(factory=AsyncStubClient))
+    clients = [AsyncStubClient("old") for _ in range(5)]
+    
+    async def scenario():
+        return await asyncio.gather(*(refresher.refresh(c) for c in clients))
+    
+    results = asyncio.run(scenario())
+    assert StubClient.upstream_calls == 1 and refresher.stats()["coalesced"] == 4
+    assert all(c.auth_token == "old-renewed" for c in clients)
+    assert all(r["token"] == "old-renewed" for r in results)
+
+
+def test_publish():
+    """Only pooled clients still holding the old token are switched to the new one"""
+    refreshed = []
+    pool = ClientPool(factory=StubClient)
+    refresher = TokenRefresher(pool, on_refresh=lambda old, new: refreshed.append((old, new)))
+    holder = pool.get("old")
+    other = pool.get("other")
+    second_holder = pool.get("spare")
+    second_holder.set_token("old")
+    
+    refresher.publish("old", {"token": "new"})
+    assert holder.auth_token == "new" and second_holder.auth_token == "new"
+    assert other.auth_token == "other"
+    assert refreshed == [("old", "new")]
+    
+    # An answer without a new token changes nothing
+    refresher.publish("other", {"token": "other"})
+    refresher.publish("other", {})
+    assert other.auth_token == "other" and len(refreshed) == 1
+
+
+def main():
+    print("=" * 60)
+    print("Testing token_refresher")
+    print("=" * 60)
+    
+    for test in (test_token_expiry, test_due, test_concurrent_refresh, test_async_concurrent_refresh,
+                 test_publish):
+        test()
+        print(f"   ✅ {test.__name__}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""Test the cached, atomically written token file (no token or network needed)"""
+
+import json
+import os
+import shutil
+import tempfile
+
+import token_store
+from token_store import TokenStore
+
+
+class Clock:
+    """Stands in for time.monotonic()"""
+    
+    def __init__(self):
+        self.now = 1000.0
+    
+    def __call__(self):
+        return self.now
+
+
+def write(path, token):
+    with open(path, "w") as f:
+        json.dump({"token": token, "updated_at": 0}, f)
+
+
+def test_reload_on_change():
+    """Replacing the file (new inode) or rewriting it in place is picked up"""
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "token.json")
+        store = TokenStore(path, check_interval=0)
+        assert store.get() is None
+        
+        write(path + ".new", "token-a")
+        os.replace(path + ".new", path)
+        assert store.get() == "token-a"
+        assert store.get() == "token-a" and store.reloads == 1
+        
+        write(path, "token-bb")
+        assert store.get() == "token-bb" and store.reloads == 2
+        
+        os.remove(path)
+        assert store.get() is None
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_check_interval():
+    """The file is stat()ed at most once per check_interval"""
+    directory = tempfile.mkdtemp()
+    clock = Clock()
+    original = token_store.time.monotonic
+    token_store.time.monotonic = clock
+    try:
+        path = os.path.join(directory, "token.json")
+        write(path, "token-a")
+        store = TokenStore(path, check_interval=5)
+        assert store.get() == "token-a"
+        
+        write(path, "token-bb")
+        clock.now += 4
+        assert store.get() == "token-a"
+        clock.now += 1
+        assert store.get() == "token-bb"
+        
+        # A save in this process is visible at once
+        store.save("token-c")
+        assert store.get() == "token-c"
+        assert TokenStore(path).get() == "token-c"
+    finally:
+        token_store.time.monotonic = original
+        shutil.rmtree(directory)
+
+
+def test_failed_write_keeps_old_file():
+    """A write that fails before os.replace() leaves the old file and no temp file behind"""
+    directory = tempfile.mkdtemp()
+    original = token_store.os.fsync
+    
+    def failing_fsync(fd):
+        raise OSError("disk full")
+    
+    try:
+        path = os.path.join(directory, "token.json")
+        store = TokenStore(path, check_interval=0)
+        store.save("token-a")
+        
+        token_store.os.fsync = failing_fsync
+        try:
+            store.save("token-b")
+        except OSError:
+            pass
+        else:
+            raise AssertionError("failed write was not reported")
+        token_store.os.fsync = original
+        
+        assert os.listdir(directory) == ["token.json"]
+        assert json.load(open(path))["token"] == "token-a"
+        assert store.get() == "token-a"
+    finally:
+        token_store.os.fsync = original
+        shutil.rmtree(directory)
+
+
+def main():
+    print("=" * 60)
+    print("Testing token_store")
+    print("=" * 60)
+    
+    for test in (test_reload_on_change, test_check_interval, test_failed_write_keeps_old_file):
+        test()
+        print(f"   ✅ {test.__name__}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""Test the content-addressed upload cache (no token or network needed)"""
+
+import io
+import os
+import shutil
+import tempfile
+import time
+
+import jwt
+
+from upload_cache import (
+    FileBackend, HashingReader, MemoryBackend, SQLiteBackend, UploadCache, stream_digest, token_scope, url_expiry
+)
+
+
+def metadata(url="https://bucket.oss/user/f1"):
+    return {"id": "f1", "url": url, "name": "exam.pdf", "size": 3}
+
+
+def test_url_expiry():
+    """V1 and V4 signed URLs carry their expiry"""
+    assert url_expiry("https://b.oss/k?OSSAccessKeyId=a&Expires=1700000000&Signature=s") == 1700000000
+    assert url_expiry("https://b.oss/k?x-oss-date=20240101T000000Z&x-oss-expires=3600") == 1704070800
+    assert url_expiry("https://b.oss/k") is None
+
+
+def test_backends():
+    """Every backend stores, expires and forgets entries"""
+    directory = tempfile.mkdtemp()
+    try:
+        backends = [
+            MemoryBackend(),
+            SQLiteBackend(os.path.join(directory, "uploads.sqlite3")),
+            FileBackend(os.path.join(directory, "files"))
+        ]
+        for backend in backends:
+            cache = UploadCache(backend, ttl=60)
+            assert cache.get("account:1", "abc") is None
+            cache.put("account:1", "abc", metadata())
+            assert cache.get("account:1", "abc")["id"] == "f1"
+            # Entries are per account
+            assert cache.get("account:2", "abc") is None
+            
+            # Signed URLs that are (nearly) expired are not cached
+            expired = metadata(f"https://b.oss/k?Expires={int(time.time()) + 10}")
+            cache.put("account:1", "old", expired)
+            assert cache.get("account:1", "old") is None
+            
+            cache.invalidate("account:1", "abc")
+            assert cache.get("account:1", "abc") is None
+            stats = cache.stats()
+            assert stats["hits"] == 1 and stats["misses"] == 4 and stats["stores"] == 1
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_ttl_expiry():
+    """Entries without a signed URL expire after ttl seconds"""
+    cache = UploadCache(MemoryBackend(), ttl=0.05)
+    cache.put("account:1", "abc", metadata())
+    assert cache.get("account:1", "abc") is not None
+    time.sleep(0.06)
+    assert cache.get("account:1", "abc") is None
+    assert cache.stats()["expired"] == 1
+
+
+def test_token_scope():
+    """Tokens naming the same account in unverified claims still get separate entries"""
+    real = jwt.encode({"id": "user-1"}, "qwen-secret", algorithm="HS256")
+    forged = jwt.encode({"id": "user-1"}, "guessed", algorithm="HS256")
+    cache = UploadCache(MemoryBackend())
+    cache.put(token_scope(real), "abc", metadata())
+    assert cache.get(token_scope(real), "abc") is not None
+    assert cache.get(token_scope(forged), "abc") is None
+
+
+def test_digests():
+    """Paths, seekable streams and one-pass streams hash to the same digest"""
+    data = os.urandom(3 * 1024 * 1024 + 7)
+    fd, path = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        cache = UploadCache(MemoryBackend())
+        
+        buffer = io.BytesIO(data)
+        digest = stream_digest(buffer)
+        assert buffer.tell() == 0
+        assert cache.file_digest(path) == digest
+        
+        reader = HashingReader(io.BytesIO(data))
+        while reader.read(65536):
+            pass
+        assert reader.hexdigest() == digest
+    finally:
+        os.remove(path)
+
+
+def main():
+    print("=" * 60)
+    print("Testing upload_cache")
+    print("=" * 60)
+    
+    for test in (test_url_expiry, test_backends, test_ttl_expiry, test_token_scope, test_digests):
+        test()
+        print(f"   ✅ {test.__name__}")
+
+
+if __name__ == "__main__":
+    main()
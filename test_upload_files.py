@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""Test QwenClient.upload_files concurrency with a stubbed _upload_file (no token or network needed)"""
+
+import threading
+import time
+
+from qwen_client import QwenClient, UploadFailed
+
+
+class StubUploadClient(QwenClient):
+    """
+    Each file "fetches its STS token" (before taking an upload slot) and is
+    then "sent" while holding the slot; files named in fail are rejected
+    """
+    
+    def __init__(self, fail=()):
+        super().__init__("token", response_cache=False, upload_cache=False)
+        self.fail = set(fail)
+        self.lock = threading.Lock()
+        self.preparing = self.max_preparing = 0
+        self.sending = self.max_sending = 0
+        self.threads = set()
+        self.finished = []
+    
+    def _upload_file(self, file, filetype=None, progress_callback=None, filename=None,
+                     size=None, sha256=None, upload_slot=None):
+        name = filename or file
+        with self.lock:
+            self.threads.add(threading.current_thread().name)
+            self.preparing += 1
+            self.max_preparing = max(self.max_preparing, self.preparing)
+        time.sleep(0.02)
+        with self.lock:
+            self.preparing -= 1
+        
+        with upload_slot:
+            with self.lock:
+                self.sending += 1
+                self.max_sending = max(self.max_sending, self.sending)
+            # Later files finish first, so results have to be put back in order
+            time.sleep(0.05 if name.endswith("0.pdf") else 0.01)
+            with self.lock:
+                self.sending -= 1
+                self.finished.append(name)
+        if name in self.fail:
+            raise ConnectionError(f"OSS rejected {name}")
+        return {"id": name, "name": name}
+
+
+def files(count):
+    return [(f"exam{i}.pdf", b"%PDF-1.4") for i in range(count)]
+
+
+def test_ordered_results():
+    """Metadata comes back in input order however the uploads finish"""
+    client = StubUploadClient()
+    result = client.upload_files(files(6), max_concurrency=3, prefetch=0)
+    assert [m["name"] for m in result] == [f"exam{i}.pdf" for i in range(6)]
+    assert client.finished != [m["name"] for m in result]
+
+
+def test_one_failure():
+    """One failed file is reported by index without cancelling the others"""
+    client = StubUploadClient(fail={"exam2.pdf"})
+    try:
+        client.upload_files(files(6), max_concurrency=2, prefetch=1)
+    except UploadFailed as e:
+        assert [(f["index"], f["file"]) for f in e.failures] == [(2, "exam2.pdf")]
+        assert "OSS rejected exam2.pdf" in e.failures[0]["error"]
+        assert [m["name"] for m in e.uploaded] == ["exam0.pdf", "exam1.pdf", "exam3.pdf", "exam4.pdf", "exam5.pdf"]
+    else:
+        raise AssertionError("failed upload was not reported")
+    assert len(client.finished) == 6
+
+
+def test_slots_and_prefetch():
+    """At most max_concurrency files send at once; prefetch more prepare ahead in their own threads"""
+    client = StubUploadClient()
+    client.upload_files(files(10), max_concurrency=2, prefetch=3)
+    assert client.max_sending == 2
+    assert client.max_preparing == 5 and len(client.threads) == 5
+    
+    client = StubUploadClient()
+    client.upload_files(files(3), max_concurrency=8, prefetch=4)
+    assert len(client.threads) == 3
+    assert client.upload_files([]) == []
+
+
+def main():
+    print("=" * 60)
+    print("Testing QwenClient.upload_files")
+    print("=" * 60)
+    
+    for test in (test_ordered_results, test_one_failure, test_slots_and_prefetch):
+        test()
+        print(f"   ✅ {test.__name__}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""
+Proactive refresh of pooled clients' Qwen tokens
+
+Qwen tokens are JWTs with an exp claim. Instead of letting a token expire
+and failing the next user request, the refresher wakes up every interval
+seconds, looks at every pooled client with auto_refresh enabled and
+refreshes the ones expiring within margin seconds. Concurrent refreshes of
+the same token (background loop, /api/token/refresh, several pooled
+clients) share one upstream /v1/auths/ call, and the new token is published
+to every client still holding the old one. Publishing only swaps the header
+used for new requests, so streams already in flight are not interrupted.
+"""
+
+import asyncio
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+import jwt
+
+
+def token_expiry(token: str) -> Optional[float]:
+    """
+    Expiry time of a JWT (its exp claim), read without verifying the signature
+    
+    Returns:
+        Unix timestamp, or None if the token is not a JWT or has no exp
+    """
+    try:
+        claims = jwt.decode(token, options={"verify_signature": False})
+    except jwt.PyJWTError:
+        return None
+    exp = claims.get("exp")
+    return float(exp) if exp else None
+
+
+class BaseTokenRefresher:
+    """Scheduling, publishing and counters shared by the sync and async refreshers"""
+    
+    def __init__(self, pool, margin: float = 300, interval: float = 60,
+                 on_refresh: Optional[Callable[[str, str], None]] = None):
+        """
+        Args:
+            pool: qwen_cache.ClientPool whose clients are kept fresh
+            margin: Refresh tokens expiring within this many seconds
+            interval: Seconds between checks
+            on_refresh: Called with (old_token, new_token) after a refresh,
+                e.g. to update the stored token file
+        """
+        self.pool = pool
+        self.margin = margin
+        self.interval = interval
+        self.on_refresh = on_refresh
+        self.refreshes = 0
+        self.coalesced = 0
+        self.failures = 0
+        self.last_error = None
+    
+    def due(self, client) -> bool:
+        """Whether client's token should be refreshed now"""
+        if not getattr(client, "auto_refresh", False):
+            return False
+        expires_at = token_expiry(client.auth_token)
+        return expires_at is not None and expires_at - time.time() < self.margin
+    
+    def publish(self, old_token: str, data: Dict):
+        """Hand the refreshed token to every pooled client still using old_token"""
+        new_token = data.get("token")
+        if not new_token or new_token == old_token:
+            return
+        for client in self.pool.clients():
+            if client.auth_token == old_token:
+                client.set_token(new_token)
+        if self.on_refresh:
+            self.on_refresh(old_token, new_token)
+    
+    def _failed(self, error: Exception):
+        self.failures += 1
+        self.last_error = str(error)
+        print(f"⚠️  Token refresh failed: {error}")
+    
+    def stats(self) -> Dict:
+        return {
+            "margin": self.margin,
+            "interval": self.interval,
+            "refreshes": self.refreshes,
+            "coalesced": self.coalesced,
+            "failures": self.failures,
+            "last_error": self.last_error
+        }
+
+
+class TokenRefresher(BaseTokenRefresher):
+    """Background thread refreshing QwenClient tokens (api_server.py)"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self._inflight = {}  # old token -> [done Event, result, error]
+        self._stop = threading.Event()
+        self._thread = None
+    
+    def refresh(self, client) -> Dict:
+        """
+        Refresh client's token now
+        
+        Callers refreshing the same token at the same time wait for the
+        first caller's upstream request and get its result.
+        """
+        old_token = client.auth_token
+        with self._lock:
+            call = self._inflight.get(old_token)
+            leader = call is None
+            if leader:
+                call = self._inflight[old_token] = [threading.Event(), None, None]
+            else:
+                self.coalesced += 1
+        
+        if not leader:
+            call[0].wait()
+            if call[2] is not None:
+                raise call[2]
+            if call[1].get("token"):
+                client.set_token(call[1]["token"])
+            return call[1]
+        
+        try:
+            data = client.refresh_token()
+            call[1] = data
+            self.refreshes += 1
+            self.publish(old_token, data)
+            return data
+        except Exception as e:
+            call[2] = e
+            self._failed(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[old_token]
+            call[0].set()
+    
+    def run_once(self):
+        """Refresh every pooled client whose token is about to expire"""
+        for client in self.pool.clients():
+            if self.due(client):
+                try:
+                    self.refresh(client)
+                except Exception:
+                    pass
+    
+    def _run(self):
+        while True:
+            self.run_once()
+            if self._stop.wait(self.interval):
+                return
+    
+    def start(self):
+        """Start the background thread (safe to call repeatedly)"""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="token-refresher", daemon=True)
+                self._thread.start()
+    
+    def stop(self):
+        """Stop the background thread"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class AsyncTokenRefresher(BaseTokenRefresher):
+    """Background task refreshing AsyncQwenClient tokens (asgi_server.py)"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._inflight = {}  # old token -> Future
+        self._task = None
+    
+    async def refresh(self, client) -> Dict:
+        """Refresh client's token now; concurrent calls share one upstream request"""
+        old_token = client.auth_token
+        future = self._inflight.get(old_token)
+        if future is not None:
+            self.coalesced += 1
+            data = await asyncio.shield(future)
+            if data.get("token"):
+                client.set_token(data["token"])
+            return data
+        
+        future = self._inflight[old_token] = asyncio.get_running_loop().create_future()
+        try:
+            data = await client.refresh_token()
+            self.refreshes += 1
+            self.publish(old_token, data)
+            future.set_result(data)
+            return data
+        except Exception as e:
+            self._failed(e)
+            future.set_exception(e)
+            # Mark the exception as retrieved when nobody else was waiting
+            future.exception()
+            raise
+        finally:
+            if not future.done():
+                future.cancel()
+            del self._inflight[old_token]
+    
+    async def run_once(self):
+        """Refresh every pooled client whose token is about to expire"""
+        for client in self.pool.clients():
+            if self.due(client):
+                try:
+                    await self.refresh(client)
+                except Exception:
+                    pass
+    
+    async def _run(self):
+        while True:
+            await self.run_once()
+            await asyncio.sleep(self.interval)
+    
+    def start(self):
+        """Start the background task on the running event loop"""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+    
+    async def stop(self):
+        """Cancel the background task"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
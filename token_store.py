@@ -0,0 +1,106 @@
+"""
+In-memory view of the persisted Qwen token (.token_storage.json)
+
+Requests without an Authorization header fall back to the stored token.
+Reading and parsing the file for every such request costs a filesystem read
+per API call, so TokenStore keeps the token in memory and only reloads it
+when the file's inode, mtime or size changes. Writes go to a temp file in
+the same directory and are moved into place with os.replace(), so readers
+(in this process or another worker) never see a half-written file.
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, Optional
+
+
+class TokenStore:
+    """Thread-safe cached token file"""
+    
+    def __init__(self, path: str, check_interval: float = 1.0):
+        """
+        Args:
+            path: JSON file holding {"token": ..., "updated_at": ...}
+            check_interval: Minimum seconds between stat() calls on the file;
+                changes made by other processes show up after at most this long
+        """
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._data = {}
+        self._signature = None      # (inode, mtime_ns, size) of the loaded file
+        self._checked_at = None     # time.monotonic() of the last stat()
+        self.reloads = 0
+    
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+    
+    def _refresh(self):
+        """Reload the file if it changed since it was last read (lock held)"""
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        
+        signature = self._stat()
+        if signature == self._signature:
+            return
+        
+        data = {}
+        if signature is not None:
+            try:
+                with open(self.path, 'r') as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                data = {}
+        self._data = data if isinstance(data, dict) else {}
+        self._signature = signature
+        self.reloads += 1
+    
+    def data(self) -> Dict:
+        """Copy of the stored record"""
+        with self._lock:
+            self._refresh()
+            return dict(self._data)
+    
+    def get(self) -> Optional[str]:
+        """Stored token, or None"""
+        with self._lock:
+            self._refresh()
+            return self._data.get('token')
+    
+    def save(self, token: str):
+        """Persist token atomically and make it visible immediately"""
+        data = {'token': token, 'updated_at': int(time.time())}
+        directory = os.path.dirname(os.path.abspath(self.path))
+        
+        with self._lock:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.token_', suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(data, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            
+            self._data = data
+            self._signature = self._stat()
+            self._checked_at = time.monotonic()
+    
+    def invalidate(self):
+        """Forget the cached copy so the next read goes to disk"""
+        with self._lock:
+            self._data = {}
+            self._signature = None
+            self._checked_at = None
@@ -0,0 +1,311 @@
+"""
+Content-addressed cache of uploaded files
+
+The same attachments (exam PDFs, screenshots) are sent again and again, and
+each upload costs an STS token request plus a full OSS upload. UploadCache
+maps the SHA-256 of a file's content to the file metadata returned by the
+first upload, so a repeat attachment reuses the uploaded object without
+touching the network.
+
+Entries are scoped to the token that uploaded them and expire with the
+signed OSS URL (Expires / x-oss-expires in the URL, minus a safety margin),
+or after ttl seconds when the URL does not say. Where the index lives is
+pluggable: MemoryBackend (per process), SQLiteBackend (shared by the
+workers of one host) or FileBackend (one JSON file per entry).
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from calendar import timegm
+from typing import BinaryIO, Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from oss_upload import file_identity
+from qwen_cache import TTLCache
+
+# Seconds an entry is kept when its URL carries no expiry
+UPLOAD_CACHE_TTL = float(os.getenv("QWEN_UPLOAD_CACHE_TTL", "21600"))
+# Entries are dropped this many seconds before their URL expires
+UPLOAD_CACHE_MARGIN = float(os.getenv("QWEN_UPLOAD_CACHE_MARGIN", "300"))
+
+_HASH_CHUNK = 1024 * 1024
+
+
+def url_expiry(url: str) -> Optional[float]:
+    """
+    Expiry time of a signed OSS URL
+    
+    Understands V1 signatures (Expires=<unix time>) and V4 signatures
+    (x-oss-date=<YYYYMMDDTHHMMSSZ>&x-oss-expires=<seconds>).
+    
+    Returns:
+        Unix timestamp, or None if the URL is not signed
+    """
+    query = {k.lower(): v[0] for k, v in parse_qs(urlsplit(url).query).items()}
+    try:
+        if "expires" in query:
+            return float(query["expires"])
+        if "x-oss-expires" in query and "x-oss-date" in query:
+            signed_at = timegm(time.strptime(query["x-oss-date"], "%Y%m%dT%H%M%SZ"))
+            return signed_at + float(query["x-oss-expires"])
+    except ValueError:
+        pass
+    return None
+
+
+def token_scope(token: str) -> str:
+    """
+    Cache scope of a token: a hash of the whole token
+    
+    JWT claims are not verified here, so scoping by the account ID they name
+    would let a forged token read another account's entries. A refreshed
+    token therefore starts with an empty scope.
+    """
+    return "token:" + hashlib.sha256(token.encode()).hexdigest()
+
+
+def stream_digest(stream: BinaryIO) -> Optional[str]:
+    """SHA-256 of the rest of a seekable stream, which is rewound afterwards"""
+    try:
+        if not stream.seekable():
+            return None
+        position = stream.tell()
+    except (AttributeError, OSError, ValueError):
+        return None
+    
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(_HASH_CHUNK), b""):
+        digest.update(chunk)
+    stream.seek(position)
+    return digest.hexdigest()
+
+
+class HashingReader:
+    """Pass-through reader that hashes what is read, for streams that cannot be rewound"""
+    
+    def __init__(self, stream: BinaryIO):
+        self.stream = stream
+        self._digest = hashlib.sha256()
+    
+    def read(self, size: int = -1) -> bytes:
+        data = self.stream.read(size)
+        self._digest.update(data)
+        return data
+    
+    def hexdigest(self) -> str:
+        return self._digest.hexdigest()
+
+
+class MemoryBackend:
+    """Per-process index, least recently used entries dropped past max_size"""
+    
+    def __init__(self, max_size: int = 4096):
+        self._cache = TTLCache(max_size=max_size, ttl=None)
+    
+    def get(self, key: str) -> Optional[Tuple[Dict, float]]:
+        return self._cache.get(key)
+    
+    def set(self, key: str, metadata: Dict, expires_at: float):
+        self._cache.set(key, (metadata, expires_at))
+    
+    def delete(self, key: str):
+        self._cache.pop(key)
+    
+    def __len__(self):
+        return len(self._cache)
+
+
+class SQLiteBackend:
+    """Index in an SQLite database, shared by every process on the host"""
+    
+    def __init__(self, path: str, table: str = "uploads"):
+        if not table.isidentifier():
+            raise ValueError(f"Invalid table name: {table}")
+        self.path = path
+        self.table = table
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "key TEXT PRIMARY KEY, metadata TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+    
+    def get(self, key: str) -> Optional[Tuple[Dict, float]]:
+        with self._lock:
+            row = self._db.execute(
+                f"SELECT metadata, expires_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+        return (json.loads(row[0]), row[1]) if row else None
+    
+    def set(self, key: str, metadata: Dict, expires_at: float):
+        with self._lock:
+            self._db.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, metadata, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(metadata), expires_at)
+            )
+            # Writes are rare next to reads, so expired rows are swept here
+            self._db.execute(f"DELETE FROM {self.table} WHERE expires_at < ?", (time.time(),))
+    
+    def delete(self, key: str):
+        with self._lock:
+            self._db.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+    
+    def __len__(self):
+        with self._lock:
+            return self._db.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+
+class FileBackend:
+    """Index as one JSON file per entry in a directory"""
+    
+    def __init__(self, root: str):
+        self.root = root
+    
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, f"{key}.json")
+    
+    def get(self, key: str) -> Optional[Tuple[Dict, float]]:
+        try:
+            with open(self._path(key), 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return entry['metadata'], entry['expires_at']
+    
+    def set(self, key: str, metadata: Dict, expires_at: float):
+        # File URLs are only as private as the account's uploads: owner-only files
+        os.makedirs(self.root, mode=0o700, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'metadata': metadata, 'expires_at': expires_at}, f)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    
+    def delete(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+    
+    def __len__(self):
+        try:
+            return sum(1 for name in os.listdir(self.root) if name.endswith('.json'))
+        except OSError:
+            return 0
+
+
+class UploadCache:
+    """SHA-256 of file content -> metadata of the uploaded file, per account"""
+    
+    def __init__(self, backend=None, ttl: float = UPLOAD_CACHE_TTL,
+                 margin: float = UPLOAD_CACHE_MARGIN):
+        """
+        Args:
+            backend: MemoryBackend, SQLiteBackend or FileBackend (default MemoryBackend())
+            ttl: Seconds an entry is kept when its URL carries no expiry
+            margin: Entries expire this many seconds before their URL does
+        """
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.ttl = ttl
+        self.margin = margin
+        # file_identity() -> digest, so unchanged local files are hashed once
+        self._digests = TTLCache(max_size=4096, ttl=None)
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.expired = 0
+    
+    @staticmethod
+    def _key(scope: str, digest: str) -> str:
+        return hashlib.sha256(f"{scope}|{digest}".encode()).hexdigest()
+    
+    def file_digest(self, file_path: str) -> str:
+        """SHA-256 of a local file, remembered until the file changes"""
+        identity = file_identity(file_path)
+        digest = self._digests.get(identity)
+        if digest is None:
+            with open(file_path, 'rb') as f:
+                digest = stream_digest(f)
+            self._digests.set(identity, digest)
+        return digest
+    
+    def source_digest(self, source) -> Optional[str]:
+        """SHA-256 of a path or seekable stream; None for streams that cannot be rewound"""
+        if isinstance(source, (str, os.PathLike)):
+            return self.file_digest(source)
+        return stream_digest(source)
+    
+    def get(self, scope: str, digest: str) -> Optional[Dict]:
+        """Metadata of an earlier upload of the same content, or None"""
+        entry = self.backend.get(self._key(scope, digest))
+        if entry is not None and entry[1] <= time.time():
+            self.backend.delete(self._key(scope, digest))
+            self.expired += 1
+            entry = None
+        
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return dict(entry[0])
+    
+    def put(self, scope: str, digest: str, metadata: Dict):
+        """Remember an upload until shortly before its URL expires"""
+        now = time.time()
+        expires_at = now + self.ttl
+        url_expires_at = url_expiry(metadata.get('url', ''))
+        if url_expires_at is not None:
+            expires_at = min(expires_at, url_expires_at - self.margin)
+        if expires_at <= now:
+            return
+        self.backend.set(self._key(scope, digest), metadata, expires_at)
+        self.stores += 1
+    
+    def invalidate(self, scope: str, digest: str):
+        self.backend.delete(self._key(scope, digest))
+    
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self.backend).__name__,
+            "size": len(self.backend),
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "expired": self.expired,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+
+def create_upload_cache() -> Optional[UploadCache]:
+    """
+    UploadCache configured from the environment
+    
+    QWEN_UPLOAD_CACHE: "memory" (default), "sqlite", "file" or "off"
+    QWEN_UPLOAD_CACHE_PATH: database file or directory for sqlite/file
+    """
+    kind = os.getenv("QWEN_UPLOAD_CACHE", "memory").lower()
+    default_path = os.path.join(tempfile.gettempdir(), "qwen_upload_cache")
+    path = os.getenv("QWEN_UPLOAD_CACHE_PATH")
+    
+    if kind == "off":
+        return None
+    if kind == "sqlite":
+        return UploadCache(SQLiteBackend(path or f"{default_path}.sqlite3"))
+    if kind == "file":
+        return UploadCache(FileBackend(path or default_path))
+    return UploadCache(MemoryBackend(int(os.getenv("QWEN_UPLOAD_CACHE_SIZE", "4096"))))
+
+
+shared_upload_cache = create_upload_cache()